@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import math
+import threading
+from datetime import date
+from pathlib import Path
+
+from file_manager import save_file
+
+
+class AgePlanner:
+    """
+    Планировщик возрастных диапазонов для поисковых запросов. Заменяет деление диапазона пополам:
+    - Если выдача упирается в лимит, диапазон сразу делится на столько частей, сколько нужно для `total` результатов.
+    Границы частей выбираются по гистограмме возрастов прошлого запуска, а без нее - по датам рождения Персон
+    из уже полученной (обрезанной лимитом) выдачи.
+    - Гистограммы (возрастные диапазоны листьев и количество Персон в них) сохраняются для каждой комбинации
+    (тип страницы, гражданство, пол), поэтому следующий запуск сразу запрашивает диапазоны, не упирающиеся в лимит.
+    """
+
+    def __init__(self, histograms_path, limit: int, fill: float = 0.75):
+        """
+        :param histograms_path: Путь к json-файлу гистограмм. Если пуст - гистограммы не сохраняются между запусками.
+        :param limit: Лимит результатов выдачи, `notices_limit`.
+        :param fill: Желаемая заполненность листа относительно лимита. Запас нужен на случай роста количества Персон.
+        """
+        self.path = Path(histograms_path) if histograms_path else None
+        self.limit = limit
+        self.fill = fill
+        self.histograms = {}    # Гистограммы прошлого запуска: {ключ: [[min_age, max_age, total], ...]}
+        if self.path and self.path.exists():
+            with self.path.open(encoding='utf-8') as fp:
+                self.histograms = json.load(fp)
+        self.leaves = {}        # Листья текущего запуска в том же формате
+        self.roots = {}         # Исходный возрастной диапазон каждой комбинации: {ключ: [min_age, max_age]}
+        self.requests = 0       # Сколько поисковых запросов фактически отправлено
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(page_id: str, nation: str, gender: str) -> str:
+        return f'{page_id}/{nation}/{gender}'
+
+    def get_density(self, key: str, min_age: int, max_age: int) -> dict:
+        """
+        Ожидаемое количество Персон на каждый возраст по гистограмме прошлого запуска.
+        Внутри листа Персоны считаются распределенными равномерно.
+        :return: Словарь {возраст: количество}. Пустой, если гистограммы нет.
+        """
+        density = {}
+        for leaf_min, leaf_max, total in self.histograms.get(key, []):
+            width = leaf_max - leaf_min + 1
+            for age in range(max(leaf_min, min_age), min(leaf_max, max_age) + 1):
+                density[age] = density.get(age, 0) + total / width
+        return density
+
+    def plan(self, page_id: str, nation: str, gender: str, min_age: int, max_age: int) -> list:
+        """
+        Начальный набор диапазонов для комбинации фильтров. По гистограмме соседние возрасты объединяются в диапазоны,
+        каждый из которых не должен упереться в лимит. Без гистограммы возвращается весь диапазон целиком.
+        :return: Список диапазонов [[min_age, max_age], ...].
+        """
+        key = self.get_key(page_id, nation, gender)
+        with self.lock:
+            self.roots[key] = [min_age, max_age]
+        density = self.get_density(key, min_age, max_age)
+        if not density:
+            return [[min_age, max_age]]
+
+        ranges = []
+        range_min, count = min_age, 0
+        for age in range(min_age, max_age + 1):
+            age_count = density.get(age, 0)
+            if age > range_min and count + age_count > self.limit * self.fill:
+                ranges.append([range_min, age - 1])
+                range_min, count = age, 0
+            count += age_count
+        ranges.append([range_min, max_age])
+        return ranges
+
+    @staticmethod
+    def get_sample_density(sample: list, min_age: int, max_age: int) -> dict:
+        """
+        Количество Персон на каждый возраст по выборке превью. Возраст считается по `date_of_birth` формата
+        `ГГГГ/ММ/ДД` и прижимается к границам диапазона, т.к. сервер может считать его с точностью до года.
+        :return: Словарь {возраст: количество}.
+        """
+        today = date.today()
+        density = {}
+        for notice in sample or []:
+            try:
+                year, month, day = (int(part) for part in notice['date_of_birth'].split('/'))
+            except (KeyError, AttributeError, ValueError):
+                continue    # Дата рождения не указана или указана не полностью
+            age = today.year - year - ((today.month, today.day) < (month, day))
+            age = min(max(age, min_age), max_age)
+            density[age] = density.get(age, 0) + 1
+        return density
+
+    def split(self, page_id: str, nation: str, gender: str, min_age: int, max_age: int, total: int,
+              sample: list = None) -> list:
+        """
+        Делит диапазон, выдача по которому уперлась в лимит, на нужное количество частей за один шаг.
+        :param total: Количество Персон в диапазоне по ответу сервера.
+        :param sample: Превью Персон из ответа по этому диапазону. Используется, если нет гистограммы.
+        :return: Список диапазонов [[min_age, max_age], ...] из двух и более частей.
+        """
+        parts = min(max(2, math.ceil(total / (self.limit * self.fill))), max_age - min_age + 1)
+        density = self.get_density(self.get_key(page_id, nation, gender), min_age, max_age)
+        if sum(density.values()) <= 0:
+            density = self.get_sample_density(sample, min_age, max_age)
+        if sum(density.values()) <= 0:
+            # Нет ни гистограммы, ни дат рождения - считаем Персон равномерно распределенными по возрастам
+            density = {age: 1 for age in range(min_age, max_age + 1)}
+
+        # Ставим границы так, чтобы в каждую часть попадала примерно равная доля Персон
+        ranges = []
+        range_min, count = min_age, 0
+        part_count = sum(density.values()) / parts
+        for age in range(min_age, max_age + 1):
+            count += density.get(age, 0)
+            ages_left = max_age - age
+            parts_left = parts - len(ranges) - 1
+            if parts_left and (count >= part_count or ages_left == parts_left):
+                ranges.append([range_min, age])
+                range_min, count = age + 1, 0
+        ranges.append([range_min, max_age])
+        return ranges
+
+    def record_request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def record_leaf(self, page_id: str, nation: str, gender: str, min_age: int, max_age: int, total: int) -> None:
+        """Запоминаем лист дерева поиска и количество Персон в нем для гистограммы следующего запуска."""
+        with self.lock:
+            self.leaves.setdefault(self.get_key(page_id, nation, gender), []).append([min_age, max_age, total])
+
+    def start_run(self) -> None:
+        """
+        Начинает новый запуск тем же объектом: листья прошлого запуска становятся гистограммами. Используется
+        службой (`--daemon`), которая не перечитывает файл гистограмм перед каждым циклом.
+        """
+        with self.lock:
+            for key, leaves in self.leaves.items():
+                self.histograms[key] = sorted(leaves)
+            self.leaves = {}
+            self.roots = {}
+            self.requests = 0
+
+    def count_bisection_requests(self) -> int:
+        """
+        Оценка количества запросов, которое потребовалось бы при делении диапазонов пополам, как в `get_age_ranges()`.
+        Считается по листьям текущего запуска для всех пройденных комбинаций фильтров.
+        """
+        requests = 0
+        for key, leaves in self.leaves.items():
+            density = {}
+            for leaf_min, leaf_max, total in leaves:
+                for age in range(leaf_min, leaf_max + 1):
+                    density[age] = density.get(age, 0) + total / (leaf_max - leaf_min + 1)
+
+            stack = [self.roots.get(key, [min(leaf[0] for leaf in leaves), max(leaf[1] for leaf in leaves)])]
+            while stack:
+                min_age, max_age = stack.pop()
+                requests += 1
+                if sum(density.get(age, 0) for age in range(min_age, max_age + 1)) >= self.limit \
+                        and min_age != max_age:
+                    lower_max = (max_age - min_age) // 2 + min_age
+                    stack += [[min_age, lower_max], [lower_max + 1, max_age]]
+        return requests
+
+    def save(self) -> None:
+        """
+        Сохраняем гистограммы. Для комбинаций, не пройденных в этом запуске, остаются прежние. Файл перечитывается
+        перед записью, т.к. при обходе по шардам его могли обновить другие процессы.
+        """
+        if not self.path:
+            return
+        histograms = dict(self.histograms)
+        if self.path.exists():
+            with self.path.open(encoding='utf-8') as fp:
+                histograms.update(json.load(fp))
+        for key, leaves in self.leaves.items():
+            histograms[key] = sorted(leaves)
+        save_file(file_path=self.path, file_data=histograms)
@@ -0,0 +1,435 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import functools
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from age_planner import AgePlanner
+from bs_interface import NoticePage, PersonDetail, PersonPreview
+from dedup_index import DedupIndex
+from delta_sync import DeltaIndex
+from file_manager import Settings
+from http_client import HttpClient
+from instrumentation import metrics
+from main import get_search_url, get_age_ranges, print_http_stats, print_planner_stats, open_state_store, \
+    create_client, finish_state, get_pages, get_queries, get_part, populate_queue, get_notice_page, create_dedup, \
+    get_dedup_uses, restore_person, save_person_copy, finish_dedup, print_dedup_stats, get_on_done, write_person, \
+    finish_delta, get_search_result, open_thumbnails, defer_thumbnails, is_known
+from output_backends import create_output
+from state_store import StateStore
+from work_queue import WorkQueue, in_shard
+
+logger = logging.getLogger(__name__)
+
+PERSONS_PER_REQUEST = 4     # Сколько незавершенных задач загрузки Персон допускается на один одновременный запрос
+
+
+class AsyncCrawler:
+    """
+    Асинхронный обход поисковых страниц. Повторяет логику синхронного `crawl()` из `main.py`, но запросы по
+    половинам возрастного диапазона, детальные данные, списки фото, сами фото и миниатюры запрашиваются параллельно.
+    Блокирующие вызовы `requests` выполняются в пуле потоков, а общее количество одновременных запросов
+    ограничивается одним семафором на весь обход.
+    """
+
+    def __init__(self, settings: Settings, client: HttpClient = None, shard: tuple = None, queue: WorkQueue = None,
+                 worker_id: str = None, planner: AgePlanner = None, queries: list = None, skip_known: bool = False,
+                 state: StateStore = None, dedup: DedupIndex = None):
+        """
+        :param settings: Объект настроек. Размер семафора и пула потоков берется из `settings.concurrency`.
+        :param client: Общий HTTP-клиент. Если не передан - создается новый с пулом не меньше `concurrency`.
+        :param shard: Статический шард (номер шарда от `1`, количество шардов), как в `crawl()`.
+        :param queue: Общая очередь шардов. Если передана - комбинации фильтров берутся из нее.
+        :param worker_id: Идентификатор процесса в очереди.
+        :param planner: Планировщик возрастных диапазонов. Если не передан - создается по файлу `age_histograms`.
+        :param queries: Комбинации фильтров в порядке обхода, как в `crawl()`: кортежи (тип страницы,
+        объект `NoticePage`, гражданство, пол). Запросы комбинаций начинаются в этом порядке.
+        :param skip_known: Загружать только Персон, которых нет в снимке дельта-синхронизации.
+        :param state: Хранилище состояния, как в `crawl()`. Если не передано - открывается по настройкам
+        и закрывается в конце обхода.
+        :param dedup: Индекс уже загруженных Персон, как в `crawl()`. Если не передан - создается по настройкам.
+        """
+        self.settings = settings
+        self.client = client if client else create_client(settings,
+                                                          pool_size=max(settings.pool_size, settings.concurrency))
+        self.executor = ThreadPoolExecutor(max_workers=settings.concurrency)
+        self.own_state, self.own_dedup = not state, not dedup   # Закрываем только то, что открыли сами
+        self.state = open_state_store(settings) if self.own_state else state
+        self.planner = planner if planner else AgePlanner(histograms_path=settings.age_histograms,
+                                                          limit=settings.notices_limit)
+        self.queries = queries
+        self.skip_known = skip_known
+        self.shard = shard
+        self.queue = queue
+        self.worker_id = worker_id
+        self.part = get_part(shard, worker_id)
+        self.output = create_output(settings, blobs=self.client.blobs, part=self.part)
+        self.dedup = create_dedup(settings) if self.own_dedup else dedup
+        self.delta = DeltaIndex(settings.delta_db) if settings.delta_db else None
+        self.thumbnails = open_thumbnails(settings, self.client, self.output, resume=not self.part)
+        self.semaphore = None   # Создается уже внутри цикла событий, в `run()`
+        self.person_slots = None    # Ограничивает число незавершенных задач загрузки Персон, тоже в `run()`
+        self.persons_pending = 0    # Персоны, загрузка или запись которых еще не завершена
+        self.changelog = None       # Список изменений дельта-синхронизации, если запуск завершен
+
+    async def run_blocking(self, func, *args):
+        """
+        Выполняет блокирующий сетевой вызов в пуле потоков, не превышая лимит одновременных запросов.
+        :param func: Функция, выполняющая запрос.
+        :param args: Аргументы функции.
+        :return: Результат функции.
+        """
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def search_notices(self, notice_type: str, nation: str, gender: str, min_age: int, max_age: int,
+                             on_leaf) -> None:
+        """
+        Асинхронный аналог `iter_notices()` из `main.py`. Если выдача упирается в лимит, то все части
+        возрастного диапазона запрашиваются одновременно.
+        :param on_leaf: Функция, которая получает словарь превью каждого листа дерева поиска сразу после его получения:
+        Ключ - `entity_id`, Значение - Словарь с краткими сведениями о найденной персоне.
+        """
+        limit = self.settings.notices_limit
+        notices = {}
+        search_node = self.state.get_search_node(notice_type, nation, gender, min_age, max_age) if self.state else None
+        if search_node and not search_node['split']:
+            self.planner.record_leaf(notice_type, nation, gender, min_age, max_age, search_node['total'])
+            on_leaf(search_node['notices'])
+            return
+        split = bool(search_node)
+        total = search_node['total'] if search_node else 0
+        sub_ranges = (search_node['sub_ranges'] or get_age_ranges(min_age, max_age)) if search_node else []
+
+        if not split:
+            request = get_search_url(url=self.settings.request_url, notice_type=notice_type, nation=nation,
+                                     gender=gender, min_age=min_age, max_age=max_age, limit=limit)
+            logger.info(f'Request: {request}', extra={'url': request, 'resource': 'search'})
+            try:
+                response = await self.run_blocking(self.client.get, request, 'search')
+            except Exception as e:
+                logger.error(e, extra={'url': request})
+                response = None
+            self.planner.record_request()
+            output_dict = None
+            if response is not None and response.status_code == 200:
+                with metrics.timer('parse_seconds', stage='search'):
+                    output_dict = response.json()
+            if output_dict is None:
+                logger.error(f'Request failed: {request}', extra={'url': request})
+
+            if output_dict and int(output_dict['total']) > 0:
+                total = int(output_dict['total'])
+                split = total >= limit and min_age != max_age
+                if split:
+                    sub_ranges = self.planner.split(notice_type, nation, gender, min_age, max_age, total,
+                                                    sample=output_dict['_embedded']['notices'])
+                else:
+                    for notice in output_dict['_embedded']['notices']:
+                        notices[notice['entity_id']] = notice
+
+            if output_dict is not None and not split:
+                self.planner.record_leaf(notice_type, nation, gender, min_age, max_age, total)
+            metrics.inc('search_queries_total', result=get_search_result(output_dict, split))
+            if self.state and output_dict is not None:
+                self.state.save_search_node(notice_type, nation, gender, min_age, max_age, split=split, total=total,
+                                            notices=notices, sub_ranges=sub_ranges if split else None)
+
+            if not split:
+                on_leaf(notices)
+
+        if split:
+            await asyncio.gather(*(self.search_notices(notice_type, nation, gender, sub_min_age, sub_max_age, on_leaf)
+                                   for sub_min_age, sub_max_age in sub_ranges))
+
+    async def iter_notices(self, notice_type: str, nation: str, gender: str, age_ranges: list):
+        """
+        Асинхронный итератор превью Персон по всем диапазонам `age_ranges`. Диапазоны запрашиваются одновременно,
+        а превью каждого листа выдаются, как только он получен.
+        :return: Пары (`entity_id`, Словарь с краткими сведениями о найденной персоне).
+        """
+        leaves = asyncio.Queue()
+
+        async def search_all():
+            try:
+                await asyncio.gather(*(self.search_notices(notice_type, nation, gender, min_age, max_age,
+                                                           leaves.put_nowait)
+                                       for min_age, max_age in age_ranges))
+            finally:
+                leaves.put_nowait(None)     # Конец выдачи
+
+        search = asyncio.ensure_future(search_all())
+        try:
+            while True:
+                notices = await leaves.get()
+                if notices is None:
+                    break
+                for item in notices.items():
+                    yield item
+            await search    # Пробрасываем ошибку поиска, если она была
+        finally:
+            search.cancel()
+
+    async def get_notices(self, notice_type: str, nation: str, gender: str, min_age: int, max_age: int) -> dict:
+        """
+        Асинхронный аналог `get_notices()` из `main.py`.
+        :return: Словарь: Ключ - `entity_id`, Значение - Словарь с краткими сведениями о найденной персоне.
+        """
+        notices = {}
+        await self.search_notices(notice_type, nation, gender, min_age, max_age, notices.update)
+        return notices
+
+    async def get_person_preview(self, notice_preview_json: dict) -> PersonPreview:
+        """Аналог `PersonPreview()`. Сетевых запросов не делает: миниатюра скачивается при сохранении Персоны."""
+        return PersonPreview(person_preview_data=notice_preview_json, client=self.client)
+
+    async def get_person_detail(self, notice_preview_json: dict) -> PersonDetail:
+        """
+        Асинхронный аналог `PersonDetail()`: детальные данные и список фото запрашиваем одновременно.
+        Сами фото скачиваются при сохранении Персоны.
+        """
+        person_detail_url = notice_preview_json['_links']['self']['href']
+        images_url = notice_preview_json['_links']['images']['href']
+        detail_json, images_list = await asyncio.gather(
+            self.run_blocking(PersonDetail.get_detail, person_detail_url, self.client),
+            self.run_blocking(PersonDetail.get_images_list, images_url, self.client),
+            return_exceptions=True)
+
+        if isinstance(detail_json, Exception):
+            raise detail_json
+        if isinstance(images_list, requests.RequestException):
+            raise images_list   # Как и в `PersonDetail()`: Персона без списка фото не должна считаться сохраненной
+        if isinstance(images_list, Exception):
+            logger.warning(f'Images list `{images_url}` is not loaded: {images_list}')
+            images_list = []
+
+        return PersonDetail.from_data(person_detail_url=person_detail_url, images_url=images_url,
+                                      detail_json=detail_json, images_list=images_list, client=self.client)
+
+    async def load_person(self, notice_preview_json: dict):
+        """Загружает данные одной Персоны без фото."""
+        if self.settings.preview_only:
+            return await self.get_person_preview(notice_preview_json)
+        return await self.get_person_detail(notice_preview_json)
+
+    async def load_images(self, person, image_dir) -> int:
+        """
+        Скачивает все фото Персоны параллельно, потоком прямо на диск, и заполняет `person.images`.
+        :return: Количество фото, которые не удалось скачать.
+        """
+        person.images = {}
+        failed = 0
+        for file_path in await asyncio.gather(*(self.run_blocking(functools.partial(
+                self.client.download, image_link.url, image_dir, image_link.name, image_link.default_suffix,
+                file_name=image_link.file_name)) for image_link in person.image_links), return_exceptions=True):
+            if isinstance(file_path, Exception):
+                logger.error(f'Image is not saved: {file_path}')
+                failed += 1
+            else:
+                person.images[file_path.name] = file_path
+        return failed
+
+    async def crawl_person(self, page_id: str, nation: str, nation_name: str, gender: str, person_result_path: Path,
+                           notice_preview_json: dict) -> None:
+        """
+        Загружает одну Персону и сохраняет ее в формат вывода. Персона с несколькими гражданствами загружается
+        один раз: копии по другим гражданствам ждут первую загрузку, даже если она еще идет в другой задаче.
+        """
+        loop = asyncio.get_running_loop()
+        image_dir = self.output.get_image_dir(person_result_path)
+        key = f"{page_id}/{notice_preview_json['entity_id']}"
+        uses = get_dedup_uses(self.settings, notice_preview_json) if self.dedup else 0
+        future = None
+        if uses > 1:
+            future, owner = self.dedup.begin(key, uses=uses)
+            if not owner:
+                try:
+                    value = await asyncio.wrap_future(future)
+                except Exception as e:
+                    # Первая копия не загрузилась - эта копия загружает Персону сама, без индекса
+                    logger.warning(f'Person `{key}` is loaded again: {e}')
+                    future = None
+                else:
+                    person = restore_person(value, notice_preview_json, self.client)
+                    on_done, unchanged = get_on_done(self.state, self.delta, page_id, nation, nation_name, gender,
+                                                     image_dir, person)
+                    submit_thumbnail = defer_thumbnails(self.settings, self.thumbnails, page_id, nation,
+                                                        nation_name, person_result_path, person, unchanged)
+                    await loop.run_in_executor(self.executor, save_person_copy, self.output, page_id, nation,
+                                               nation_name, person_result_path, person, value['images'], on_done,
+                                               unchanged)
+                    if submit_thumbnail:
+                        submit_thumbnail()
+                    return
+
+        try:
+            person = await self.load_person(notice_preview_json)
+            # Персона отмечается в хранилище состояния и снимке только после того, как формат вывода запишет
+            # ее данные, и только если скачаны все ее фото. Иначе продолженный обход загрузит ее снова.
+            on_done, unchanged = get_on_done(self.state, self.delta, page_id, nation, nation_name, gender,
+                                             image_dir, person)
+            submit_thumbnail = defer_thumbnails(self.settings, self.thumbnails, page_id, nation, nation_name,
+                                                person_result_path, person, unchanged)
+            failed = await self.load_images(person, image_dir)
+        except BaseException as e:
+            if future:
+                self.dedup.fail(key, e)
+            if not isinstance(e, Exception):
+                raise   # Отмена задачи при прерывании обхода
+            # Персона не отмечается в состоянии, продолженный обход запросит ее снова
+            logger.error(f'Person `{key}` is not loaded: {e}')
+            return
+        if future:
+            finish_dedup(self.dedup, key, person, person.images, failed)
+
+        # Запись на диск не занимает слот семафора, т.к. не является сетевым запросом.
+        on_saved = functools.partial(on_done, person.images) if on_done and not failed else None
+        await loop.run_in_executor(self.executor, write_person, self.output, page_id, nation, nation_name,
+                                   person_result_path, person, on_saved, unchanged and not failed)
+        if submit_thumbnail:
+            submit_thumbnail()
+
+    async def crawl_query(self, page_id: str, page_object: NoticePage, nation: str, gender: str) -> None:
+        """
+        Обходит одну комбинацию фильтров (гражданство, пол). Загрузка каждой Персоны начинается, как только получен
+        лист выдачи с ней, параллельно с остальными поисковыми запросами.
+        """
+        seen = set()        # ID найденных Персон. Дубли выдачи сервера пропускаем
+        failed = self.client.scheduler.stats['failed'] if self.client.scheduler else 0
+        persons = set()     # Задачи загрузки Персон, которые еще выполняются или завершились ошибкой
+
+        def forget_done(task: asyncio.Task) -> None:
+            self.persons_pending -= 1
+            self.person_slots.release()
+            # Успешные задачи сразу забываем, а ошибку пробросит `gather` в конце
+            if task.cancelled() or task.exception() is None:
+                persons.discard(task)
+
+        age_ranges = self.planner.plan(page_id, nation, gender, self.settings.min_age, self.settings.max_age)
+        async for notice_id, notice_preview_json in self.iter_notices(page_id, nation, gender, age_ranges):
+            if notice_id in seen:
+                continue
+            seen.add(notice_id)
+            if self.state and self.state.is_person_done(page_id, nation, notice_id):
+                continue
+            if self.skip_known and is_known(self.delta, page_id, nation, notice_id):
+                continue
+            # Если загрузка отстает от поиска - ждем, пока завершится одна из задач, а не копим их без ограничения
+            await self.person_slots.acquire()
+            person = asyncio.ensure_future(self.crawl_person(
+                page_id, nation, page_object.nationalities[nation], gender,
+                Path(self.settings.result_dir, page_id, page_object.nationalities[nation], notice_id.replace('/', '-')),
+                notice_preview_json))
+            persons.add(person)
+            self.persons_pending += 1
+            person.add_done_callback(forget_done)
+        logger.info(f'Total notices in Result: {len(seen)}',
+                    extra={'page_id': page_id, 'nation': nation, 'gender': gender, 'notices': len(seen)})
+        await asyncio.gather(*persons)
+        if self.delta:
+            self.delta.mark_seen(page_id, nation, gender, seen, complete=not self.client.scheduler
+                                 or self.client.scheduler.stats['failed'] == failed)
+
+    async def crawl_page(self, page_id: str, page_url: str) -> None:
+        """Загружает поисковую страницу и параллельно обходит все комбинации ее фильтров (или только своего шарда)."""
+        page_object = await self.run_blocking(get_notice_page, self.settings, page_url, self.client)
+        logger.info(f'Page `{page_id}` get_status: {page_object.get_status()}')
+
+        await asyncio.gather(*(
+            self.crawl_query(page_id, page_object, nation, gender)
+            for nation, gender in get_queries(self.settings, page_object)
+            if not self.shard or in_shard(page_id, nation, gender, self.shard)))
+
+    async def crawl_queue(self) -> None:
+        """
+        Берет шарды из общей очереди по одному, как `crawl_queue()` из `main.py`. Запросы внутри шарда
+        выполняются параллельно.
+        """
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(self.executor, populate_queue, self.settings, self.client, self.queue)
+        while True:
+            shard = await loop.run_in_executor(self.executor, self.queue.claim, self.worker_id)
+            if shard is None:
+                break
+            page_id, nation, gender = shard['page_id'], shard['nation'], shard['gender']
+            if page_id not in pages:
+                pages[page_id] = await self.run_blocking(get_notice_page, self.settings,
+                                                         self.settings.search_pages_urls[page_id], self.client)
+            logger.info(f"Shard {shard['id']}: {page_id}/{nation}/{gender}", extra={'shard': shard['id']})
+            failed = self.client.scheduler.stats['failed'] if self.client.scheduler else 0
+            try:
+                with self.queue.keep_alive(shard['id'], self.worker_id):
+                    await self.crawl_query(page_id, pages[page_id], nation, gender)
+                    await loop.run_in_executor(self.executor, self.output.flush)
+            except BaseException:
+                self.queue.release(shard['id'], self.worker_id)
+                raise
+            if self.client.scheduler and self.client.scheduler.stats['failed'] > failed:
+                self.queue.release(shard['id'], self.worker_id)
+            else:
+                self.queue.complete(shard['id'], self.worker_id)
+
+    async def run(self) -> None:
+        """Обходит все поисковые страницы из настроек."""
+        self.semaphore = asyncio.Semaphore(self.settings.concurrency)
+        self.person_slots = asyncio.Semaphore(self.settings.concurrency * PERSONS_PER_REQUEST)
+        metrics.register_gauge('queue_depth', lambda: self.persons_pending, queue='persons')
+        try:
+            try:
+                if self.queue:
+                    await self.crawl_queue()
+                elif self.queries is not None:
+                    await asyncio.gather(*(self.crawl_query(page_id, page_object, nation, gender)
+                                           for page_id, page_object, nation, gender in self.queries))
+                else:
+                    await asyncio.gather(*(self.crawl_page(page_id, page_url)
+                                           for page_id, page_url in get_pages(self.settings).items()))
+                if self.thumbnails:
+                    # Превью уже записаны, дожидаемся миниатюр, которые качаются параллельно с поиском
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.thumbnails.flush)
+                if not self.part:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.output.flush)
+                    self.changelog = finish_delta(self.settings, self.delta, self.client, self.output)
+            finally:
+                self.executor.shutdown(wait=True)
+                if self.thumbnails:
+                    self.thumbnails.close()     # До закрытия формата вывода: скачанные миниатюры дописываются в него
+                # При прерывании (Ctrl-C) дописываем уже сохраненные Персоны, чтобы продолженный обход их не повторил
+                self.output.close()
+                if self.dedup and self.own_dedup:
+                    self.dedup.close()
+                if self.delta:
+                    self.delta.close()
+                metrics.unregister_gauge('queue_depth', queue='persons')
+                print_http_stats(self.client)
+                print_dedup_stats(self.dedup)
+                print_planner_stats(self.planner)
+
+            # Как и в `crawl()`: состояние очищается, только когда формат вывода закрыт и все Персоны в нем отмечены
+            self.planner.save()
+            if self.part:
+                logger.info(f'Часть результатов `{self.part}` записана. '
+                            f'Объедините результаты командой `python main.py --merge`')
+            else:
+                finish_state(self.state, self.client)
+        finally:
+            if self.state and self.own_state:
+                self.state.close()
+
+
+def crawl_async(settings: Settings, shard: tuple = None, queue: WorkQueue = None, worker_id: str = None, **kwargs):
+    """
+    Точка входа асинхронного обхода. Результат на диске совпадает с результатом синхронного `crawl()`.
+    :param settings: Объект настроек.
+    :param shard: Статический шард (номер шарда от `1`, количество шардов).
+    :param queue: Общая очередь шардов.
+    :param worker_id: Идентификатор процесса в очереди.
+    :param kwargs: Остальные параметры `AsyncCrawler`: `client`, `planner`, `queries`, `skip_known`, `state`, `dedup`.
+    :return: Список изменений дельта-синхронизации или `None`.
+    """
+    crawler = AsyncCrawler(settings, shard=shard, queue=queue, worker_id=worker_id, **kwargs)
+    asyncio.run(crawler.run())
+    return crawler.changelog
@@ -0,0 +1,193 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from file_manager import SETTINGS_DATA
+from mock_api import Dataset, MockApi
+
+MAIN_SCRIPT = Path(__file__).resolve().parent / 'main.py'
+# Хранилища между запусками отключены: каждый замер - холодный полный обход
+BENCHMARK_SETTINGS = {'page_meta': '', 'age_histograms': '', 'state_db': '', 'delta_db': '', 'dedup_db': '',
+                      'thumbnail_db': '', 'cache_dir': '', 'blob_dir': '', 'metrics_report': 'metrics.json',
+                      'metrics_prometheus': '', 'proxies': [], 'nations': [], 'genders': [], 'search_pages_id': [],
+                      'backoff_base': 0.1, 'backoff_max': 2}
+
+
+def get_case_id(case: dict) -> str:
+    """Ключ замера в отчете, по нему замеры сравниваются с эталоном."""
+    case_id = f"{case['size']}/c{case['concurrency']}/{case['output_backend']}"
+    return f'{case_id}/preview' if case['preview_only'] else case_id
+
+
+def run_main(work_dir: Path, timeout: float) -> tuple:
+    """
+    Запускает обход `main.py` отдельным процессом в папке замера.
+    :return: Кортеж (код завершения, время в секундах, пиковая память процесса в МБ или `None`, если ОС не сообщает).
+    """
+    started = time.monotonic()
+    with open(work_dir / 'crawl.log', 'wb') as log:
+        process = subprocess.Popen([sys.executable, str(MAIN_SCRIPT)], cwd=work_dir, stdout=log,
+                                   stderr=subprocess.STDOUT)
+        if not hasattr(os, 'wait4'):    # Windows: пиковую память дочернего процесса не узнать
+            return process.wait(timeout), time.monotonic() - started, None
+        deadline = started + timeout
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                process.kill()
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            time.sleep(0.05)
+    duration = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # `ru_maxrss` в Linux - в килобайтах, в macOS - в байтах
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return process.returncode, duration, round(peak_rss, 1)
+
+
+def get_counter(report: dict, name: str, **labels) -> int:
+    """Сумма значений счетчика из отчета `metrics.json` по всем сериям с заданными метками."""
+    return sum(series['value'] for series in report.get('counters', {}).get(name, [])
+               if all(series['labels'].get(key) == value for key, value in labels.items()))
+
+
+def run_case(case: dict, args) -> dict:
+    """Один замер: поднимает сервер с набором заданного размера, запускает обход и собирает результаты."""
+    dataset = Dataset(case['size'], nations=args.nations, seed=args.seed, image_size=args.image_size)
+    mock = MockApi(dataset, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                   rate_limit=args.server_rps, seed=args.seed).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='inter_parser_bench_') as temp_dir:
+            work_dir = Path(temp_dir)
+            settings = {**SETTINGS_DATA, **BENCHMARK_SETTINGS, **args.settings, **mock.get_settings(),
+                        'concurrency': case['concurrency'], 'preview_only': case['preview_only'],
+                        'output_backend': case['output_backend']}
+            (work_dir / 'settings.json').write_text(json.dumps(settings, indent=4), encoding='utf-8')
+            returncode, duration, peak_rss = run_main(work_dir, args.timeout)
+            metrics_path = work_dir / 'metrics.json'
+            report = json.loads(metrics_path.read_text(encoding='utf-8')) if metrics_path.exists() else {}
+            if returncode and not args.quiet:
+                print((work_dir / 'crawl.log').read_text(encoding='utf-8', errors='replace')[-2000:])
+    finally:
+        mock.stop()
+
+    server = mock.get_stats()
+    persons = get_counter(report, 'persons_total')
+    expected = dataset.count_expected()
+    return {'case': get_case_id(case), **case, 'returncode': returncode, 'wall_time': round(duration, 2),
+            'peak_rss_mb': peak_rss, 'requests': server['requests'], 'server_errors': server['errors'],
+            'throttled': server['throttled'], 'resources': server['resources'],
+            'megabytes': round(server['bytes'] / 1024 / 1024, 2),
+            'client_requests': get_counter(report, 'http_requests_total'),
+            'thumbnails': get_counter(report, 'thumbnails_total', result='saved'),
+            'persons': persons, 'expected_persons': expected, 'complete': persons == expected,
+            'persons_per_second': round(persons / duration, 1) if duration else 0,
+            'requests_per_second': round(server['requests'] / duration, 1) if duration else 0}
+
+
+def get_regressions(results: list, baseline: dict, tolerance: float) -> list:
+    """
+    Сравнивает замеры с эталонным отчетом.
+    - Время обхода и пиковая память хуже эталона больше чем на `tolerance` (доля) - регрессия.
+    - Больше запросов к серверу, чем в эталоне, - регрессия при любой разнице: набор детерминирован.
+    - Обход, не сохранивший всех Персон или завершившийся ошибкой, - регрессия независимо от эталона.
+    :return: Список строк с описанием регрессий.
+    """
+    previous = {result['case']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        case_id = result['case']
+        if result['returncode'] or not result['complete']:
+            regressions.append(f"{case_id}: exit code {result['returncode']}, "
+                               f"persons {result['persons']} of {result['expected_persons']}")
+        old = previous.get(case_id)
+        if old is None:
+            continue
+        for key in ('wall_time', 'peak_rss_mb'):
+            if result[key] and old.get(key) and result[key] > old[key] * (1 + tolerance):
+                regressions.append(f'{case_id}: {key} {old[key]} -> {result[key]}')
+        if result['requests'] > old['requests']:
+            regressions.append(f"{case_id}: requests {old['requests']} -> {result['requests']}")
+    return regressions
+
+
+def print_results(results: list) -> None:
+    print(f"{'case':<28}{'time, s':>9}{'requests':>10}{'req/s':>9}{'persons':>9}{'pers/s':>9}{'RSS, MB':>9}"
+          f"{'complete':>10}")
+    for result in results:
+        print(f"{result['case']:<28}{result['wall_time']:>9}{result['requests']:>10}"
+              f"{result['requests_per_second']:>9}{result['persons']:>9}{result['persons_per_second']:>9}"
+              f"{str(result['peak_rss_mb']):>9}{str(result['complete']):>10}")
+
+
+def parse_setting(value: str) -> tuple:
+    """Разбирает аргумент `--set` формата `ключ=json-значение`."""
+    key, separator, raw = value.partition('=')
+    if not separator or key not in SETTINGS_DATA:
+        raise argparse.ArgumentTypeError(f'Setting must be `key=value` with a known key, got `{value}`')
+    try:
+        return key, json.loads(raw)
+    except ValueError:
+        return key, raw     # Строку можно передавать без кавычек
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Замер скорости обхода на локальном сервере, повторяющем API Интерпола (`mock_api.py`).')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 2000],
+                        help='размеры наборов: Персон на каждый тип страницы')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[0, 16],
+                        help='значения `concurrency`: 0 - синхронный обход')
+    parser.add_argument('--backends', nargs='+', default=['tree'], choices=['tree', 'jsonl', 'sqlite'],
+                        help='значения `output_backend`')
+    parser.add_argument('--preview-only', action='store_true', help='замерить обход только превью')
+    parser.add_argument('--nations', type=int, default=8, help='количество гражданств в наборе')
+    parser.add_argument('--image-size', type=int, default=20 * 1024, help='размер фото в байтах')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.005, help='задержка ответа сервера в секундах')
+    parser.add_argument('--jitter', type=float, default=0.005, help='случайная добавка к задержке в секундах')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 503')
+    parser.add_argument('--server-rps', type=float, default=0, help='запросов в секунду до ответов 429')
+    parser.add_argument('--set', dest='settings', type=parse_setting, action='append', default=[],
+                        metavar='KEY=VALUE', help='переопределить настройку обхода, значение в формате json')
+    parser.add_argument('--timeout', type=float, default=1800, help='предельное время одного обхода в секундах')
+    parser.add_argument('--report', default='benchmark.json', help='куда сохранить отчет')
+    parser.add_argument('--baseline', help='эталонный отчет для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='допустимое ухудшение времени и памяти относительно эталона (доля)')
+    parser.add_argument('--quiet', action='store_true', help='не выводить лог неудачного обхода')
+    args = parser.parse_args()
+    args.settings = dict(args.settings)
+
+    results = []
+    for size in args.sizes:
+        for backend in args.backends:
+            for concurrency in args.concurrency:
+                case = {'size': size, 'concurrency': concurrency, 'output_backend': backend,
+                        'preview_only': args.preview_only}
+                print(f'Замер {get_case_id(case)}...', flush=True)
+                results.append(run_case(case, args))
+    print_results(results)
+
+    report = {'created_at': int(time.time()), 'python': sys.version.split()[0], 'platform': sys.platform,
+              'mock': {'nations': args.nations, 'image_size': args.image_size, 'seed': args.seed,
+                       'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                       'server_rps': args.server_rps},
+              'settings': args.settings, 'results': results}
+    Path(args.report).write_text(json.dumps(report, indent=4, ensure_ascii=False), encoding='utf-8')
+    print(f'Отчет сохранен: `{args.report}`')
+
+    baseline = json.loads(Path(args.baseline).read_text(encoding='utf-8')) if args.baseline else {}
+    regressions = get_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'Регрессия: {regression}')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from file_manager import link_file
+
+
+class BlobStore:
+    """
+    Хранилище фото с адресацией по содержимому. Каждое уникальное фото хранится один раз в файле, имя которого -
+    sha256 его байтов, а в папке Персоны появляется жесткая ссылка на этот файл (или копия, если файловая система
+    не поддерживает ссылки). В индексе SQLite для каждого адреса фото запоминается хэш и расширение, поэтому фото,
+    уже сохраненное в прошлых запусках или у другой Персоны, повторно не скачивается.
+    """
+
+    def __init__(self, blob_dir):
+        """
+        :param blob_dir: Папка хранилища в формате строки или `Path`. Должна быть на том же диске, что и папка
+        результатов, иначе вместо жестких ссылок будут создаваться копии.
+        """
+        self.path = Path(blob_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # files - сохранено фото в папки Персон, blobs - записано новых уникальных фото,
+        # duplicates - скачанное фото уже было в хранилище, skipped - фото не скачивалось, т.к. адрес уже известен
+        self.stats = {'files': 0, 'blobs': 0, 'duplicates': 0, 'skipped': 0, 'bytes_saved': 0}
+
+        self.connection = sqlite3.connect(str(Path(self.path, 'index.sqlite')), timeout=60,
+                                          check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT, suffix TEXT)')
+
+    def get_blob_path(self, digest: str) -> Path:
+        """Фото раскладываются по подпапкам из первых двух символов хэша, чтобы не держать все файлы в одной папке."""
+        return Path(self.path, digest[:2], digest)
+
+    def get_temp_path(self, name: str) -> Path:
+        """Временный файл для загрузки. Лежит в папке хранилища, чтобы перенос в хранилище был атомарным."""
+        return Path(self.path, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    def lookup(self, url: str):
+        """
+        Ищем фото, уже скачанное по этому адресу.
+        :return: Кортеж (хэш, расширение) или `None`, если адрес неизвестен или файл пропал с диска.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT hash, suffix FROM urls WHERE url=?', (url,)).fetchone()
+        if row is None or not self.get_blob_path(row[0]).exists():
+            return None
+        return row
+
+    def link(self, digest: str, file_path: Path = None) -> Path:
+        """
+        Создаем в папке Персоны ссылку на фото из хранилища.
+        :param digest: Хэш фото.
+        :param file_path: Итоговый путь к фото в папке Персоны. Если `None` - фото остается только в хранилище.
+        :return: `file_path` или путь к фото в хранилище.
+        """
+        blob_path = self.get_blob_path(digest)
+        with self.lock:
+            self.stats['files'] += 1
+        if file_path is None:
+            return blob_path
+        return link_file(blob_path, file_path)
+
+    def link_known(self, url: str, file_path, digest: str) -> Path:
+        """Сохраняем фото, которое не скачивалось, т.к. его адрес уже есть в индексе."""
+        size = self.get_blob_path(digest).stat().st_size
+        with self.lock:
+            self.stats['skipped'] += 1
+            self.stats['bytes_saved'] += size
+        return self.link(digest, file_path)
+
+    def add(self, url: str, temp_path: Path, digest: str, suffix: str, file_path) -> Path:
+        """
+        Переносим скачанное фото в хранилище и создаем ссылку на него в папке Персоны.
+        Если фото с таким содержимым уже есть - временный файл удаляется.
+        :param url: Адрес фото.
+        :param temp_path: Временный файл с телом ответа из `get_temp_path()`.
+        :param digest: sha256 тела ответа, посчитанный при загрузке.
+        :param suffix: Расширение фото без точки.
+        :param file_path: Итоговый путь к фото в папке Персоны. Если `None` - фото остается только в хранилище.
+        :return: `file_path` или путь к фото в хранилище.
+        """
+        blob_path = self.get_blob_path(digest)
+        size = temp_path.stat().st_size
+        with self.lock, self.connection:
+            known = self.connection.execute('SELECT 1 FROM blobs WHERE hash=?', (digest,)).fetchone()
+            if known and blob_path.exists():
+                temp_path.unlink()
+                self.stats['duplicates'] += 1
+                self.stats['bytes_saved'] += size
+            else:
+                blob_path.parent.mkdir(exist_ok=True)
+                os.replace(temp_path, blob_path)
+                self.connection.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?)', (digest, size))
+                self.stats['blobs'] += 1
+            self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (url, digest, suffix))
+        return self.link(digest, file_path)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
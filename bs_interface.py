@@ -1,7 +1,41 @@
 # -*- coding: UTF-8 -*-
 
+import json
+import time
+import logging
 import requests
-from bs4 import BeautifulSoup
+from collections import namedtuple
+from pathlib import Path
+from bs4 import BeautifulSoup, SoupStrainer
+
+from file_manager import save_file
+from http_client import HttpClient, get_client
+from instrumentation import metrics
+
+try:
+    import lxml     # Необязательная зависимость: с ней поисковая страница разбирается заметно быстрее
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+# Ссылка на картинку Персоны: имя файла без расширения, адрес и расширение на случай, если сервер не вернул
+# `content-type` (`None` - такую картинку не сохраняем). `file_name` - имя файла, под которым картинка сохранена
+# в прошлом обходе (дельта-синхронизация): если файл на месте, картинка не скачивается заново.
+ImageLink = namedtuple('ImageLink', ['name', 'url', 'default_suffix', 'file_name'], defaults=[None])
+
+logger = logging.getLogger(__name__)
+
+
+def is_filter_tag(name: str, attrs: dict) -> bool:
+    """
+    Теги поисковой страницы, из которых берутся фильтры. Остальной документ при разборе пропускается.
+    :param name: Имя тега.
+    :param attrs: Атрибуты тега.
+    """
+    return ((name == 'select' and attrs.get('id') == 'nationality') or
+            (name == 'input' and attrs.get('name') == 'sexId') or
+            (name == 'label' and 'for' in attrs) or
+            (name == 'strong' and attrs.get('id') == 'totalResults'))
 
 
 class NoticePage:
@@ -14,34 +48,86 @@ class NoticePage:
     genders = {}
     request_page = None
     parser_page = None
+    status = 0
     total = 0
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, client: HttpClient = None, meta_path=None, meta_ttl: float = 0):
         """
         При инициализации получаем адрес целевой страницы, с которой необходимо работать в дальнейшем.
         :param url: Строка адреса поисковой страницы
+        :param client: Общий HTTP-клиент. Если не передан - используется клиент по-умолчанию.
+        :param meta_path: Путь к json-файлу с фильтрами поисковых страниц. Если фильтры этой страницы в нем свежее
+        `meta_ttl` секунд - страница не запрашивается. Если не задан - фильтры не сохраняются между запусками.
+        :param meta_ttl: Время жизни сохраненных фильтров в секундах.
         """
         self.url = url
-        self.request_page = requests.get(self.url)
+        self.meta_path = Path(meta_path) if meta_path else None
+        self.meta_ttl = meta_ttl
+        # Словари заполняются для каждого объекта отдельно, словари класса остаются пустыми
+        self.nationalities = {}
+        self.genders = {}
+        if self.load_meta():
+            return
+
+        self.request_page = get_client(client).get(self.url, resource='page')
+        self.status = self.request_page.status_code
 
         if self.request_page.status_code == 200:
-            # Если страница недоступна, то не требуется ничего с ней делать
-            self.parser_page = BeautifulSoup(self.request_page.text, 'html.parser')
-            self.nationalities = self.get_nationalities(page=self.parser_page)
-            self.genders = self.get_genders(page=self.parser_page)
-            self.total = self.get_total(page=self.parser_page)
+            # Если страница недоступна, то не требуется ничего с ней делать.
+            # Разбираем только теги фильтров, а не весь документ
+            with metrics.timer('parse_seconds', stage='page'):
+                self.parser_page = BeautifulSoup(self.request_page.text, HTML_PARSER,
+                                                 parse_only=SoupStrainer(is_filter_tag))
+                self.nationalities = self.get_nationalities(page=self.parser_page)
+                self.genders = self.get_genders(page=self.parser_page)
+                self.total = self.get_total(page=self.parser_page)
+            self.save_meta()
 
     def __call__(self):
-        if self.parser_page:
+        if self.status == 200:
 
             return len(self.nationalities)
 
         else:
             return
 
+    def read_meta(self) -> dict:
+        """Фильтры всех поисковых страниц из файла: {адрес страницы: {...}}."""
+        if not self.meta_path or not self.meta_path.exists():
+            return {}
+        try:
+            with self.meta_path.open(encoding='utf-8') as fp:
+                return json.load(fp)
+        except ValueError as e:
+            logger.warning(e)   # Битый файл просто перезапишется свежими данными
+            return {}
+
+    def load_meta(self) -> bool:
+        """
+        Загружаем фильтры страницы из файла, если они свежее `meta_ttl`.
+        :return: `True`, если фильтры загружены и страницу запрашивать не нужно.
+        """
+        meta = self.read_meta().get(self.url)
+        if not meta or time.time() - meta['saved_at'] > self.meta_ttl:
+            return False
+        self.nationalities = meta['nationalities']
+        self.genders = meta['genders']
+        self.total = meta['total']
+        self.status = 200
+        return True
+
+    def save_meta(self) -> None:
+        """Сохраняем фильтры страницы. Файл перечитывается, т.к. его могли обновить другие процессы."""
+        if not self.meta_path or not self.meta_ttl:
+            return
+        meta = self.read_meta()
+        meta[self.url] = {'saved_at': int(time.time()), 'nationalities': self.nationalities, 'genders': self.genders,
+                          'total': self.total}
+        save_file(file_path=self.meta_path, file_data=meta)
+
     def get_status(self) -> int:
-        """Возвращаем статус запроса страницы"""
-        return int(self.request_page.status_code)
+        """Возвращаем статус запроса страницы. Для фильтров из файла - `200`."""
+        return int(self.status)
 
     def get_nationalities(self, page: BeautifulSoup) -> dict:
         """
@@ -54,10 +140,11 @@ class NoticePage:
 
         # TODO - переписать с использованием фильтрующей функции `select.find_all(filter_func)`
         # TODO - переписать с использованием словарного включения. P.S. или оставить как есть =)
+        nationalities = {}
         for option in select.find_all('option'):
             if option.attrs:  # Первый элемент пустой, поэтому его пропускаем. Нужен лишь список ID стран
-                self.nationalities[option.attrs['value']] = option.string
-        return self.nationalities
+                nationalities[option.attrs['value']] = option.string
+        return nationalities
 
     def get_genders(self, page: BeautifulSoup) -> dict:
         """
@@ -67,10 +154,11 @@ class NoticePage:
         """
         radios = page.find_all('input', attrs={'type': 'radio', 'name': 'sexId'})
 
+        genders = {}
         for radio in radios:
             if radio.attrs['value']:  # Первая кнопка `All` имеет пустое значение атрибута `value`, его пропускаем
-                self.genders[radio.attrs['value']] = page.find('label', attrs={'for': radio.attrs['id']}).string
-        return self.genders
+                genders[radio.attrs['value']] = page.find('label', attrs={'for': radio.attrs['id']}).string
+        return genders
 
     def get_total(self, page: BeautifulSoup) -> int:
         """
@@ -86,25 +174,24 @@ class NoticePage:
 class PersonPreview:
     """
     preview_json = {}
-    images = {}
+    image_links = []        # Список `ImageLink` миниатюры. Сама картинка скачивается потоком при сохранении Персоны.
+    images = {}             # Заполняется при сохранении: {`имя_файла`: путь к сохраненному файлу}
     """
 
-    def __init__(self, person_preview_data: dict):
+    def __init__(self, person_preview_data: dict, client: HttpClient = None):
         self.preview_json = person_preview_data
+        self.client = client
+        self.images = {}
         try:
-            self.images = self.get_thumbnail(person_preview_data['_links']['thumbnail']['href'])
+            self.image_links = [ImageLink(name='thumbnail', url=person_preview_data['_links']['thumbnail']['href'],
+                                          default_suffix=None)]
         except Exception as e:
-            print(e)
-            self.images = {}
+            logger.warning(f"Preview `{person_preview_data.get('entity_id')}` has no thumbnail: {e}")
+            self.image_links = []
 
     def __call__(self):
         return self.preview_json, self.images
 
-    def get_thumbnail(self, images_url: str):
-        response = requests.get(images_url)
-        suffix = response.headers['content-type'].split('/')[-1]
-        return {f'thumbnail.{suffix}': response.content}
-
 
 class PersonDetail:
     # TODO - наследовать от `PersonPreview` (если  это имеет смысл).
@@ -113,10 +200,13 @@ class PersonDetail:
     detail_url = ''         # Ссылка на подробную страницу Персоны
     images_url = ''         # Запрос на получение ссылок всех фото Персоны
     detail_json = {}        # json (словарь) с подробными данными Персоны
-    images = {}             # Словарь {`picture_id`: `image_raw_data`}, в котором хранятся все фото (без миниатюры).
+    images_list = []        # Описания всех фото из ответа сервера (результат `get_images_list`)
+    image_links = []        # Список `ImageLink` всех фото (без миниатюры). Фото не хранятся в памяти,
+                            # а скачиваются потоком прямо в папку Персоны при ее сохранении.
+    images = {}             # Заполняется при сохранении: {`picture_id.suffix`: путь к сохраненному файлу}
     """
 
-    def __init__(self, person_detail_url: str, images_url: str):
+    def __init__(self, person_detail_url: str, images_url: str, client: HttpClient = None):
         # TODO - по аналогии с `PersonPreview` можно принимать лишь превью данных, и добывать ссылку на фото уже здесь.
         """
         - При инициализации или вызове можно добавить флаги `json_data = False, img = False`. Это упрощает код,
@@ -126,30 +216,82 @@ class PersonDetail:
         поэтому просто обнуляем словарь `images`, вместо вызова функции `__new__(cls):`.
         :param person_detail_url: Ссылка на детальную страницу Персоны.
         :param images_url: Ссылка на запрос фотографий Персоны.
+        :param client: Общий HTTP-клиент. Если не передан - используется клиент по-умолчанию.
         """
         self.images = {}
+        self.client = client
         self.detail_url = person_detail_url
         self.images_url = images_url
         # TODO - перехватить все статусы реквестов кроме 200-го. Вероятно проще написать универсальный класс обработки
-        self.detail_json = requests.get(person_detail_url).json()
+        self.detail_json = self.get_detail(person_detail_url, client=client)
         self.person_id = self.detail_json['entity_id'].replace('/', '-')    # Заменяем `/` на `-` для корректного пути
 
-        # Получаем список ID и фотографии персоны
-        images_json = requests.get(images_url).json()
-
+        # Получаем список ID и ссылок на фотографии персоны
         try:
             # TODO - сделать проверку на пустой ответ или коды ошибок
-            for item in images_json['_embedded']['images']:
-                response = requests.get(item['_links']['self']['href'])
-                try:
-                    suffix = response.headers['content-type'].split('/')[-1]    # Получаем расширение файла
-                except Exception:
-                    suffix = '.jpg'
-
-                self.images[f"{item['picture_id']}.{suffix}"] = response.content    # Сохраняем картинку с именем
+            self.images_list = self.get_images_list(images_url, client=client)
+            self.image_links = self.get_image_links(self.images_list)
+        except requests.RequestException:
+            raise   # Сетевую ошибку не скрываем, иначе Персона будет сохранена без фото и отмечена выполненной
         except Exception as e:
-            print(e)
+            logger.warning(f'Images list `{images_url}` is not loaded: {e}')
+            self.images_list = []
+            self.image_links = []
 
     def __call__(self):
         # При вызове можно сразу же и сохранять файлы, либо прописать это отдельным методом. Либо оставить как есть =)
         return self.detail_json, self.images
+
+    @classmethod
+    def from_data(cls, person_detail_url: str, images_url: str, detail_json: dict, images_list: list,
+                  client: HttpClient = None):
+        """
+        Создает Персону из уже загруженных данных без обращения к сети. Используется асинхронным обходом,
+        который запрашивает детальные данные и список фото параллельно, и для Персон из `DedupIndex`.
+        :param person_detail_url: Ссылка на детальную страницу Персоны.
+        :param images_url: Ссылка на запрос фотографий Персоны.
+        :param detail_json: Словарь с подробными данными Персоны.
+        :param images_list: Результат `get_images_list`.
+        :param client: Общий HTTP-клиент.
+        """
+        person = cls.__new__(cls)
+        person.client = client
+        person.detail_url = person_detail_url
+        person.images_url = images_url
+        person.detail_json = detail_json
+        person.person_id = detail_json['entity_id'].replace('/', '-')
+        person.images_list = images_list
+        person.image_links = cls.get_image_links(images_list)
+        person.images = {}
+        return person
+
+    @staticmethod
+    def get_detail(person_detail_url: str, client: HttpClient = None) -> dict:
+        """Получаем словарь с подробными данными Персоны"""
+        response = get_client(client).get(person_detail_url, resource='detail')
+        response.raise_for_status()     # Повторы уже исчерпаны клиентом - дальше обрабатывает вызывающий код
+        with metrics.timer('parse_seconds', stage='detail'):
+            return response.json()
+
+    @staticmethod
+    def get_images_list(images_url: str, client: HttpClient = None) -> list:
+        """
+        Получаем список описаний всех фото Персоны.
+        :param images_url: Ссылка на запрос фотографий Персоны.
+        :param client: Общий HTTP-клиент.
+        :return: Список словарей, каждый из которых содержит `picture_id` и ссылку на само изображение.
+        """
+        response = get_client(client).get(images_url, resource='images')
+        response.raise_for_status()
+        with metrics.timer('parse_seconds', stage='images'):
+            return response.json()['_embedded']['images']
+
+    @staticmethod
+    def get_image_links(images_list: list) -> list:
+        """
+        Превращаем список описаний фото в ссылки для загрузки.
+        :param images_list: Результат `get_images_list`.
+        :return: Список `ImageLink`. Фото сохраняется с именем `picture_id` и расширением из `content-type`.
+        """
+        return [ImageLink(name=item['picture_id'], url=item['_links']['self']['href'], default_suffix='jpg')
+                for item in images_list]
@@ -0,0 +1,292 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from age_planner import AgePlanner
+from file_manager import Settings
+from instrumentation import metrics, write_text
+from main import create_client, create_dedup, get_pages, get_notice_page, get_queries, open_state_store, run_crawl
+
+logger = logging.getLogger(__name__)
+
+STATUS_INTERVAL = 5     # Раз в сколько секунд обновлять файл состояния во время цикла
+IDLE_INTERVAL = 60      # Раз в сколько секунд между циклами сверяться с часами: полный цикл идет по времени суток
+CHANGES_DECAY = 0.5     # Во сколько раз за цикл уменьшается вес прошлых изменений комбинации при выборе порядка обхода
+TOP_PRIORITIES = 10     # Сколько первых комбинаций очереди показывать в файле состояния
+
+
+class Daemon:
+    """
+    Режим службы (`python main.py --daemon`): процесс работает постоянно и сам запускает циклы синхронизации
+    по расписанию, вместо запуска обхода по cron.
+    - Между циклами остаются открытыми HTTP-клиент с keep-alive соединениями, хранилище состояния и индекс дублей,
+    а в памяти - фильтры поисковых страниц и гистограммы возрастов. Снимок дельта-синхронизации хранится на диске.
+    Перед каждым циклом сбрасываются только счетчики и записи прошлого цикла.
+    - Поисковый цикл (`search`) раз в `daemon_search_interval` секунд запрашивает выдачу всех комбинаций фильтров,
+    загружает только новых Персон и отмечает удаленными пропавших из выдачи.
+    - Полный цикл (`full`) раз в сутки, в `daemon_full_at`, загружает всех Персон и находит изменения их данных.
+    - Комбинации фильтров обходятся по приоритету: сначала те, где недавно были изменения, затем упирающиеся
+    в лимит выдачи (больше листьев в гистограмме).
+    - Прогресс текущего цикла, расписание и итоги последних циклов пишутся в json-файл `daemon_status`.
+    """
+
+    def __init__(self, settings: Settings, max_cycles: int = 0):
+        """
+        :param settings: Объект настроек.
+        :param max_cycles: Завершить службу после этого количества циклов. Если `0` - работает до остановки.
+        """
+        if not settings.delta_db:
+            raise ValueError('Daemon mode requires `delta_db`: search cycles load only persons missing from it')
+        if not settings.daemon_search_interval and not settings.daemon_full_at:
+            raise ValueError('Daemon mode requires `daemon_search_interval` or `daemon_full_at`')
+        self.full_at = self.parse_time(settings.daemon_full_at) if settings.daemon_full_at else None
+        if settings.cache_dir and settings.cache_ttl.get('search', 0) >= settings.daemon_search_interval > 0:
+            logger.warning('`cache_ttl.search` is not less than `daemon_search_interval`: '
+                           'search cycles will get cached results')
+        self.settings = settings
+        self.max_cycles = max_cycles
+        self.client = create_client(settings, pool_size=max(settings.pool_size, settings.concurrency))
+        self.planner = AgePlanner(histograms_path=settings.age_histograms, limit=settings.notices_limit)
+        self.state = open_state_store(settings)     # `None`, если параметр `state_db` пуст
+        self.dedup = create_dedup(settings)         # `None`, если параметр `dedup` выключен
+        self.pages = {}         # Поисковые страницы: {тип страницы: (время загрузки, объект `NoticePage`)}
+        self.changes = {}       # Затухающее число изменений: {(тип страницы, гражданство): вес}
+        self.priorities = []    # Начало очереди комбинаций последнего цикла
+        self.cycle = None       # Текущий цикл: {'kind', 'number', 'started_at', 'queries'}
+        self.number = 0
+        self.started_at = int(time.time())
+        self.status_path = Path(settings.daemon_status) if settings.daemon_status else None
+        self.status_lock = threading.Lock()
+        # Итоги последних циклов переживают перезапуск службы, иначе после каждого перезапуска шел бы полный цикл
+        self.cycles = self.read_status().get('cycles', {})
+        self.last_started = {'search': self.cycles.get('search', {}).get('started_at', 0),
+                             'full': self.cycles.get('full', {}).get('started_at', self.started_at)}
+
+    @staticmethod
+    def parse_time(value: str) -> tuple:
+        """Разбирает время суток формата `ЧЧ:ММ` в кортеж (часы, минуты)."""
+        try:
+            hours, minutes = (int(part) for part in value.split(':'))
+        except ValueError:
+            raise ValueError(f'`daemon_full_at` must be `HH:MM`, got `{value}`')
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            raise ValueError(f'`daemon_full_at` must be `HH:MM`, got `{value}`')
+        return hours, minutes
+
+    def read_status(self) -> dict:
+        """Файл состояния прошлого запуска службы или пустой словарь."""
+        if not self.status_path or not self.status_path.exists():
+            return {}
+        try:
+            return json.loads(self.status_path.read_text(encoding='utf-8'))
+        except ValueError as e:
+            logger.warning(e)   # Битый файл просто перезапишется
+            return {}
+
+    def get_schedule(self, now: float) -> dict:
+        """
+        Время следующего запуска каждого вида цикла. Пропущенный запуск (служба была остановлена или предыдущий
+        цикл затянулся) наступает сразу, но только один раз.
+        :return: Словарь {вид цикла: время в секундах эпохи}. Отключенные виды не входят.
+        """
+        schedule = {}
+        if self.full_at:
+            slot = datetime.fromtimestamp(now).replace(hour=self.full_at[0], minute=self.full_at[1], second=0,
+                                                       microsecond=0)
+            if slot.timestamp() > now:
+                slot -= timedelta(days=1)   # Последнее наступившее время полного цикла
+            if self.last_started['full'] >= slot.timestamp():
+                slot += timedelta(days=1)
+            schedule['full'] = slot.timestamp()
+        if self.settings.daemon_search_interval:
+            schedule['search'] = self.last_started['search'] + self.settings.daemon_search_interval
+        return schedule
+
+    def get_next_cycle(self, now: float) -> tuple:
+        """
+        :return: Кортеж (вид ближайшего цикла, время его запуска). Если наступили оба - полный, т.к. он заменяет
+        поисковый.
+        """
+        schedule = self.get_schedule(now)
+        kind = min(schedule, key=lambda kind: (max(schedule[kind], now), kind != 'full'))
+        return kind, schedule[kind]
+
+    def get_pages(self) -> dict:
+        """
+        Поисковые страницы с фильтрами. Объекты страниц хранятся в памяти между циклами и обновляются раз
+        в `page_meta_ttl` секунд. Если страница недоступна - используется прежний объект.
+        :return: Словарь: Ключ - тип страницы, Значение - объект `NoticePage`.
+        """
+        pages = {}
+        for page_id, page_url in get_pages(self.settings).items():
+            loaded_at, page_object = self.pages.get(page_id, (0, None))
+            if not page_object or time.time() - loaded_at >= self.settings.page_meta_ttl:
+                fresh = get_notice_page(self.settings, page_url, self.client)
+                logger.info(f'Page `{page_id}` get_status: {fresh.get_status()}')
+                if fresh.get_status() == 200:
+                    self.pages[page_id] = time.time(), fresh
+                    page_object = fresh
+                elif not page_object:
+                    page_object = fresh     # Без фильтров комбинаций не будет, страница запросится в следующем цикле
+            pages[page_id] = page_object
+        return pages
+
+    def get_queries(self) -> list:
+        """
+        Комбинации фильтров всех поисковых страниц в порядке обхода. Первыми идут комбинации с недавними
+        изменениями, затем - упиравшиеся в лимит выдачи: их обход дольше всего, и начинать его лучше раньше.
+        :return: Список кортежей (тип страницы, объект `NoticePage`, гражданство, пол), как для `crawl()`.
+        """
+        queries = [(page_id, page_object, nation, gender)
+                   for page_id, page_object in self.get_pages().items()
+                   for nation, gender in get_queries(self.settings, page_object)]
+
+        def get_priority(query: tuple) -> tuple:
+            page_id, _, nation, gender = query
+            leaves = self.planner.histograms.get(AgePlanner.get_key(page_id, nation, gender), [])
+            return -self.changes.get((page_id, nation), 0), -len(leaves)
+
+        queries.sort(key=get_priority)     # Сортировка устойчива: без приоритета сохраняется порядок страниц
+        self.priorities = []
+        for query in queries[:TOP_PRIORITIES]:
+            changes, leaves = get_priority(query)
+            self.priorities.append({'page_id': query[0], 'nation': query[2], 'gender': query[3],
+                                    'changes': round(-changes, 2), 'leaves': -leaves})
+        return queries
+
+    def update_changes(self, changelog: dict) -> None:
+        """Учитывает изменения цикла в приоритетах комбинаций. Вес прошлых изменений затухает."""
+        self.changes = {key: weight * CHANGES_DECAY for key, weight in self.changes.items()
+                        if weight * CHANGES_DECAY >= 0.01}
+        for change in ('added', 'updated', 'removed'):
+            for person in changelog[change]:
+                key = person['page_id'], person['nation']
+                self.changes[key] = self.changes.get(key, 0) + 1
+
+    def get_progress(self):
+        """Прогресс текущего цикла или `None` между циклами."""
+        if not self.cycle:
+            return None
+        return {**self.cycle, 'elapsed': round(time.time() - self.cycle['started_at'], 1),
+                'queries_started': len(self.planner.roots),
+                'persons': int(metrics.get_total('persons_total')),
+                'requests': int(metrics.get_total('http_requests_total'))}
+
+    def write_status(self, state: str) -> None:
+        """
+        Атомарно перезаписывает файл состояния службы.
+        :param state: `running`, `idle` или `stopped`.
+        """
+        if not self.status_path:
+            return
+        status = {'pid': os.getpid(), 'started_at': self.started_at, 'updated_at': int(time.time()), 'state': state,
+                  'cycle': self.get_progress(),
+                  'next': {kind: int(at) for kind, at in self.get_schedule(time.time()).items()},
+                  'cycles': self.cycles, 'priorities': self.priorities}
+        with self.status_lock:
+            write_text(self.status_path, json.dumps(status, indent=4, ensure_ascii=False))
+
+    def report_progress(self, stop_event: threading.Event) -> None:
+        """Поток, обновляющий файл состояния во время цикла."""
+        while not stop_event.wait(STATUS_INTERVAL):
+            try:
+                self.write_status('running')
+            except OSError as e:
+                logger.warning(f'Daemon status is not saved: {e}')
+
+    def run_cycle(self, kind: str) -> None:
+        """
+        Один цикл синхронизации на общих для всех циклов клиенте, планировщике, хранилище состояния и индексе
+        дублей. Ошибка цикла не останавливает
+        службу: она записывается в итоги, а следующий цикл начнется по расписанию.
+        :param kind: `search` - загружаются только новые Персоны, `full` - все.
+        """
+        self.number += 1
+        started = time.time()
+        self.last_started[kind] = started
+        if kind == 'full':
+            self.last_started['search'] = started   # Полный цикл заменяет и очередной поисковый
+        # Неудачные запросы прошлого цикла не должны помешать завершить этот
+        self.client.scheduler.reset_stats()
+        self.planner.start_run()
+        if self.dedup:
+            self.dedup.reset()      # Данные Персон могли измениться с прошлого цикла
+        self.cycle = {'kind': kind, 'number': self.number, 'started_at': int(started), 'queries': 0}
+        logger.info(f'Цикл {self.number} `{kind}` начат')
+        stop_event = threading.Event()
+        reporter = threading.Thread(target=self.report_progress, args=(stop_event,), daemon=True)
+        reporter.start()
+        changelog, error = None, None
+        try:
+            queries = self.get_queries()
+            self.cycle['queries'] = len(queries)
+            self.write_status('running')
+            changelog = run_crawl(self.settings, client=self.client, planner=self.planner, queries=queries,
+                                  skip_known=kind == 'search', state=self.state, dedup=self.dedup)
+        except Exception as e:
+            logger.exception(f'Цикл {self.number} `{kind}` завершился ошибкой')
+            error = str(e)
+        finally:
+            stop_event.set()
+            reporter.join()
+        finished = time.time()
+        summary = {'number': self.number, 'started_at': int(started), 'finished_at': int(finished),
+                   'duration': round(finished - started, 1), 'queries': self.cycle['queries'],
+                   'persons': int(metrics.get_total('persons_total')),
+                   'persons_saved': int(metrics.get_total('persons_total', result='saved')),
+                   'requests': int(metrics.get_total('http_requests_total')),
+                   'failed_requests': self.client.scheduler.stats['failed'],
+                   # Если часть запросов не удалась, список изменений дополнит следующий цикл
+                   **({change: len(changelog[change]) for change in ('added', 'updated', 'removed')}
+                      if changelog else {'added': None, 'updated': None, 'removed': None})}
+        if error:
+            summary['error'] = error
+        self.cycles[kind] = summary
+        self.cycle = None
+        if changelog:
+            self.update_changes(changelog)
+        logger.info(f"Цикл {self.number} `{kind}` завершен за {summary['duration']} с: "
+                    f"Персон {summary['persons']}, запросов {summary['requests']}")
+
+    def run(self) -> None:
+        """Выполняет циклы по расписанию до остановки (Ctrl-C, SIGTERM) или до `max_cycles` циклов."""
+        def stop(signum, frame):
+            raise KeyboardInterrupt     # SIGTERM останавливает службу так же, как Ctrl-C: очереди дописываются
+
+        signal.signal(signal.SIGTERM, stop)
+        logged = None
+        try:
+            while not self.max_cycles or self.number < self.max_cycles:
+                now = time.time()
+                kind, due = self.get_next_cycle(now)
+                if due > now:
+                    if logged != (kind, due):
+                        logged = kind, due
+                        self.write_status('idle')
+                        logger.info(f"Следующий цикл `{kind}`: "
+                                    f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(due))}")
+                    time.sleep(min(due - now, IDLE_INTERVAL))
+                    continue
+                self.run_cycle(kind)
+        except KeyboardInterrupt:
+            logger.info('Служба остановлена')
+        finally:
+            self.cycle = None
+            self.write_status('stopped')
+            self.client.close()
+            if self.state:
+                self.state.close()
+            if self.dedup:
+                self.dedup.close()
+
+
+def run_daemon(settings: Settings, max_cycles: int = 0) -> None:
+    """Точка входа режима службы."""
+    Daemon(settings, max_cycles=max_cycles).run()
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import sqlite3
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+
+class DedupIndex:
+    """
+    Индекс Персон, уже загруженных в этом запуске. Персона с несколькими гражданствами находится поиском по каждому
+    из них, и без индекса ее детальные данные, список фото и сами фото загружались бы по разу на каждое гражданство.
+    Первое обращение к Персоне загружает ее (`begin` возвращает `owner=True`), остальные получают тот же результат,
+    в том числе если загрузка еще идет в другом потоке или задаче. Хранятся только Персоны, которые еще встретятся:
+    запись удаляется после `uses` обращений. Завершенные записи могут храниться в SQLite, а не в памяти.
+    """
+
+    def __init__(self, db_path=None):
+        """
+        :param db_path: Путь к базе для завершенных записей. Если не задан - записи хранятся в памяти.
+        База очищается при открытии, т.к. индекс относится к одному запуску.
+        """
+        self.lock = threading.Lock()
+        self.records = {}       # {ключ: {'future': Future, 'uses': осталось обращений}}
+        self.stats = {'fetched': 0, 'avoided': 0}
+        self.connection = None
+        if db_path:
+            path = Path(db_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(path), check_same_thread=False)
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, '
+                                        'uses INTEGER)')
+                self.connection.execute('DELETE FROM entries')
+
+    def reset(self) -> None:
+        """
+        Начинает новый запуск на уже открытом индексе: записи и счетчики прошлого запуска удаляются, т.к. данные
+        Персон могли измениться. Служба (`--daemon`) вызывает его перед каждым циклом вместо создания индекса.
+        """
+        with self.lock:
+            self.records = {}
+            self.stats = {'fetched': 0, 'avoided': 0}
+            if self.connection:
+                with self.connection:
+                    self.connection.execute('DELETE FROM entries')
+
+    def begin(self, key: str, uses: int) -> tuple:
+        """
+        Регистрирует обращение к Персоне.
+        :param key: Ключ Персоны, например `red/2020-1234`.
+        :param uses: Сколько раз Персона встретится за обход (количество ее гражданств в обходе).
+        :return: Кортеж (Future, owner). Если `owner` - вызывающий код загружает Персону сам и обязан вызвать
+        `finish()` или `fail()`. Иначе результат загрузки придет в Future.
+        """
+        with self.lock:
+            record = self.records.get(key)
+            if record:
+                self.stats['avoided'] += 1
+                record['uses'] -= 1
+                if record['uses'] <= 0 and record['future'].done():
+                    del self.records[key]
+                return record['future'], False
+
+            row = None
+            if self.connection:
+                row = self.connection.execute('SELECT value, uses FROM entries WHERE key=?', (key,)).fetchone()
+            if row:
+                self.stats['avoided'] += 1
+                with self.connection:
+                    if row[1] <= 1:
+                        self.connection.execute('DELETE FROM entries WHERE key=?', (key,))
+                    else:
+                        self.connection.execute('UPDATE entries SET uses=uses-1 WHERE key=?', (key,))
+                future = Future()
+                future.set_result(json.loads(row[0]))
+                return future, False
+
+            self.stats['fetched'] += 1
+            future = Future()
+            self.records[key] = {'future': future, 'uses': uses - 1}
+            return future, True
+
+    def finish(self, key: str, value) -> None:
+        """
+        Сохраняет результат загрузки и передает его ожидающим обращениям.
+        :param value: Словарь, который можно сохранить в json.
+        """
+        with self.lock:
+            record = self.records[key]
+            if record['uses'] <= 0:
+                del self.records[key]
+            elif self.connection:
+                # Ожидающие уже держат Future, а следующие обращения прочитают запись из базы
+                del self.records[key]
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                                            (key, json.dumps(value, ensure_ascii=False), record['uses']))
+        record['future'].set_result(value)
+
+    def fail(self, key: str, error: BaseException) -> None:
+        """Загрузка не удалась. Ожидающие получат ошибку, а следующее обращение загрузит Персону заново."""
+        with self.lock:
+            record = self.records.pop(key)
+        record['future'].set_exception(error)
+
+    def close(self) -> None:
+        if self.connection:
+            with self.lock:
+                self.connection.close()
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class DeltaIndex:
+    """
+    Снимок прошлых обходов для дельта-синхронизации. Для каждой Персоны хранится отпечаток ее данных (детальных
+    или превью вместе с адресами фото) и имена файлов ее фото, поэтому повторный обход скачивает только новые фото,
+    а данные Персоны, которые не изменились, не перезаписывает. Изменения копятся за запуск и выдаются `finish()`
+    списком добавленных, измененных и удаленных Персон.
+    Персона считается удаленной, только если она не нашлась в выдаче комбинации фильтров (тип страницы, гражданство,
+    пол), которая в этом запуске обойдена полностью, без неудачных запросов.
+    В отличие от `StateStore`, снимок не очищается после обхода. Запуск завершается только вызовом `finish()`,
+    поэтому прерванный и продолженный обход дают один список изменений.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Путь к файлу базы в формате строки или `Path`.
+        """
+        self.path = Path(db_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Базу пишут потоки асинхронного обхода и процессы обхода по шардам, как и у `StateStore`
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS persons (
+                    page_id TEXT, nation TEXT, entity_id TEXT, nation_name TEXT, gender TEXT, fingerprint TEXT,
+                    pictures TEXT, removed INTEGER NOT NULL, seen_run INTEGER,
+                    PRIMARY KEY (page_id, nation, entity_id))''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS queries (
+                    page_id TEXT, nation TEXT, gender TEXT, run INTEGER, PRIMARY KEY (page_id, nation, gender))''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS changes (
+                    page_id TEXT, nation TEXT, entity_id TEXT, nation_name TEXT, change TEXT,
+                    PRIMARY KEY (page_id, nation, entity_id))''')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('run', '1')")
+            self.connection.execute("INSERT OR IGNORE INTO meta VALUES ('started_at', ?)", (str(int(time.time())),))
+        self.run = int(self.connection.execute("SELECT value FROM meta WHERE key='run'").fetchone()[0])
+
+    @staticmethod
+    def get_fingerprint(data: dict, image_urls: list) -> str:
+        """Отпечаток данных Персоны и набора ее фото. Не зависит от порядка ключей и фото."""
+        payload = json.dumps({'data': data, 'images': sorted(image_urls)}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_person(self, page_id: str, nation: str, entity_id: str):
+        """
+        Ищем Персону в снимке прошлых обходов.
+        :return: `None`, если Персона еще не сохранялась. Иначе словарь {'fingerprint': str,
+        'pictures': {адрес фото: имя файла}, 'removed': bool}.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT fingerprint, pictures, removed FROM persons WHERE page_id=? AND nation=? AND entity_id=?',
+                (page_id, nation, entity_id)).fetchone()
+        if row is None:
+            return None
+        return {'fingerprint': row[0], 'pictures': json.loads(row[1]), 'removed': bool(row[2])}
+
+    def save_person(self, page_id: str, nation: str, entity_id: str, nation_name: str, gender: str,
+                    fingerprint: str, pictures: dict, change: str) -> None:
+        """
+        Обновляет Персону в снимке. Вызывать только после того, как сохранены все ее файлы.
+        :param pictures: Словарь сохраненных фото {адрес фото: имя файла}.
+        :param change: `added` или `updated`.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO persons VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                (page_id, nation, entity_id, nation_name, gender, fingerprint,
+                 json.dumps(pictures, ensure_ascii=False), self.run))
+            # Персона, добавленная в прерванной части запуска, остается добавленной
+            self.connection.execute('INSERT OR IGNORE INTO changes VALUES (?, ?, ?, ?, ?)',
+                                    (page_id, nation, entity_id, nation_name, change))
+
+    def mark_seen(self, page_id: str, nation: str, gender: str, entity_ids, complete: bool) -> None:
+        """
+        Отмечает Персон, найденных поиском по комбинации фильтров в этом запуске.
+        :param entity_ids: ID всех найденных Персон, в том числе пропущенных как уже сохраненные.
+        :param complete: `True`, если все поисковые запросы комбинации удались. Только из выдачи таких комбинаций
+        `finish()` определяет удаленных Персон.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE persons SET seen_run=? WHERE page_id=? AND nation=? AND entity_id=?',
+                [(self.run, page_id, nation, entity_id) for entity_id in entity_ids])
+            if complete:
+                self.connection.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                                        (page_id, nation, gender, self.run))
+
+    def get_removed(self) -> list:
+        """
+        Персоны, которых не было в выдаче полностью обойденных в этом запуске комбинаций фильтров.
+        :return: Список словарей {'page_id', 'nation', 'nation_name', 'entity_id'}.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT p.page_id, p.nation, p.nation_name, p.entity_id FROM persons AS p JOIN queries AS q '
+                'ON p.page_id=q.page_id AND p.nation=q.nation AND p.gender=q.gender '
+                'WHERE q.run=? AND p.seen_run<? AND p.removed=0', (self.run, self.run)).fetchall()
+        return [{'page_id': page_id, 'nation': nation, 'nation_name': nation_name, 'entity_id': entity_id}
+                for page_id, nation, nation_name, entity_id in rows]
+
+    def finish(self, removed: list) -> dict:
+        """
+        Завершает запуск: отмечает Персон удаленными и выдает список изменений за запуск. Следующий обход
+        начнет новый список.
+        :param removed: Удаленные Персоны из `get_removed()`.
+        :return: Словарь {'started_at', 'finished_at', 'added', 'updated', 'removed'}. Изменения - списки
+        словарей {'page_id', 'nation', 'nation_name', 'entity_id'}.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE persons SET removed=1 WHERE page_id=? AND nation=? AND entity_id=?',
+                [(person['page_id'], person['nation'], person['entity_id']) for person in removed])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, 'removed')",
+                [(person['page_id'], person['nation'], person['entity_id'], person['nation_name'])
+                 for person in removed])
+            started_at = self.connection.execute("SELECT value FROM meta WHERE key='started_at'").fetchone()[0]
+            changelog = {'started_at': int(started_at), 'finished_at': int(time.time()),
+                         'added': [], 'updated': [], 'removed': []}
+            for page_id, nation, entity_id, nation_name, change in self.connection.execute(
+                    'SELECT * FROM changes ORDER BY page_id, nation, entity_id'):
+                changelog[change].append({'page_id': page_id, 'nation': nation, 'nation_name': nation_name,
+                                          'entity_id': entity_id})
+            self.connection.execute('DELETE FROM changes')
+            self.run += 1
+            self.connection.execute("UPDATE meta SET value=? WHERE key='run'", (str(self.run),))
+            self.connection.execute("UPDATE meta SET value=? WHERE key='started_at'", (str(int(time.time())),))
+        return changelog
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class HttpCache:
+    """
+    Дисковый кэш ответов сервера. Тела ответов лежат отдельными файлами (имя - хэш URL), а индекс с заголовками,
+    размерами и временем последнего обращения хранится в SQLite.
+    - Пока запись моложе TTL своего типа ресурса - ответ отдается из кэша без обращения к сети.
+    - Устаревшая запись с `ETag`/`Last-Modified` проверяется условным запросом: ответ `304` продлевает ее жизнь.
+    - При превышении общего размера вытесняются записи, к которым дольше всего не обращались (LRU).
+    """
+
+    def __init__(self, cache_dir, max_size: int, ttl: dict):
+        """
+        :param cache_dir: Папка кэша в формате строки или `Path`.
+        :param max_size: Максимальный общий размер тел ответов в байтах.
+        :param ttl: Время жизни записей в секундах по типам ресурсов: {'search': 3600, 'image': 2592000, ...}.
+        Ответы ресурсов, отсутствующих в словаре, не кэшируются.
+        """
+        self.path = Path(cache_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'bytes_saved': 0}
+
+        self.connection = sqlite3.connect(str(Path(self.path, 'index.sqlite')), timeout=60,
+                                          check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    url TEXT PRIMARY KEY, file TEXT, size INTEGER, headers TEXT,
+                    etag TEXT, last_modified TEXT, stored_at REAL, accessed_at REAL)''')
+        self.total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        with self.lock, self.connection:
+            self.evict()    # Лимит размера мог быть уменьшен в настройках с прошлого запуска
+
+    def is_cacheable(self, resource: str) -> bool:
+        return resource in self.ttl
+
+    def lookup(self, url: str):
+        """
+        Ищем запись по URL.
+        :return: `None` или словарь с полями записи.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT file, size, headers, etag, last_modified, stored_at FROM entries WHERE url=?',
+                (url,)).fetchone()
+        if row is None:
+            return None
+        file, size, headers, etag, last_modified, stored_at = row
+        return {'file': file, 'size': size, 'headers': json.loads(headers), 'etag': etag,
+                'last_modified': last_modified, 'stored_at': stored_at}
+
+    def is_fresh(self, entry: dict, resource: str) -> bool:
+        return time.time() - entry['stored_at'] < self.ttl[resource]
+
+    def get_validators(self, entry: dict) -> dict:
+        """Заголовки условного запроса для устаревшей записи. Пустой словарь, если сервер их не поддерживает."""
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get_response(self, url: str, entry: dict, revalidated=False, stream=False):
+        """
+        Собираем объект ответа `requests` из записи кэша и обновляем время обращения к ней.
+        :param revalidated: `True`, если запись подтверждена ответом `304`. Тогда срок ее жизни начинается заново.
+        :param stream: Если `True` - тело не читается в память, а отдается открытым файлом через `response.raw`,
+        как и у потокового ответа `requests`.
+        :return: Объект `requests.Response` или `None`, если файл записи пропал с диска.
+        """
+        response = requests.Response()
+        try:
+            if stream:
+                response.raw = Path(self.path, entry['file']).open('rb')
+            else:
+                response._content = Path(self.path, entry['file']).read_bytes()
+        except OSError:
+            self.remove(url)
+            return None
+
+        now = time.time()
+        with self.lock, self.connection:
+            if revalidated:
+                self.connection.execute('UPDATE entries SET stored_at=?, accessed_at=? WHERE url=?', (now, now, url))
+                self.stats['revalidated'] += 1
+            else:
+                self.connection.execute('UPDATE entries SET accessed_at=? WHERE url=?', (now, url))
+                self.stats['hits'] += 1
+            self.stats['bytes_saved'] += entry['size']
+
+        response.status_code = 200
+        response.from_cache = True
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def record_miss(self) -> None:
+        """Учитываем запрос, на который кэш не ответил: записи нет, ее файл пропал или запись изменилась на сервере."""
+        with self.lock:
+            self.stats['misses'] += 1
+
+    def store(self, url: str, response: requests.Response) -> None:
+        """Сохраняем успешный ответ в кэш и вытесняем старые записи при превышении размера."""
+        file = hashlib.sha256(url.encode()).hexdigest()
+        temp_path = Path(self.path, f'{file}.{os.getpid()}.{threading.get_ident()}.tmp')
+        temp_path.write_bytes(response.content)
+        os.replace(temp_path, Path(self.path, file))     # Атомарная замена: читатель не увидит недописанный файл
+        self.add_entry(url, file, len(response.content), response.headers)
+
+    def store_file(self, url: str, file_path: Path, headers) -> None:
+        """
+        Сохраняем в кэш ответ, тело которого уже скачано потоком в файл. Файл копируется без чтения целиком в память.
+        :param file_path: Путь к скачанному телу ответа.
+        :param headers: Заголовки ответа.
+        """
+        file = hashlib.sha256(url.encode()).hexdigest()
+        temp_path = Path(self.path, f'{file}.{os.getpid()}.{threading.get_ident()}.tmp')
+        shutil.copyfile(file_path, temp_path)
+        size = temp_path.stat().st_size
+        os.replace(temp_path, Path(self.path, file))
+        self.add_entry(url, file, size, headers)
+
+    def add_entry(self, url: str, file: str, size: int, headers) -> None:
+        """Добавляем запись в индекс и вытесняем старые записи при превышении размера."""
+        kept_headers = {key: value for key, value in headers.items()
+                        if key.lower() in ('content-type', 'etag', 'last-modified')}
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT size FROM entries WHERE url=?', (url,)).fetchone()
+            self.total_size += size - (row[0] if row else 0)
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (url, file, size, json.dumps(kept_headers), headers.get('ETag'),
+                                     headers.get('Last-Modified'), now, now))
+            self.evict()
+
+    def evict(self) -> None:
+        """Удаляем давно не использованные записи, пока общий размер больше допустимого. Вызывается под `lock`."""
+        while self.total_size > self.max_size:
+            row = self.connection.execute(
+                'SELECT url, file, size FROM entries ORDER BY accessed_at LIMIT 1').fetchone()
+            if row is None:
+                break
+            url, file, size = row
+            self.connection.execute('DELETE FROM entries WHERE url=?', (url,))
+            Path(self.path, file).unlink(missing_ok=True)
+            self.total_size -= size
+
+    def remove(self, url: str) -> None:
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT size FROM entries WHERE url=?', (url,)).fetchone()
+            if row:
+                self.connection.execute('DELETE FROM entries WHERE url=?', (url,))
+                self.total_size -= row[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,264 @@
+# -*- coding: UTF-8 -*-
+
+import functools
+import hashlib
+import os
+import threading
+import time
+import requests
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+from blob_store import BlobStore
+from http_cache import HttpCache
+from instrumentation import metrics
+from request_scheduler import RequestScheduler
+
+
+class CountingAdapter(HTTPAdapter):
+    """
+    Адаптер `requests`, который помимо пула соединений считает, сколько TCP(+TLS) соединений было открыто за все время.
+    `urllib3` сам ведет счетчик `num_connections` в каждом пуле хоста, нам остается лишь суммировать их и не терять
+    значения пулов, которые менеджер вытесняет при превышении `pool_connections`. Пулы соединений через прокси
+    живут в отдельных менеджерах (`proxy_manager`) и считаются так же.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.disposed_connections = 0      # Соединения пулов, которые уже были вытеснены из менеджера
+        super().__init__(*args, **kwargs)
+
+    def watch_pools(self, manager) -> None:
+        """Подключает подсчет соединений пулов, вытесняемых из менеджера."""
+        pools = manager.pools
+        dispose = pools.dispose_func
+
+        def dispose_func(pool):
+            self.disposed_connections += pool.num_connections
+            if dispose:
+                dispose(pool)
+
+        pools.dispose_func = dispose_func
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.watch_pools(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        new = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if new:
+            self.watch_pools(manager)
+        return manager
+
+    def connections_opened(self) -> int:
+        """Возвращаем общее количество открытых адаптером соединений."""
+        opened = 0
+        for manager in [self.poolmanager, *self.proxy_manager.values()]:
+            pools = manager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    opened += pool.num_connections
+        return opened + self.disposed_connections
+
+
+class HttpClient:
+    """
+    Единый HTTP-клиент на весь обход. Держит одну сессию `requests` с пулом keep-alive соединений, поэтому
+    повторные запросы к `ws-public.interpol.int` не открывают новое TCP+TLS соединение.
+    Объект передается в `NoticePage`, `PersonPreview`, `PersonDetail` и `get_notices()`.
+    """
+
+    def __init__(self, pool_size: int = 10, timeout: float = 60, cache: HttpCache = None, blobs: BlobStore = None,
+                 scheduler: RequestScheduler = None, proxies=None):
+        """
+        :param pool_size: Максимальное количество одновременно удерживаемых соединений с одним хостом.
+        Для асинхронного обхода должно быть не меньше `concurrency`, иначе лишние соединения будут закрываться.
+        :param timeout: Таймаут подключения и чтения ответа в секундах.
+        :param cache: Дисковый кэш ответов. Если не передан - все запросы уходят в сеть.
+        :param blobs: Хранилище фото без дублей. Если не передано - каждое фото сохраняется отдельным файлом.
+        :param scheduler: Ограничение частоты и повторы запросов. Если не передан - каждый запрос отправляется
+        один раз и сразу.
+        :param proxies: Пул прокси (`ProxyPool`). Если передан - все запросы уходят через его прокси, каждый
+        со своим пулом соединений, а собственный пул клиента не используется.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = cache
+        self.blobs = blobs
+        self.scheduler = scheduler
+        self.proxies = proxies
+        self.requests_made = 0
+        self.lock = threading.Lock()     # Клиент используется из нескольких потоков асинхронного обхода
+
+        self.adapter = CountingAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def get(self, url: str, resource: str = None, **kwargs) -> requests.Response:
+        """
+        Аналог `requests.get()`, но через общий пул соединений и с таймаутом по-умолчанию.
+        :param url: Адрес запроса.
+        :param resource: Тип ресурса: `page`, `search`, `detail`, `images` или `image`. По нему выбирается TTL кэша.
+        :param kwargs: Любые параметры `requests.Session.get()`.
+        :return: Объект ответа `requests`.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        entry = None
+        if self.cache and self.cache.is_cacheable(resource):
+            entry = self.cache.lookup(url)
+            if entry and self.cache.is_fresh(entry, resource):
+                response = self.cache.get_response(url, entry, stream=kwargs.get('stream', False))
+                if response:
+                    metrics.inc('http_cache_hits_total', resource=resource)
+                    return response
+                entry = None    # Файл записи пропал с диска - запрашиваем заново
+            if entry:
+                # Устаревшую запись проверяем условным запросом, если сервер отдавал `ETag` или `Last-Modified`
+                kwargs['headers'] = {**kwargs.get('headers', {}), **self.cache.get_validators(entry)}
+
+        if self.scheduler:
+            response = self.scheduler.request(url, functools.partial(self.send, url, kwargs, resource))
+        else:
+            response = self.send(url, kwargs, resource)
+
+        if entry and response.status_code == 304:
+            response.close()    # Возвращаем соединение в пул, даже если ответ запрашивался потоком
+            cached_response = self.cache.get_response(url, entry, revalidated=True, stream=kwargs.get('stream', False))
+            if cached_response:
+                return cached_response
+            kwargs['headers'] = {key: value for key, value in kwargs['headers'].items()
+                                 if key not in ('If-None-Match', 'If-Modified-Since')}
+            return self.get(url, resource=resource, **kwargs)
+
+        if self.cache and self.cache.is_cacheable(resource):
+            # Промах считается здесь, а не при записи в кэш: запись бывает и без промаха, и промах без записи
+            self.cache.record_miss()
+            if response.status_code == 200 and not kwargs.get('stream'):
+                # Потоковые ответы кэшируются уже после записи на диск, в `download()`
+                self.cache.store(url, response)
+        return response
+
+    def send(self, url: str, kwargs: dict, resource: str = None) -> requests.Response:
+        """
+        Отправляет запрос в сеть. Каждый повтор запроса считается отдельно, в том числе в метриках: количество
+        запросов по типу ресурса и статусу ответа, время до получения ответа и объем скачанных данных.
+        Объем потоковых ответов считает `download()`.
+        """
+        with self.lock:
+            self.requests_made += 1
+        started = time.perf_counter()
+        try:
+            if self.proxies:
+                response = self.proxies.send(url, kwargs)
+            else:
+                response = self.session.get(url, **kwargs)
+        except requests.RequestException as e:
+            metrics.inc('http_requests_total', resource=resource, status=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('http_request_seconds', time.perf_counter() - started, resource=resource)
+        metrics.inc('http_requests_total', resource=resource, status=response.status_code)
+        if not kwargs.get('stream'):
+            metrics.inc('downloaded_bytes_total', len(response.content), resource=resource)
+        return response
+
+    def download(self, url: str, directory: Path, name: str, default_suffix: str = None, resource: str = 'image',
+                 chunk_size: int = 64 * 1024, file_name: str = None) -> Path:
+        """
+        Скачивает файл потоком прямо на диск, не держа тело ответа в памяти целиком. Данные пишутся во временный
+        файл и атомарно переименовываются, поэтому недокачанный файл никогда не окажется под итоговым именем.
+        Если подключено хранилище фото (`BlobStore`), файл, уже скачанный по этому адресу, не запрашивается заново,
+        а одинаковые по содержимому файлы хранятся на диске один раз.
+        :param url: Адрес файла.
+        :param directory: Папка назначения. Создается при необходимости. Если `None` - файл сохраняется только
+        в хранилище фото, и возвращается путь к нему в хранилище.
+        :param name: Имя файла без расширения. Расширение берется из `content-type` ответа.
+        :param default_suffix: Расширение без точки (`jpg`), если сервер не вернул `content-type`. Если `None` -
+        будет исключение.
+        :param resource: Тип ресурса для кэша.
+        :param chunk_size: Размер блока чтения в байтах.
+        :param file_name: Имя файла, под которым фото сохранено в прошлом обходе. Если файл есть в папке
+        назначения - он не запрашивается заново.
+        :return: Путь к сохраненному файлу.
+        """
+        if file_name and directory and Path(directory, file_name).is_file():
+            return Path(directory, file_name)
+        if self.blobs:
+            known = self.blobs.lookup(url)
+            if known:
+                digest, suffix = known
+                return self.blobs.link_known(url, Path(directory, f'{name}.{suffix}') if directory else None, digest)
+
+        with self.get(url, resource=resource, stream=True) as response:
+            response.raise_for_status()
+            if 'content-type' in response.headers or default_suffix is None:
+                suffix = response.headers['content-type'].split('/')[-1]    # Получаем расширение файла
+            else:
+                suffix = default_suffix
+            file_name = f'{name}.{suffix}'
+            file_path = Path(directory, file_name) if directory else None
+            if self.blobs:
+                temp_path = self.blobs.get_temp_path(file_name)
+            else:
+                temp_path = Path(directory, f'.{file_name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                Path(directory).mkdir(parents=True, exist_ok=True)
+
+            try:
+                digest = hashlib.sha256()
+                size = 0
+                with temp_path.open('wb') as fp:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        fp.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                metrics.inc('written_bytes_total', size, target='image')
+                if not getattr(response, 'from_cache', False):
+                    metrics.inc('downloaded_bytes_total', size, resource=resource)
+                if self.blobs:
+                    file_path = self.blobs.add(url, temp_path, digest.hexdigest(), suffix, file_path)
+                else:
+                    os.replace(temp_path, file_path)
+            finally:
+                temp_path.unlink(missing_ok=True)
+
+            if getattr(response, 'from_cache', False):
+                response.raw.close()    # Файл кэша, прочитанный до конца, `requests` сам не закрывает
+            elif self.cache and self.cache.is_cacheable(resource):
+                # Ответ пришел из сети - кладем его в кэш копией уже сохраненного файла
+                self.cache.store_file(url, file_path, response.headers)
+        return file_path
+
+    def get_stats(self) -> dict:
+        """Возвращаем количество сделанных запросов и открытых соединений."""
+        connections = self.adapter.connections_opened()
+        if self.proxies:
+            connections += self.proxies.connections_opened()
+        return {'requests': self.requests_made, 'connections': connections}
+
+    def close(self) -> None:
+        self.session.close()
+        if self.proxies:
+            self.proxies.close()
+        if self.cache:
+            self.cache.close()
+        if self.blobs:
+            self.blobs.close()
+
+
+default_client = None
+
+
+def get_client(client: HttpClient = None) -> HttpClient:
+    """
+    Возвращает переданный клиент, либо общий клиент модуля с настройками по-умолчанию.
+    Позволяет использовать классы `bs_interface` без явной передачи клиента.
+    """
+    global default_client
+    if client:
+        return client
+    if not default_client:
+        default_client = HttpClient()
+    return default_client
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+
+import queue
+import logging
+import threading
+from pathlib import Path
+
+from http_client import HttpClient, get_client
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePipeline:
+    """
+    Этап загрузки картинок. Обход кладет ссылки на фото в ограниченную очередь, а несколько потоков забирают их
+    и скачивают потоком прямо в папку Персоны (`HttpClient.download`). Если очередь заполнена, обход ждет,
+    поэтому память не растет, сколько бы фото ни было у Персон.
+    При `workers=0` фото скачиваются сразу в вызывающем потоке.
+    """
+
+    def __init__(self, client: HttpClient = None, workers: int = 4, queue_size: int = 16, name: str = 'images'):
+        """
+        :param client: Общий HTTP-клиент.
+        :param workers: Количество потоков загрузки.
+        :param queue_size: Сколько фото может ждать загрузки в очереди. Если `0` - очередь не ограничена.
+        :param name: Имя очереди в метрике `queue_depth`.
+        """
+        self.client = get_client(client)
+        self.name = name
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+        metrics.register_gauge('queue_depth', self.jobs.qsize, queue=name)
+
+    def submit(self, directory: Path, image_links: list, on_done=None) -> None:
+        """
+        Ставит все фото одной Персоны в очередь загрузки.
+        :param directory: Папка Персоны.
+        :param image_links: Список `ImageLink`.
+        :param on_done: Функция, которая вызывается после загрузки всех фото Персоны с двумя аргументами:
+        словарем {`имя_файла`: путь} и количеством фото, которые не удалось скачать (в словарь они не попадают).
+        """
+        batch = {'left': len(image_links), 'images': {}, 'failed': 0, 'on_done': on_done, 'lock': threading.Lock()}
+        if not image_links:
+            if on_done:
+                on_done({}, 0)
+            return
+
+        for image_link in image_links:
+            if self.threads:
+                self.jobs.put((directory, image_link, batch))      # Блокируется, пока в очереди нет места
+            else:
+                self.download(directory, image_link, batch)
+
+    def work(self) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    break
+                self.download(*job)
+            finally:
+                self.jobs.task_done()
+
+    def download(self, directory: Path, image_link, batch: dict) -> None:
+        """Скачивает одно фото и, если оно последнее у Персоны, вызывает `on_done`."""
+        try:
+            file_path = self.client.download(image_link.url, directory, image_link.name,
+                                             default_suffix=image_link.default_suffix,
+                                             file_name=image_link.file_name)
+            with batch['lock']:
+                batch['images'][file_path.name] = file_path
+        except Exception as e:
+            logger.error(f'Image `{image_link.url}` is not saved: {e}', extra={'url': image_link.url})
+            with batch['lock']:
+                batch['failed'] += 1
+        finally:
+            with batch['lock']:
+                batch['left'] -= 1
+                done = batch['left'] == 0
+            if done and batch['on_done']:
+                batch['on_done'](batch['images'], batch['failed'])
+
+    def flush(self) -> None:
+        """Дожидается загрузки всех фото, уже поставленных в очередь."""
+        self.jobs.join()
+
+    def cancel(self) -> int:
+        """
+        Убирает из очереди фото, загрузка которых еще не началась. `on_done` их Персон не вызывается.
+        :return: Количество убранных фото.
+        """
+        cancelled = 0
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                return cancelled
+            self.jobs.task_done()
+            cancelled += 1
+
+    def close(self) -> None:
+        """Дожидается загрузки всех фото из очереди и останавливает потоки."""
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        metrics.unregister_gauge('queue_depth', queue=self.name)
@@ -0,0 +1,304 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Границы корзин гистограмм в секундах. Подходят и для сетевых задержек, и для разбора и записи файлов
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PREFIX = 'inter_parser_'    # Префикс имен метрик в формате Prometheus
+# Стандартные атрибуты записи лога. Все остальные переданы через `extra` и выводятся отдельными полями json
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Распределение значений по корзинам `BUCKETS`, как гистограмма Prometheus."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # Последняя корзина - значения больше всех границ (`+Inf`)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def get_quantile(self, quantile: float) -> float:
+        """Оценка квантиля по корзинам: верхняя граница корзины, в которую он попадает."""
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Метрики обхода: счетчики, гистограммы времени и глубина очередей. Модули обхода пишут в общий объект `metrics`
+    этого модуля, метрики различаются именем и метками, например `http_requests_total{resource="search"}`.
+    Глубина очередей снимается фоновым потоком раз в секунду (последнее и максимальное значение). Тот же поток
+    периодически перезаписывает файл метрик в текстовом формате Prometheus. В конце обхода `write_report()`
+    сохраняет все метрики в json.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # {(имя, метки): значение}. Метки - кортеж пар (имя, значение)
+        self.histograms = {}    # {(имя, метки): Histogram}
+        self.gauges = {}        # {(имя, метки): функция без аргументов, возвращающая текущее значение}
+        self.gauge_values = {}  # {(имя, метки): {'last': значение, 'max': значение}}
+        self.summary = {}       # Итоговая статистика модулей: {раздел: словарь}
+        self.common_labels = ()     # Метки всех метрик в формате Prometheus, например процесс обхода по шардам
+        self.started_at = time.time()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def get_key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Увеличивает счетчик `name` с метками `labels` на `value`."""
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Добавляет значение (обычно время в секундах) в гистограмму `name`."""
+        key = self.get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Измеряет время выполнения блока `with` и добавляет его в гистограмму `name`, даже если блок упал."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def get_total(self, name: str, **labels) -> float:
+        """Сумма счетчика `name` по всем сериям, метки которых включают `labels`."""
+        labels = {key: str(value) for key, value in labels.items()}
+        with self.lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                       if counter_name == name and labels.items() <= dict(counter_labels).items())
+
+    def register_gauge(self, name: str, func, **labels) -> None:
+        """
+        Подключает значение, которое снимается периодически, например глубину очереди.
+        :param func: Функция без аргументов, возвращающая текущее значение.
+        """
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.gauges[key] = func
+
+    def unregister_gauge(self, name: str, **labels) -> None:
+        """Отключает значение. Последнее и максимальное значения остаются в отчете."""
+        self.sample_gauges()
+        with self.lock:
+            self.gauges.pop(self.get_key(name, labels), None)
+
+    def sample_gauges(self) -> None:
+        with self.lock:
+            gauges = list(self.gauges.items())
+        for key, func in gauges:
+            try:
+                value = func()
+            except Exception:
+                continue    # Объект уже закрыт
+            with self.lock:
+                values = self.gauge_values.setdefault(key, {'last': value, 'max': value})
+                values['last'] = value
+                values['max'] = max(values['max'], value)
+
+    def set_summary(self, section: str, data: dict) -> None:
+        """Сохраняет итоговую статистику модуля (HTTP, кэш, хранилище фото и т.п.) в раздел отчета."""
+        with self.lock:
+            self.summary[section] = data
+
+    def reset(self) -> None:
+        """Очищает все метрики перед новым обходом. Подключенные значения очередей остаются."""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.gauge_values = {}
+            self.summary = {}
+            self.started_at = time.time()
+
+    def start(self, prometheus_path=None, interval: float = 15, **labels) -> None:
+        """
+        Начинает новый обход: очищает метрики и запускает фоновый поток, который снимает глубину очередей
+        и перезаписывает файл метрик Prometheus раз в `interval` секунд.
+        :param prometheus_path: Путь к файлу метрик в текстовом формате Prometheus. Если не задан - не пишется.
+        :param labels: Метки, которые добавляются ко всем метрикам в формате Prometheus, чтобы метрики процессов
+        обхода по шардам не смешивались у сборщика.
+        """
+        self.stop()
+        self.reset()
+        self.common_labels = self.get_key('', labels)[1]
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.work, args=(prometheus_path, max(interval, 1)), daemon=True)
+        self.thread.start()
+
+    def work(self, prometheus_path, interval: float) -> None:
+        written_at = time.monotonic()
+        while not self.stop_event.wait(1):
+            self.sample_gauges()
+            if prometheus_path and time.monotonic() - written_at >= interval:
+                written_at = time.monotonic()
+                try:
+                    self.write_prometheus(prometheus_path)
+                except OSError as e:
+                    logger.warning(f'Metrics file is not written: {e}')
+        if prometheus_path:
+            self.sample_gauges()
+            self.write_prometheus(prometheus_path)   # Итоговые значения после остановки обхода
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток. Файл метрик Prometheus перезаписывается итоговыми значениями."""
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        self.sample_gauges()
+
+    def get_report(self) -> dict:
+        """
+        Все метрики в виде словаря для json-отчета. Каждая метрика - список значений с разными метками:
+        счетчики - {'labels', 'value'}, гистограммы - {'labels', 'count', 'sum', 'mean', 'p50', 'p90', 'p99', 'max',
+        'buckets': {граница: количество значений не больше нее}}, очереди - {'labels', 'last', 'max'}.
+        """
+        report = {'started_at': self.started_at, 'finished_at': time.time(), 'counters': {}, 'histograms': {},
+                  'gauges': {}}
+        report['duration'] = report['finished_at'] - report['started_at']
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                report['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip((*BUCKETS, '+Inf'), histogram.counts):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                report['histograms'].setdefault(name, []).append({
+                    'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                    'mean': histogram.sum / histogram.count, 'p50': histogram.get_quantile(0.5),
+                    'p90': histogram.get_quantile(0.9), 'p99': histogram.get_quantile(0.99), 'max': histogram.max,
+                    'buckets': buckets})
+            for (name, labels), values in sorted(self.gauge_values.items()):
+                report['gauges'].setdefault(name, []).append({'labels': dict(labels), **values})
+            report['summary'] = json.loads(json.dumps(self.summary, default=str))
+        return report
+
+    def get_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus. Для очередей выводится последнее значение."""
+        def format_labels(labels, extra=()) -> str:
+            pairs = [*self.common_labels, *labels, *extra]
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+        def escape(value: str) -> str:
+            return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {PREFIX}{name} counter')
+                lines.append(f'{PREFIX}{name}{format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {PREFIX}{name} histogram')
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, '+Inf'), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+            for (name, labels), values in sorted(self.gauge_values.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {PREFIX}{name} gauge')
+                lines.append(f"{PREFIX}{name}{format_labels(labels)} {values['last']}")
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, file_path) -> None:
+        """Сохраняет json-отчет с метриками обхода."""
+        write_text(Path(file_path), json.dumps(self.get_report(), indent=4, ensure_ascii=False))
+
+    def write_prometheus(self, file_path) -> None:
+        """Перезаписывает файл метрик для `node_exporter` (textfile collector) или другого сборщика."""
+        write_text(Path(file_path), self.get_prometheus())
+
+
+def write_text(file_path: Path, text: str) -> None:
+    """Атомарная запись текстового файла: сборщик метрик никогда не прочитает файл наполовину."""
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = Path(file_path.parent, f'.{file_path.name}.{os.getpid()}.tmp')
+    try:
+        temp_path.write_text(text, encoding='utf-8')
+        os.replace(temp_path, file_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def get_metrics_path(path, part: str = None):
+    """
+    Путь к файлу метрик. При обходе по шардам каждый процесс пишет свой файл: `metrics.json` -> `metrics.part.json`.
+    :return: `Path` или `None`, если путь не задан.
+    """
+    if not path:
+        return None
+    path = Path(path)
+    return path.with_name(f'{path.stem}.{part}{path.suffix}') if part else path
+
+
+class JsonFormatter(logging.Formatter):
+    """Записи лога в виде json-строк: время, уровень, модуль, сообщение и поля, переданные через `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_ATTRS})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(log_format: str = 'text', level: str = 'INFO') -> None:
+    """
+    Настраивает вывод лога в консоль. Повторный вызов заменяет прежние настройки.
+    :param log_format: `text` - строки для чтения человеком, `json` - json-строка на каждую запись.
+    :param level: Минимальный уровень записей: `DEBUG`, `INFO`, `WARNING`, `ERROR`.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level.upper(), handlers=[handler], force=True)
+
+
+metrics = Metrics()
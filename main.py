@@ -1,18 +1,42 @@
 # -*- coding: UTF-8 -*-
 
-import requests
+import argparse
 import json
+import functools
 import itertools
-from file_manager import Settings, save_file
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from file_manager import Settings, save_file, link_file
 
+from age_planner import AgePlanner
+from blob_store import BlobStore
+from dedup_index import DedupIndex
+from delta_sync import DeltaIndex
 from bs_interface import NoticePage, PersonDetail, PersonPreview
+from http_cache import HttpCache
+from http_client import HttpClient, get_client
+from image_pipeline import ImagePipeline
+from instrumentation import metrics, setup_logging, get_metrics_path
+from proxy_pool import ProxyPool
+from output_backends import TreeOutput, create_output, merge_outputs
+from request_scheduler import RequestScheduler
+from state_store import StateStore
+from thumbnail_queue import ThumbnailQueue, ThumbnailFetcher
+from work_queue import WorkQueue, in_shard
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
 
-def get_notices(url='', notice_type='', nation='', gender='', keyword='', request='', limit=0,
-                age=0, min_age=0, max_age=0) -> dict:
+
+def iter_notices(url='', notice_type='', nation='', gender='', keyword='', request='', limit=0,
+                 age=0, min_age=0, max_age=0, client: HttpClient = None, state: StateStore = None,
+                 planner: AgePlanner = None):
     """
-    Формирует словарь Превьюшек с базовыми данными для всех Персон, подходящих под фильтр.
+    Выдает Превьюшки с базовыми данными для всех Персон, подходящих под фильтр. Превью каждого листа дерева поиска
+    выдаются сразу после его получения, поэтому загрузка Персон начинается, не дожидаясь остальных запросов.
     :param url: api-ссылка
     :param notice_type: `red` или `yellow`
     :param nation: ID Гражданства. Доступный список получаем непосредственно из HTML страницы.
@@ -23,70 +47,167 @@ def get_notices(url='', notice_type='', nation='', gender='', keyword='', reques
     :param request: DEPRECATED. Готовый запрос с фильтрами и указанием страницы выдачи.
     Используем его при рекурсивном обходе.
     :param limit: Количество результатов выдачи на одну страницу.
-    :return: Возвращаем кортеж, который содержит словарь и целое число.
-    Словарь: Ключ - `entity_id`, Значение - Словарь с краткими сведениями о найденной персоне.
-    Из него получаем, в том числе, ссылку на фото и запрос детальной информации.
-    Целое число: общее количество результатов по запросу.
+    :param client: Общий HTTP-клиент с пулом соединений. Если не передан - используется клиент по-умолчанию.
+    :param state: Хранилище состояния обхода. Если передано - уже выполненные узлы поиска не запрашиваются повторно.
+    :param planner: Планировщик возрастных диапазонов. Если не передан - диапазон делится пополам `get_age_ranges()`.
+    :return: Генератор пар (`entity_id`, Словарь с краткими сведениями о найденной персоне).
+    Из словаря получаем, в том числе, ссылку на фото и запрос детальной информации.
+    Одна Персона может встретиться несколько раз, если сервер выдал ее дубль.
     """
     min_age = int(min(min_age, max_age))
     max_age = int(max(min_age, max_age))
     notices = {}        # Словарь, который хранит результаты выдачи
     total = 0           # DEPRECATED: Общее количество результатов в выдаче. Забираем его атрибутов параметров выдачи.
-    if not request:     # Этот `if` потерял актуальность, т.к. больше не используем параметр `request`.
-        # Если нам не передан готовый реквест, значит собираем его из параметров
-        request = f'{url}{notice_type}?' \
-                  f'nationality={nation}&' \
-                  f'sexId={gender}&' \
-                  f'ageMin={min_age}&ageMax={max_age}&' \
-                  f'resultPerPage={limit}'      # &freeText={keyword} - Ключевой запрос больше не используем.
-    print(f'Request: {request}')
-    response = requests.get(url=request)
-
-    # TODO - обработать все прочие запросы. Возможно, добавить несколько попыток при получении 4** и 5** ошибок.
-    '''
-    if response.status_code == 200:  # Для простоты игнорируем другие статусы. По-уму их тоже нужно обработать
-        output_dict = response.json()   # Метод .json сразу же возвращает Словарь вместо json-Сроки.
-    '''
-    output_dict = response.json() if response.status_code == 200 else None      # Сократил вложенность `иф-элсов`
 
-    if output_dict and int(output_dict['total']) > 0:  # Проверяем что результат не пуст и `total` больше `0`
-        total = int(output_dict['total'])
+    # Если запуск продолжает прерванный обход - узел дерева поиска мог быть уже выполнен
+    search_node = state.get_search_node(notice_type, nation, gender, min_age, max_age) if state else None
+    if search_node and not search_node['split']:
+        if planner:
+            planner.record_leaf(notice_type, nation, gender, min_age, max_age, search_node['total'])
+        yield from search_node['notices'].items()   # Лист уже получен ранее, повторный запрос не нужен
+        return
+    split = bool(search_node)           # Узел уже разбивался ранее - сразу переходим к поддиапазонам
+    if split:
+        total = search_node['total']
+        sub_ranges = search_node['sub_ranges'] or get_age_ranges(min_age, max_age)
+
+    if not split:
+        if not request:     # Этот `if` потерял актуальность, т.к. больше не используем параметр `request`.
+            # Если нам не передан готовый реквест, значит собираем его из параметров
+            request = get_search_url(url=url, notice_type=notice_type, nation=nation, gender=gender,
+                                     min_age=min_age, max_age=max_age, limit=limit)
+        logger.info(f'Request: {request}', extra={'url': request, 'resource': 'search'})
+        try:
+            response = get_client(client).get(url=request, resource='search')
+        except Exception as e:
+            logger.error(e, extra={'url': request})     # Сеть недоступна и после всех повторов
+            response = None
+        if planner:
+            planner.record_request()
 
-        if total >= limit and min_age != max_age:
+        # TODO - обработать все прочие запросы. Возможно, добавить несколько попыток при получении 4** и 5** ошибок.
+        '''
+        if response.status_code == 200:  # Для простоты игнорируем другие статусы. По-уму их тоже нужно обработать
+            output_dict = response.json()   # Метод .json сразу же возвращает Словарь вместо json-Сроки.
+        '''
+        # Сократил вложенность `иф-элсов`
+        output_dict = None
+        if response is not None and response.status_code == 200:
+            with metrics.timer('parse_seconds', stage='search'):
+                output_dict = response.json()
+        if output_dict is None:
+            # Клиент уже исчерпал повторы. Узел не отмечается в состоянии, поэтому продолженный обход его повторит
+            logger.error(f'Request failed: {request}', extra={'url': request})
+
+        if output_dict and int(output_dict['total']) > 0:  # Проверяем что результат не пуст и `total` больше `0`
+            total = int(output_dict['total'])
             """
             Если в выдаче 160 результатов и более, значит фильтр слишком широк, и нужно его уточнить.
-            Для этого разбиваем возрастной диапазон на 2 половины и рекурсивно вызываем метод по двум новым диапазонам.
+            Для этого разбиваем возрастной диапазон на части и рекурсивно вызываем метод по новым диапазонам.
+            Если в выдаче меньше 160 результатов ИЛИ минимальный возраст равен максимальному -
+            то нет необходимости дальше углубляться в запросах, т.к. мы достигли `листа` в нашем графе.
             """
-            [lower_min_age, lower_max_age], [upper_min_age, upper_max_age] = get_age_ranges(min_age, max_age)
+            split = total >= limit and min_age != max_age
+            if split and planner:
+                # Возрасты Персон из уже полученной выдачи подсказывают, где ставить границы поддиапазонов
+                sub_ranges = planner.split(notice_type, nation, gender, min_age, max_age, total,
+                                           sample=output_dict['_embedded']['notices'])
+            elif split:
+                sub_ranges = get_age_ranges(min_age, max_age)
+            else:
+                for notice in output_dict['_embedded']['notices']:
+                    # Собираем все превью персон в словарь. Ключом выступает уникальный идентификатор Запроса
+                    notices[notice['entity_id']] = notice
 
-            notices.update(get_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, keyword=keyword,
-                                       limit=limit, min_age=lower_min_age, max_age=lower_max_age))
-            notices.update(get_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, keyword=keyword,
-                                       limit=limit, min_age=upper_min_age, max_age=upper_max_age))
-        else:
             """
-            Если в выдаче меньше 160 результатов ИЛИ минимальный возраст равен максимальному -
-            то нет необходимости дальше углубляться в запросах, т.к. мы достигли `листа` в нашем графе.
+            По сути мы больше не нуждаемся в этом блоке кода, т.к. забираем всю выдачу сразу без разбивки на страницы -
+            `next_page` всегда будет `None`. Однако оставлю его "прозапас" на случай непредвиденных задач.
             """
-            for notice in output_dict['_embedded']['notices']:
-                # Собираем все превью персон в словарь. Ключом выступает уникальный идентификатор Запроса
-                notices[notice['entity_id']] = notice
+            next_page = output_dict['_links'].get('next')  # Ищем ссылку на следующую страницу выдачи, `default=None`
+            if next_page:
+                # У последней страницы нет ссылки на следующую страницу.
+                # TODO - заменить предварительное сохранение и проверку "истинности" результата на обработку ошибок
+                # Рекурсивно проходим по всем доступным страницам выдачи, обновляя словарь Превьюшек персон.
+                # TODO - больше не нужно, т.к. забираем всю доступную выдачу одним запросом без разбивки на страницы
+                next_page_response, total = get_notices(request=next_page['href'], client=client)
+                if next_page_response:       # Если результат не пуст (а он не должен быть пуст, если сеть доступна),
+                    notices.update(next_page_response)   # то расширяем словарь "нотисов".
 
-        """
-        По сути мы больше не нуждаемся в этом блоке кода, т.к. забираем всю выдачу сразу без разбивки на страницы -
-        `next_page` всегда будет `None`. Однако оставлю его "прозапас" на случай непредвиденных задач.
-        """
-        next_page = output_dict['_links'].get('next')     # Ищем ссылку на следующую страницу выдачи, `default=None`.
-        if next_page:
-            # У последней страницы нет ссылки на следующую страницу.
-            # TODO - заменить предварительное сохранение и проверку "истинности" результата на обработку ошибок сети
-            # Рекурсивно проходим по всем доступным страницам выдачи, обновляя словарь Превьюшек персон ("Нотисов").
-            # TODO - больше не нужно, т.к. забираем всю доступную выдачу одним запросом без разбивки на страницы
-            next_page_response, total = get_notices(request=next_page['href'])
-            if next_page_response:       # Если результат не пуст (а он не должен быть пуст, если сеть доступна),
-                notices.update(next_page_response)   # то расширяем словарь "нотисов".
+        if planner and output_dict is not None and not split:
+            planner.record_leaf(notice_type, nation, gender, min_age, max_age, total)
+        metrics.inc('search_queries_total', result=get_search_result(output_dict, split))
+        if state and output_dict is not None:
+            # Неудачные запросы не отмечаем, чтобы следующий запуск их повторил
+            state.save_search_node(notice_type, nation, gender, min_age, max_age, split=split, total=total,
+                                   notices=notices, sub_ranges=sub_ranges if split else None)
+        yield from notices.items()  # Пустой словарь тоже обработается без ошибок и в рекурсии, и в вызывающем коде
+
+    if split:
+        for sub_min_age, sub_max_age in sub_ranges:
+            yield from iter_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, keyword=keyword,
+                                    limit=limit, min_age=sub_min_age, max_age=sub_max_age, client=client,
+                                    state=state, planner=planner)
+
+
+def get_search_result(output_dict, split: bool) -> str:
+    """
+    Итог поискового запроса для метрик: `saturated` - выдача уперлась в лимит и диапазон делится дальше,
+    `leaf` - лист дерева поиска, `failed` - запрос не удался.
+    """
+    if output_dict is None:
+        return 'failed'
+    return 'saturated' if split else 'leaf'
 
-    return notices  # Пустой словарь тоже обработается без ошибок как в рекурсии, так и в вызывающем коде
+
+def get_notices(url='', notice_type='', nation='', gender='', keyword='', request='', limit=0,
+                age=0, min_age=0, max_age=0, client: HttpClient = None, state: StateStore = None,
+                planner: AgePlanner = None) -> dict:
+    """
+    Формирует словарь Превьюшек с базовыми данными для всех Персон, подходящих под фильтр.
+    Параметры те же, что и у `iter_notices()`.
+    :return: Словарь: Ключ - `entity_id`, Значение - Словарь с краткими сведениями о найденной персоне.
+    """
+    return dict(iter_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, keyword=keyword,
+                             request=request, limit=limit, age=age, min_age=min_age, max_age=max_age, client=client,
+                             state=state, planner=planner))
+
+
+def iter_planned_notices(url: str, notice_type: str, nation: str, gender: str, limit: int, min_age: int,
+                         max_age: int, client: HttpClient = None, state: StateStore = None,
+                         planner: AgePlanner = None):
+    """
+    Выдает все превью Персон для комбинации фильтров, начиная не со всего возрастного диапазона,
+    а с диапазонов, предложенных планировщиком по гистограмме прошлого запуска.
+    :return: Генератор пар (`entity_id`, Словарь с краткими сведениями о найденной персоне), как у `iter_notices()`.
+    """
+    age_ranges = planner.plan(notice_type, nation, gender, min_age, max_age) if planner else [[min_age, max_age]]
+    for plan_min_age, plan_max_age in age_ranges:
+        yield from iter_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, limit=limit,
+                                min_age=plan_min_age, max_age=plan_max_age, client=client, state=state,
+                                planner=planner)
+
+
+def get_planned_notices(url: str, notice_type: str, nation: str, gender: str, limit: int, min_age: int, max_age: int,
+                        client: HttpClient = None, state: StateStore = None, planner: AgePlanner = None) -> dict:
+    """
+    Собирает все превью Персон для комбинации фильтров в словарь. Параметры те же, что и у `iter_planned_notices()`.
+    :return: Словарь: Ключ - `entity_id`, Значение - Словарь с краткими сведениями о найденной персоне.
+    """
+    return dict(iter_planned_notices(url=url, notice_type=notice_type, nation=nation, gender=gender, limit=limit,
+                                     min_age=min_age, max_age=max_age, client=client, state=state, planner=planner))
+
+
+def get_search_url(url: str, notice_type: str, nation: str, gender: str, min_age: int, max_age: int,
+                   limit: int) -> str:
+    """
+    Собирает поисковый запрос к API из параметров фильтра. Используется как синхронным, так и асинхронным обходом.
+    :return: Строка запроса.
+    """
+    return f'{url}{notice_type}?' \
+           f'nationality={nation}&' \
+           f'sexId={gender}&' \
+           f'ageMin={min_age}&ageMax={max_age}&' \
+           f'resultPerPage={limit}'      # &freeText={keyword} - Ключевой запрос больше не используем.
 
 
 def get_age_ranges(min_age: int, max_age: int) -> list:
@@ -104,100 +225,861 @@ def get_age_ranges(min_age: int, max_age: int) -> list:
         return []       # Если поймаем непредвиденный случай - то получим ошибку при распаковке пустого словаря.
 
 
-if __name__ == '__main__':
-    settings = Settings()
-    print(f"Гражданство: {settings.nations}\n"
-          f"Пол: {settings.genders}\n"
-          f"Минимальный возраст: {settings.min_age}\n"
-          f"Максимальный возраст: {settings.max_age}\n"
-          f"Только Превью: {settings.preview_only}")
+def save_person(output: TreeOutput, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                pipeline: ImagePipeline = None, on_done=None, on_images=None, unchanged: bool = False) -> None:
+    """
+    Ставит все фото Персоны в очередь потоковой загрузки, после чего выгружает ее данные в формат вывода.
+    :param output: Формат вывода из `create_output()`.
+    :param page_id: Тип поисковой страницы: `red`, `yellow`.
+    :param nation: ID гражданства из фильтра.
+    :param nation_name: Название государства.
+    :param person_result_path: Путь к папке Персоны формата 'result/red/Zimbabwe/1990-8402/'.
+    :param person: Объект `PersonDetail` или `PersonPreview`.
+    :param pipeline: Этап загрузки картинок. Если не передан - фото скачиваются сразу, в текущем потоке.
+    :param on_done: Функция, которая получит словарь сохраненных фото, когда данные Персоны будут записаны на диск.
+    Не вызывается, если часть фото скачать не удалось: такую Персону продолженный обход загрузит снова.
+    :param on_images: Функция, которая получит словарь сохраненных фото и количество неудачных загрузок
+    сразу после загрузки фото, до записи данных Персоны.
+    :param unchanged: Персона не изменилась с прошлого обхода (дельта-синхронизация), ее данные не перезаписываются.
+    :return: None
+    """
+    def on_images_saved(images: dict, failed: int) -> None:
+        person.images = images
+        if on_images:
+            on_images(images, failed)
+        write_person(output, page_id, nation, nation_name, person_result_path, person,
+                     on_saved=functools.partial(on_done, images) if on_done and not failed else None,
+                     unchanged=unchanged and not failed)
+
+    if not pipeline:
+        pipeline = ImagePipeline(client=person.client, workers=0)
+    pipeline.submit(directory=output.get_image_dir(person_result_path), image_links=person.image_links,
+                    on_done=on_images_saved)
+
+
+def get_dedup_uses(settings: Settings, notice_preview_json: dict) -> int:
+    """Сколько раз Персона встретится за обход: по одному разу на каждое ее гражданство из фильтра обхода."""
+    nations = notice_preview_json.get('nationalities') or []
+    return len([nation for nation in nations if not settings.nations or nation in settings.nations])
+
+
+def get_dedup_value(person) -> dict:
+    """Данные Персоны для `DedupIndex`, из которых `restore_person()` соберет ее без запросов к серверу."""
+    value = {'images': {name: str(path) for name, path in person.images.items()}}
+    if hasattr(person, 'detail_json'):
+        value.update(detail_json=person.detail_json, images_list=person.images_list)
+    return value
+
+
+def restore_person(value: dict, notice_preview_json: dict, client: HttpClient):
+    """Собирает Персону, уже загруженную по другому гражданству, из данных `get_dedup_value()`."""
+    if 'detail_json' not in value:
+        return PersonPreview(person_preview_data=notice_preview_json, client=client)
+    return PersonDetail.from_data(person_detail_url=notice_preview_json['_links']['self']['href'],
+                                  images_url=notice_preview_json['_links']['images']['href'],
+                                  detail_json=value['detail_json'], images_list=value['images_list'], client=client)
+
+
+def save_person_copy(output: TreeOutput, page_id: str, nation: str, nation_name: str, person_result_path: Path,
+                     person, images: dict, on_done=None, unchanged: bool = False) -> None:
+    """
+    Сохраняет Персону, уже загруженную по другому гражданству. Фото не скачиваются, а связываются жесткими
+    ссылками с фото первой копии.
+    :param images: Словарь сохраненных фото первой копии {`имя_файла`: путь}.
+    :param unchanged: Персона не изменилась с прошлого обхода, ее данные не перезаписываются.
+    """
+    directory = output.get_image_dir(person_result_path)
+    person.images = {name: link_file(Path(path), Path(directory, name)) if directory else Path(path)
+                     for name, path in images.items()}
+    write_person(output, page_id, nation, nation_name, person_result_path, person,
+                 on_saved=functools.partial(on_done, person.images) if on_done else None, unchanged=unchanged)
+
+
+def finish_dedup(dedup: DedupIndex, key: str, person, images: dict, failed: int) -> None:
+    """
+    Передает загруженную Персону ожидающим копиям. Если часть фото не скачана - копии получают ошибку и загружают
+    Персону сами, каждая в своем запросе, поэтому неудача снова учтется в полноте выдачи ее комбинации.
+    """
+    if failed:
+        dedup.fail(key, RuntimeError(f'Не все фото Персоны `{key}` скачаны'))
+    else:
+        person.images = images
+        dedup.finish(key, get_dedup_value(person))
+
+
+def write_person(output: TreeOutput, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                 on_saved=None, unchanged: bool = False) -> None:
+    """
+    Выгружает данные Персоны в формат вывода. Данные, не изменившиеся с прошлого обхода, уже записаны
+    и повторно не пишутся: сразу вызывается `on_saved`.
+    """
+    metrics.inc('persons_total', kind='detail' if hasattr(person, 'detail_json') else 'preview',
+                result='unchanged' if unchanged else 'saved')
+    if not unchanged:
+        output.save_person(page_id, nation, nation_name, person_result_path, person, on_saved=on_saved)
+    elif on_saved:
+        on_saved()
+
+
+def get_on_done(state: StateStore, delta: DeltaIndex, page_id: str, nation: str, nation_name: str, gender: str,
+                image_dir, person) -> tuple:
+    """
+    Готовит отметку Персоны сохраненной в хранилище состояния и в снимке дельта-синхронизации. Фото, сохраненные
+    в прошлом обходе, помечаются в `person.image_links` именами их файлов, чтобы не скачивать их заново.
+    :param image_dir: Папка фото Персоны из `output.get_image_dir()`.
+    :param person: Объект `PersonDetail` или `PersonPreview`, фото которого еще не скачаны.
+    :return: Кортеж (функция `on_done` для `save_person()` или `None`, `True`, если Персона не изменилась
+    с прошлого обхода).
+    """
+    data = person.detail_json if hasattr(person, 'detail_json') else person.preview_json
+    entity_id = data['entity_id']
+    on_done = functools.partial(state.save_person, page_id, nation, entity_id) if state else None
+    if not delta:
+        return on_done, False
+
+    fingerprint = DeltaIndex.get_fingerprint(data, [image_link.url for image_link in person.image_links])
+    previous = delta.get_person(page_id, nation, entity_id)
+    if not previous or previous['removed']:
+        change, pictures = 'added', {}
+    else:
+        change = 'unchanged' if previous['fingerprint'] == fingerprint else 'updated'
+        pictures = previous['pictures']
+        person.image_links = [image_link._replace(file_name=pictures.get(image_link.url))
+                              for image_link in person.image_links]
+    return functools.partial(save_delta_person, delta, page_id, nation, entity_id, nation_name, gender, image_dir,
+                             person, fingerprint, pictures, change, on_done), change == 'unchanged'
+
+
+def save_delta_person(delta: DeltaIndex, page_id: str, nation: str, entity_id: str, nation_name: str, gender: str,
+                      image_dir, person, fingerprint: str, previous: dict, change: str, on_done, images: dict) -> None:
+    """
+    Обновляет Персону в снимке дельта-синхронизации после сохранения всех ее файлов. Фото, которых у Персоны
+    больше нет, удаляются из ее папки. Неизмененная Персона в снимке не обновляется.
+    :param previous: Фото Персоны из прошлого обхода {адрес фото: имя файла}.
+    :param change: `added`, `updated` или `unchanged`.
+    :param on_done: Отметка Персоны в хранилище состояния или `None`.
+    :param images: Словарь сохраненных фото {`имя_файла`: путь}.
+    """
+    if change != 'unchanged':
+        files = {file_name.split('.', 1)[0]: file_name for file_name in images}    # Файл фото - `имя.расширение`
+        pictures = {image_link.url: files[image_link.name] for image_link in person.image_links
+                    if image_link.name in files}
+        if image_dir:
+            for file_name in previous.values():
+                if file_name not in images:
+                    Path(image_dir, file_name).unlink(missing_ok=True)
+        delta.save_person(page_id, nation, entity_id, nation_name, gender, fingerprint, pictures, change)
+    if on_done:
+        on_done(images)
+
+
+def is_known(delta: DeltaIndex, page_id: str, nation: str, entity_id: str) -> bool:
+    """Персона есть в снимке дельта-синхронизации и не отмечена удаленной."""
+    previous = delta.get_person(page_id, nation, entity_id) if delta else None
+    return bool(previous) and not previous['removed']
+
+
+def get_thumbnail_db(settings: Settings) -> Path:
+    """
+    Файл очереди отложенных миниатюр. Очередь всегда на диске: иначе неудачные миниатюры пропали бы с концом
+    запуска, и их нельзя было бы догрузить `--thumbnails` или при объединении шардов. Если `thumbnail_db` пуст -
+    файл лежит в папке результатов, как хранилище фото форматов `jsonl` и `sqlite`.
+    """
+    return Path(settings.thumbnail_db) if settings.thumbnail_db else Path(settings.result_dir, 'thumbnails.sqlite')
+
+
+def open_thumbnails(settings: Settings, client: HttpClient, output: TreeOutput, resume: bool = True):
+    """
+    Запускает фоновую загрузку отложенных миниатюр по параметру `preview_thumbnails`.
+    :param resume: Сразу поставить в загрузку миниатюры, оставшиеся в очереди от прошлых запусков. Процессы обхода
+    по шардам их не берут: очередь общая, и оставшиеся миниатюры догружаются при объединении результатов.
+    :return: Объект `ThumbnailFetcher` или `None`, если миниатюры не откладываются.
+    """
+    if settings.preview_thumbnails not in ('deferred', 'inline', 'none'):
+        raise ValueError(f'Unknown preview_thumbnails mode `{settings.preview_thumbnails}`')
+    if not settings.preview_only or settings.preview_thumbnails != 'deferred':
+        return None
+    thumbnails = ThumbnailFetcher(ThumbnailQueue(get_thumbnail_db(settings)), output, client=client,
+                                  workers=settings.image_workers)
+    if resume:
+        resumed = thumbnails.resume()
+        if resumed:
+            logger.info(f'Миниатюр из прошлых запусков поставлено в загрузку: {resumed}')
+    return thumbnails
+
+
+def defer_thumbnails(settings: Settings, thumbnails: ThumbnailFetcher, page_id: str, nation: str, nation_name: str,
+                     person_result_path: Path, person, unchanged: bool = False):
+    """
+    Убирает миниатюру из сохранения Превью, чтобы запись Персоны не ждала ее загрузки. В режиме `deferred`
+    миниатюра скачивается в фоне и дописывается к уже сохраненной записи, в режиме `none` не скачивается совсем.
+    В режиме `inline` и для детальных данных ничего не делает.
+    Вызывается после `get_on_done()`: отпечаток дельта-синхронизации учитывает адрес миниатюры.
+    :param unchanged: Превью не изменилось с прошлого обхода, его миниатюра уже скачана или ждет в очереди.
+    :return: Функция без аргументов, которая ставит миниатюру в загрузку, или `None`, если загружать нечего.
+    Вызывать после сохранения Превью: запись с миниатюрой должна попасть в формат вывода позже записи без нее.
+    """
+    if not settings.preview_only or settings.preview_thumbnails == 'inline' or hasattr(person, 'detail_json'):
+        return None
+    submit = None
+    if thumbnails and person.image_links and not unchanged:
+        submit = functools.partial(thumbnails.submit, page_id, nation, nation_name, person_result_path,
+                                   person.preview_json)
+    person.image_links = []
+    return submit
+
+
+def get_pages(settings: Settings) -> dict:
+    """
+    Поисковые страницы для обхода. Если в задаче появятся другие типы, вроде `purple`, `blue` - то их добавление
+    ограничивается файлом настроек.
+    :return: Словарь: Ключ - тип страницы (`red`, `yellow`), Значение - адрес страницы.
+    """
+    # Если параметр `search_pages_id` заполнен - обходим только перечисленные в нем типы страниц
+    return {page_id: page_url for page_id, page_url in settings.search_pages_urls.items()
+            if not settings.search_pages_id or page_id in settings.search_pages_id}
+
+
+def get_notice_page(settings: Settings, page_url: str, client: HttpClient) -> NoticePage:
+    """Объект поисковой страницы. Фильтры страницы берутся из файла `page_meta`, пока они свежее `page_meta_ttl`."""
+    return NoticePage(url=page_url, client=client, meta_path=settings.page_meta, meta_ttl=settings.page_meta_ttl)
+
+
+def get_queries(settings: Settings, page_object: NoticePage) -> list:
+    """
+    Все комбинации фильтров (гражданство, пол) поисковой страницы в пределах настроек.
+    :return: Список кортежей (гражданство, пол).
+    """
+    '''
+    Использовать параметры объекта настроек нагляднее, но перехватить ошибки битого файла настроек проще
+    с использованием словаря параметров: nations = settings.data.get('nations', page_object.nationalities)
+    или же перехватывать ошибки с присвоением: nations = getattr(settings, 'nations', page_object.nationalities)
+    '''
+    # Если фильтры заданы при запуске - используем их. Иначе, используем все доступные варианты со страницы.
+    nations = settings.nations if settings.nations else page_object.nationalities
+    genders = settings.genders if settings.genders else page_object.genders
+    # Если задано несуществующее значение Гражданства или Пола, то пропускаем комбинацию
+    return [(nation, gender) for nation, gender in itertools.product(nations, genders)
+            if nation in page_object.nationalities and gender in page_object.genders]
 
-    for page_id, page_url in settings.search_pages_urls.items():
+
+def crawl_query(settings: Settings, client: HttpClient, state: StateStore, planner: AgePlanner,
+                pipeline: ImagePipeline, output: TreeOutput, page_id: str, page_object: NoticePage, nation: str,
+                gender: str, dedup: DedupIndex = None, delta: DeltaIndex = None,
+                thumbnails: ThumbnailFetcher = None, skip_known: bool = False) -> None:
+    """
+    Обходит одну комбинацию фильтров (тип страницы, гражданство, пол) и ставит в очередь сохранения всех найденных
+    Персон. Это единица работы при обходе по шардам.
+    :param dedup: Индекс уже загруженных Персон. Персона с несколькими гражданствами загружается один раз.
+    :param delta: Снимок прошлых обходов. Если передан - скачиваются только новые фото, а неизмененные данные
+    Персон не перезаписываются.
+    :param thumbnails: Фоновая загрузка отложенных миниатюр Превью из `open_thumbnails()`.
+    :param skip_known: Загружать только Персон, которых нет в снимке `delta` (поисковый цикл службы `--daemon`).
+    Пропущенные Персоны все равно отмечаются найденными, поэтому удаленные определяются по полной выдаче.
+    """
+    '''
+    Персоны загружаются по мере получения листов дерева поиска, не дожидаясь остальных запросов. Дубли, связанные
+    с соответствием одной персоны нескольким словарным ключам или выдачей сервера, отсекаем по уже встреченным ID.
+    '''
+    seen = set()    # ID найденных Персон текущего запроса. Сами превью в памяти не копятся.
+    nation_name = page_object.nationalities[nation]
+    failed = client.scheduler.stats['failed'] if client.scheduler else 0
+
+    # TODO - оценить необходимость доп. фильтрации по ключевым запросам.
+    '''
+    if notices_total >= settings.notices_limit:
         """
-        Главный цикл, который проходит по списку ключей поисковых страниц: `red`, `yellow`.
-        Если в задаче появятся другие типы, вроде `purple`, `blue` - то их добавление ограничивается файлом настроек.
+        В случае, если запрос без ключа дает нам больше 160 результатов, мы создаем дополнительные запросы
+        ключами и пересобираем данные уже по ним. Результатом является словарь - это избавит от дублей.
         """
-        if settings.search_pages_id and page_id not in settings.search_pages_id:
-            # Если параметр заполнен И текущий `page_id` НЕ содержится в параметре - то пропускаем этот тип страниц.
+        for keyword in settings.keywords[page_id]:
+            print(f'Using the key `{keyword}` for request')
+            search_notices, _ = get_notices(url=settings.request_url, notice_type=page_id,
+                                            nation=nation, gender=gender, age=age, keyword=keyword)
+            result_notices.update(search_notices)
+    '''
+
+    for notice_id, notice_preview_json in iter_planned_notices(url=settings.request_url, notice_type=page_id,
+                                                               nation=nation, gender=gender,
+                                                               limit=settings.notices_limit,
+                                                               min_age=settings.min_age, max_age=settings.max_age,
+                                                               client=client, state=state, planner=planner):
+        # Забираем айдишник каждой Персоны и содержимое ее Превью, как только получен лист с ней
+        if notice_id in seen:
             continue
-        page_object = NoticePage(url=page_url)      # Создаем объект поисковой страницы нужного типа.
+        seen.add(notice_id)
+        if state and state.is_person_done(page_id, nation, notice_id):
+            continue    # Персона полностью сохранена в прерванном запуске
+        if skip_known and is_known(delta, page_id, nation, notice_id):
+            continue    # Изменения данных уже известных Персон ищет полный обход
+        # Генерим ссылку для выгрузки данных формата 'result/red/Zimbabwe/1990-8402/'.
+        # Имя файла добавим позже.
+        person_result_path = Path(settings.result_dir,
+                                  page_id,
+                                  nation_name,
+                                  notice_id.replace('/', '-'))
 
-        print(f'Page `{page_id}` get_status: {page_object.get_status()}')
-        '''
-        Использовать параметры объекта настроек нагляднее, но перехватить ошибки битого файла настроек проще
-        с использованием словаря параметров: nations = settings.data.get('nations', page_object.nationalities)
-        или же перехватывать ошибки с присвоением: nations = getattr(settings, 'nations', page_object.nationalities)
-        '''
-        # Если фильтры заданы при запуске - используем их. Иначе, используем все доступные варианты со страницы.
-        nations = settings.nations if settings.nations else page_object.nationalities
-        genders = settings.genders if settings.genders else page_object.genders
-
-        # for nation, gender, age in itertools.product(nations, genders, range(settings.min_age, settings.max_age+1)):
-        for nation, gender in itertools.product(nations, genders):
-            '''
-            Цикл по всем вариациям фильтров в заданных пределах. Сохраняем результаты в промежуточный словарь.
-            Это позволит избавиться от неизбежно возникающих дублей, связанных с соответствием одной персоны
-            нескольким словарным ключам (где они используются для поиска).
-            '''
-            # Предварительно сохраняем данные в словарь, чтобы исключить дубли, которые могут образоваться после
-            # применения запросов с ключами. Уже после передаем словарь в функцию, которая вытаскивает
-            # более полные сведения по запросу
-            # Ключ - ID уведомления, значение - json
-            result_notices = {}  # Тут копятся краткие сведения всех найденных персон для текущего запроса.
-
-            # Итерируемся по всем комбинациям фильтров в пределах заданного диапазона возрастов
-            if nation not in page_object.nationalities or gender not in page_object.genders:
-                # Если задано несуществующее значение Гражданства или Пола, то пропускаем итерацию
+        # Персону с несколькими гражданствами загружаем только при первой встрече, остальные копии берут ее данные
+        key = f'{page_id}/{notice_id}'
+        uses = get_dedup_uses(settings, notice_preview_json) if dedup else 0
+        future = value = None
+        if uses > 1:
+            future, owner = dedup.begin(key, uses=uses)
+            if not owner:
+                try:
+                    value = future.result()     # Ждем, если фото первой копии еще скачиваются
+                except Exception as e:
+                    # Первая копия не загрузилась - эта копия загружает Персону сама, без индекса
+                    logger.warning(f'Person `{key}` is loaded again: {e}')
+                    value = future = None
+            if value is not None:
+                person = restore_person(value, notice_preview_json, client)
+                on_done, unchanged = get_on_done(state, delta, page_id, nation, nation_name, gender,
+                                                 output.get_image_dir(person_result_path), person)
+                submit_thumbnail = defer_thumbnails(settings, thumbnails, page_id, nation, nation_name,
+                                                    person_result_path, person, unchanged)
+                save_person_copy(output=output, page_id=page_id, nation=nation, nation_name=nation_name,
+                                 person_result_path=person_result_path, person=person, images=value['images'],
+                                 on_done=on_done, unchanged=unchanged)
+                if submit_thumbnail:
+                    submit_thumbnail()
                 continue
 
-            # Получаем все результаты по запросу и их общее количество
-            search_notices = get_notices(url=settings.request_url, notice_type=page_id,
-                                         nation=nation, gender=gender,
-                                         limit=settings.notices_limit,
-                                         min_age=settings.min_age, max_age=settings.max_age)
+        if settings.preview_only:
+            person = PersonPreview(person_preview_data=notice_preview_json, client=client)
+        else:
+            person_detail_url = notice_preview_json['_links']['self']['href']
+            images_url = notice_preview_json['_links']['images']['href']
 
-            # if notices_total < 160:
-            result_notices.update(search_notices)
+            try:
+                person = PersonDetail(person_detail_url=person_detail_url, images_url=images_url, client=client)
+            except Exception as e:
+                # Персона не отмечается в состоянии, продолженный обход запросит ее снова
+                logger.error(f'Person `{key}` is not loaded: {e}')
+                if future:
+                    dedup.fail(key, e)
+                continue
+
+        # Отмечаем Персону в хранилище состояния и снимке только после сохранения всех ее файлов
+        on_done, unchanged = get_on_done(state, delta, page_id, nation, nation_name, gender,
+                                         output.get_image_dir(person_result_path), person)
+        submit_thumbnail = defer_thumbnails(settings, thumbnails, page_id, nation, nation_name, person_result_path,
+                                            person, unchanged)
+        save_person(output=output, page_id=page_id, nation=nation, nation_name=nation_name,
+                    person_result_path=person_result_path, person=person, pipeline=pipeline, on_done=on_done,
+                    on_images=functools.partial(finish_dedup, dedup, key, person) if future else None,
+                    unchanged=unchanged)
+        if submit_thumbnail:
+            submit_thumbnail()     # Только после записи Превью, иначе она заменит запись с миниатюрой
+
+    logger.info(f'Total notices in Result: {len(seen)}',
+                extra={'page_id': page_id, 'nation': nation, 'gender': gender, 'notices': len(seen)})
+    if delta:
+        # Пропавших Персон `finish_delta()` ищет только в выдаче, полученной без неудачных запросов
+        delta.mark_seen(page_id, nation, gender, seen,
+                        complete=not client.scheduler or client.scheduler.stats['failed'] == failed)
+
+
+def populate_queue(settings: Settings, client: HttpClient, queue: WorkQueue) -> dict:
+    """
+    Заполняет очередь шардами всех поисковых страниц, если этого еще не сделал другой процесс.
+    :return: Словарь загруженных поисковых страниц: Ключ - тип страницы, Значение - объект `NoticePage`.
+    """
+    pages = {}
+    if queue.is_populated():
+        return pages
+    items = []
+    for page_id, page_url in get_pages(settings).items():
+        page_object = get_notice_page(settings, page_url, client)
+        logger.info(f'Page `{page_id}` get_status: {page_object.get_status()}')
+        if page_object.get_status() != 200:
+            # Без фильтров страницы очередь получилась бы неполной, а повторно она не заполняется
+            raise RuntimeError(f'Page `{page_id}` is unavailable, work queue is not populated')
+        pages[page_id] = page_object
+        items += [(page_id, nation, gender) for nation, gender in get_queries(settings, page_object)]
+    queue.populate(items)
+    logger.info(f'Очередь заполнена: шардов {len(items)}')
+    return pages
+
+
+def crawl_queue(settings: Settings, client: HttpClient, state: StateStore, planner: AgePlanner,
+                pipeline: ImagePipeline, output: TreeOutput, queue: WorkQueue, worker_id: str,
+                dedup: DedupIndex = None, delta: DeltaIndex = None, thumbnails: ThumbnailFetcher = None) -> None:
+    """
+    Берет шарды из общей очереди, пока они не закончатся. Шард отмечается выполненным, только когда все его Персоны
+    записаны на диск. Если часть запросов шарда не удалась и после всех повторов - шард возвращается в очередь.
+    """
+    pages = populate_queue(settings, client, queue)
+    while True:
+        shard = queue.claim(worker_id)
+        if shard is None:
+            break
+        page_id, nation, gender = shard['page_id'], shard['nation'], shard['gender']
+        if page_id not in pages:
+            pages[page_id] = get_notice_page(settings, settings.search_pages_urls[page_id], client)
+        logger.info(f"Shard {shard['id']}: {page_id}/{nation}/{gender}", extra={'shard': shard['id']})
+        failed = client.scheduler.stats['failed'] if client.scheduler else 0
+        try:
+            with queue.keep_alive(shard['id'], worker_id):
+                crawl_query(settings=settings, client=client, state=state, planner=planner, pipeline=pipeline,
+                            output=output, page_id=page_id, page_object=pages[page_id], nation=nation,
+                            gender=gender, dedup=dedup, delta=delta, thumbnails=thumbnails)
+                pipeline.flush()
+                output.flush()
+        except BaseException:
+            queue.release(shard['id'], worker_id)
+            raise
+        if client.scheduler and client.scheduler.stats['failed'] > failed:
+            queue.release(shard['id'], worker_id)
+        else:
+            queue.complete(shard['id'], worker_id)
+
+
+def get_part(shard: tuple = None, worker_id: str = None):
+    """Идентификатор части результатов процесса при обходе по шардам или `None` для обычного обхода."""
+    if worker_id:
+        return worker_id
+    if shard:
+        return f'shard-{shard[0]}-of-{shard[1]}'
+    return None
+
+
+def iter_queries(settings: Settings, client: HttpClient, shard: tuple = None):
+    """
+    Все комбинации фильтров обхода по порядку поисковых страниц. Страница загружается, только когда до нее дошла
+    очередь.
+    :param shard: Статический шард (номер шарда от `1`, количество шардов). Если передан - только его комбинации.
+    :return: Генератор кортежей (тип страницы, объект `NoticePage`, гражданство, пол).
+    """
+    for page_id, page_url in get_pages(settings).items():
+        # Главный цикл, который проходит по списку ключей поисковых страниц: `red`, `yellow`.
+        # Создаем объект поисковой страницы нужного типа.
+        page_object = get_notice_page(settings, page_url, client)
+        logger.info(f'Page `{page_id}` get_status: {page_object.get_status()}')
+
+        # for nation, gender, age in itertools.product(nations, genders,
+        #                                            range(settings.min_age, settings.max_age+1)):
+        for nation, gender in get_queries(settings, page_object):
+            # Цикл по всем вариациям фильтров в заданных пределах.
+            if shard and not in_shard(page_id, nation, gender, shard):
+                continue    # Комбинация относится к другому шарду
+            yield page_id, page_object, nation, gender
+
+
+def crawl(settings: Settings, client: HttpClient = None, state: StateStore = None, shard: tuple = None,
+          queue: WorkQueue = None, worker_id: str = None, planner: AgePlanner = None, queries: list = None,
+          skip_known: bool = False, dedup: DedupIndex = None):
+    """
+    Синхронный обход всех поисковых страниц, гражданств и полов в пределах заданных настроек.
+    :param settings: Объект настроек.
+    :param client: Общий HTTP-клиент. Если не передан - создается новый по параметрам из настроек.
+    :param state: Хранилище состояния для продолжения прерванного обхода. Если не передано - открывается по настройкам
+    и закрывается в конце обхода. Переданное хранилище остается открытым.
+    :param shard: Статический шард: кортеж (номер шарда от `1`, количество шардов). Обходятся только комбинации
+    фильтров этого шарда.
+    :param queue: Общая очередь шардов. Если передана - комбинации фильтров берутся из нее.
+    :param worker_id: Идентификатор процесса в очереди. Обязателен вместе с `queue`.
+    :param planner: Планировщик возрастных диапазонов. Если не передан - создается по файлу `age_histograms`.
+    :param queries: Комбинации фильтров в порядке обхода: список кортежей (тип страницы, объект `NoticePage`,
+    гражданство, пол). Если не переданы - обходятся все комбинации из `iter_queries()`.
+    :param skip_known: Загружать только Персон, которых нет в снимке дельта-синхронизации, см. `crawl_query()`.
+    :param dedup: Индекс уже загруженных Персон. Если не передан - создается по настройкам и закрывается в конце
+    обхода, как и `state`.
+    :return: Список изменений из `finish_delta()` или `None`.
+    """
+    if not client:
+        client = create_client(settings)
+    own_state, own_dedup = not state, not dedup     # Закрываем только то, что открыли сами
+    if own_state:
+        state = open_state_store(settings)
+    if own_dedup:
+        dedup = create_dedup(settings)
+    part = get_part(shard, worker_id)
+    if not planner:
+        planner = AgePlanner(histograms_path=settings.age_histograms, limit=settings.notices_limit)
+    pipeline = ImagePipeline(client=client, workers=settings.image_workers, queue_size=settings.image_queue_size)
+    output = create_output(settings, blobs=client.blobs, part=part)
+    delta = DeltaIndex(settings.delta_db) if settings.delta_db else None
+    thumbnails = open_thumbnails(settings, client, output, resume=not part)
+    changelog = None
+
+    try:
+        try:
+            if queue:
+                crawl_queue(settings=settings, client=client, state=state, planner=planner, pipeline=pipeline,
+                            output=output, queue=queue, worker_id=worker_id, dedup=dedup, delta=delta,
+                            thumbnails=thumbnails)
+            else:
+                for page_id, page_object, nation, gender in (queries if queries is not None
+                                                             else iter_queries(settings, client, shard)):
+                    crawl_query(settings=settings, client=client, state=state, planner=planner, pipeline=pipeline,
+                                output=output, page_id=page_id, page_object=page_object, nation=nation, gender=gender,
+                                dedup=dedup, delta=delta, thumbnails=thumbnails, skip_known=skip_known)
+            if thumbnails:
+                thumbnails.flush()      # Превью уже записаны, дожидаемся миниатюр, качающихся параллельно с поиском
+            if not part:
+                # Снимок обновляется по мере записи Персон, поэтому запуск завершаем, когда все очереди дописаны
+                pipeline.flush()
+                output.flush()
+                changelog = finish_delta(settings, delta, client, output)
+        finally:
+            # И при штатном завершении, и при прерывании (Ctrl-C) дописываем все, что уже стоит в очередях:
+            # скачанные Персоны попадут на диск и в хранилище состояния, и продолженный обход их не повторит.
+            pipeline.close()
+            if thumbnails:
+                thumbnails.close()      # До закрытия формата вывода: скачанные миниатюры дописываются в него
+            output.close()
+            if dedup and own_dedup:
+                dedup.close()
+            if delta:
+                delta.close()
+
+        planner.save()
+        if part:
+            # Состояние общее для всех процессов, поэтому очищается только при объединении результатов
+            logger.info(f'Часть результатов `{part}` записана. Объедините результаты командой `python main.py --merge`')
+        else:
+            finish_state(state, client)
+    finally:
+        if state and own_state:
+            state.close()
+    print_http_stats(client)
+    print_dedup_stats(dedup)
+    print_planner_stats(planner)
+    return changelog
+
+
+def open_state_store(settings: Settings):
+    """
+    Открывает хранилище состояния обхода по пути из настроек.
+    :return: Объект `StateStore` или `None`, если параметр `state_db` пуст.
+    """
+    if not settings.state_db:
+        return None
+    state = StateStore(settings.state_db)
+    done = state.count_persons()
+    if done:
+        logger.info(f'Продолжаем прерванный обход: уже сохранено Персон - {done}')
+    return state
+
+
+def finish_state(state: StateStore, client: HttpClient) -> None:
+    """
+    Очищает состояние после завершения обхода, чтобы следующий запуск начался заново. Если часть запросов
+    не удалась и после всех повторов - состояние сохраняется, и повторный запуск догрузит только пропущенное.
+    """
+    if not state:
+        return
+    if client.scheduler and client.scheduler.stats['failed']:
+        logger.warning(f"Неудачных запросов: {client.scheduler.stats['failed']}. "
+                       f"Состояние сохранено, повторный запуск догрузит пропущенные данные.")
+    else:
+        state.clear()
 
-            # TODO - оценить необходимость доп. фильтрации по ключевым запросам.
-            '''
-            if notices_total >= settings.notices_limit:
-                """
-                В случае, если запрос без ключа дает нам больше 160 результатов, мы создаем дополнительные запросы
-                ключами и пересобираем данные уже по ним. Результатом является словарь - это избавит от дублей.
-                """
-                for keyword in settings.keywords[page_id]:
-                    print(f'Using the key `{keyword}` for request')
-                    search_notices, _ = get_notices(url=settings.request_url, notice_type=page_id,
-                                                    nation=nation, gender=gender, age=age, keyword=keyword)
-                    result_notices.update(search_notices)
-            '''
-
-            # print(json.dumps(result_notices, indent=4))
-            # print(f'Total notices in Response: {notices_total}')
-            print(f'Total notices in Result: {len(result_notices)}')
-
-            for notice_id, notice_preview_json in result_notices.items():
-                # Теперь проходим по созданному словарю, забираем айдишники каждой Персоны и содержимое его Превью
-                # Генерим ссылку для выгрузки данных формата 'result/red/Zimbabwe/1990-8402/'. Имя файла добавим позже.
-                person_result_path = Path(settings.result_dir,
-                                          page_id,
-                                          page_object.nationalities[nation],
-                                          notice_id.replace('/', '-'))
-
-                if settings.preview_only:
-                    person = PersonPreview(person_preview_data=notice_preview_json)
-                else:
-                    person_detail_url = notice_preview_json['_links']['self']['href']
-                    images_url = notice_preview_json['_links']['images']['href']
-
-                    person = PersonDetail(person_detail_url=person_detail_url, images_url=images_url)
-
-                if hasattr(person, 'detail_json'):
-                    save_file(file_path=Path(person_result_path, 'detail.json'), file_data=person.detail_json)
-                else:
-                    save_file(file_path=Path(person_result_path, 'preview.json'), file_data=person.preview_json)
-
-                # Выгружаем все фото в папку Персоны
-                for image_name, image_raw in person.images.items():
-                    save_file(file_path=Path(person_result_path, image_name), file_data=image_raw)
+
+def finish_delta(settings: Settings, delta: DeltaIndex, client: HttpClient, output: TreeOutput):
+    """
+    Завершает запуск дельта-синхронизации: Персоны, пропавшие из выдачи, получают метку удаления в формате вывода,
+    а список добавленных, измененных и удаленных Персон записывается в папку `changelog` результатов.
+    Если часть запросов не удалась - запуск не завершается, и повторный запуск продолжит тот же список изменений.
+    :param client: HTTP-клиент обхода. `None` при объединении результатов процессов обхода по шардам.
+    :param output: Открытый формат вывода, в котором уже записаны все Персоны обхода.
+    :return: Список изменений из `DeltaIndex.finish()` или `None`, если запуск не завершен.
+    """
+    if not delta:
+        return None
+    if client and client.scheduler and client.scheduler.stats['failed']:
+        logger.warning('Список изменений не записан: повторный запуск продолжит его.')
+        return None
+    removed = delta.get_removed()
+    for person in removed:
+        person_result_path = Path(settings.result_dir, person['page_id'], person['nation_name'],
+                                  person['entity_id'].replace('/', '-'))
+        output.remove_person(person['page_id'], person['nation'], person['nation_name'], person_result_path,
+                             person['entity_id'])
+    output.flush()
+    changelog = delta.finish(removed)
+    changelog_name = time.strftime('%Y%m%d-%H%M%S', time.localtime(changelog['finished_at']))
+    changelog_path = Path(settings.result_dir, 'changelog', f'{changelog_name}.json')
+    save_file(changelog_path, changelog)
+    logger.info(f"Изменения с прошлого обхода: добавлено {len(changelog['added'])}, "
+                f"изменено {len(changelog['updated'])}, удалено {len(changelog['removed'])}. "
+                f"Список изменений: `{changelog_path}`")
+    return changelog
+
+
+def create_client(settings: Settings, pool_size: int = 0) -> HttpClient:
+    """
+    Создает общий HTTP-клиент по параметрам из настроек, с ограничением частоты и повторами запросов.
+    Если задан `cache_dir` - подключает дисковый кэш, если задан `blob_dir` или выбран формат вывода без папок
+    Персон - хранилище фото без дублей, если заданы `proxies` - пул прокси. Лимиты `rate_limit` и `pool_size`
+    относятся к одному выходу в сеть, поэтому с пулом прокси умножаются на количество прокси.
+    :param pool_size: Размер пула соединений, если он должен отличаться от `settings.pool_size`.
+    :return: Объект `HttpClient`.
+    """
+    cache = None
+    if settings.cache_dir:
+        cache = HttpCache(cache_dir=settings.cache_dir, max_size=int(settings.cache_max_size_mb * 1024 * 1024),
+                          ttl=settings.cache_ttl)
+    blob_dir = settings.blob_dir
+    if not blob_dir and settings.output_backend != 'tree':
+        blob_dir = Path(settings.result_dir, 'blobs')   # Форматы `jsonl` и `sqlite` хранят фото только в хранилище
+    blobs = BlobStore(blob_dir=blob_dir) if blob_dir else None
+    proxies = None
+    if settings.proxies:
+        proxies = ProxyPool(settings.proxies, pool_size=pool_size or settings.pool_size,
+                            eject_time=settings.proxy_eject_time)
+    routes = len(settings.proxies) if proxies else 1
+    scheduler = RequestScheduler(rate=settings.rate_limit * routes, burst=settings.rate_burst * routes,
+                                 retries=settings.retries, backoff_base=settings.backoff_base,
+                                 backoff_max=settings.backoff_max,
+                                 max_concurrency=(pool_size or settings.pool_size) * routes,
+                                 latency_target=settings.latency_target, host_pause=not proxies)
+    return HttpClient(pool_size=pool_size or settings.pool_size, timeout=settings.timeout, cache=cache, blobs=blobs,
+                      scheduler=scheduler, proxies=proxies)
+
+
+def create_dedup(settings: Settings):
+    """
+    Создает индекс уже загруженных Персон по параметрам `dedup` и `dedup_db` из настроек.
+    :return: Объект `DedupIndex` или `None`, если индекс отключен.
+    """
+    if not settings.dedup:
+        return None
+    return DedupIndex(db_path=settings.dedup_db or None)
+
+
+def print_dedup_stats(dedup: DedupIndex) -> None:
+    """Выводит, сколько загрузок Персон с несколькими гражданствами удалось не повторять."""
+    if dedup:
+        metrics.set_summary('dedup', dedup.stats)
+        logger.info(f"Персоны с несколькими гражданствами: загружено {dedup.stats['fetched']}, "
+                    f"взято из уже загруженных {dedup.stats['avoided']}")
+
+
+def print_planner_stats(planner: AgePlanner) -> None:
+    """Выводит количество поисковых запросов в сравнении с делением диапазонов пополам."""
+    bisection_requests = planner.count_bisection_requests()
+    metrics.set_summary('planner', {'requests': planner.requests, 'bisection_requests': bisection_requests})
+    logger.info(f'Поисковых запросов: {planner.requests}, '
+                f'при делении пополам потребовалось бы около {bisection_requests}')
+
+
+def print_http_stats(client: HttpClient) -> None:
+    """
+    Выводит количество запросов и открытых соединений, чтобы по логу было видно переиспользование соединений.
+    Итоговая статистика клиента, как и других `print_*_stats()`, попадает в раздел `summary` отчета с метриками.
+    """
+    stats = client.get_stats()
+    metrics.set_summary('http', stats)
+    logger.info(f"HTTP: запросов {stats['requests']}, открыто соединений {stats['connections']}")
+    if client.scheduler:
+        scheduler_stats = client.scheduler.stats
+        metrics.set_summary('scheduler', {**scheduler_stats, 'limits': client.scheduler.get_limits()})
+        logger.info(f"Повторы: перегрузок и сбоев {scheduler_stats['throttled']}, "
+                    f"повторов {scheduler_stats['retries']}, неудачных запросов {scheduler_stats['failed']}, "
+                    f"лимит параллельных запросов {client.scheduler.get_limits()}")
+    if client.proxies:
+        proxy_stats = client.proxies.get_stats()
+        metrics.set_summary('proxies', proxy_stats)
+        for proxy in proxy_stats:
+            latency = f"{proxy['latency']:.2f} с" if proxy['latency'] is not None else '-'
+            logger.info(f"Прокси {proxy['name']}: запросов {proxy['requests']}, ошибок {proxy['errors']}, "
+                        f"задержка {latency}, исключался {proxy['ejected']} раз"
+                        f"{', сейчас исключен' if proxy['is_ejected'] else ''}")
+    if client.cache:
+        cache_stats = client.cache.stats
+        metrics.set_summary('cache', cache_stats)
+        logger.info(f"Кэш: попаданий {cache_stats['hits']}, подтверждено сервером {cache_stats['revalidated']}, "
+                    f"промахов {cache_stats['misses']}, "
+                    f"сэкономлено {cache_stats['bytes_saved'] / 1024 / 1024:.1f} МБ")
+    if client.blobs:
+        blob_stats = client.blobs.stats
+        metrics.set_summary('blobs', blob_stats)
+        duplicates = blob_stats['duplicates'] + blob_stats['skipped']
+        logger.info(f"Фото: сохранено {blob_stats['files']}, новых уникальных {blob_stats['blobs']}, "
+                    f"дублей {duplicates} ({duplicates / max(blob_stats['files'], 1):.0%}), "
+                    f"из них не скачивалось {blob_stats['skipped']}, "
+                    f"сэкономлено на диске {blob_stats['bytes_saved'] / 1024 / 1024:.1f} МБ")
+
+
+def run_crawl(settings: Settings, shard: tuple = None, queue: WorkQueue = None, worker_id: str = None, **kwargs):
+    """
+    Запускает синхронный или асинхронный обход в зависимости от параметра `concurrency`. Во время обхода
+    собираются метрики: они периодически пишутся в файл `metrics_prometheus`, а в конце обхода, в том числе
+    прерванного, - в json-отчет `metrics_report`. Процессы обхода по шардам пишут каждый свои файлы.
+    :param kwargs: Остальные параметры `crawl()`: `client`, `planner`, `queries`, `skip_known`, `state`, `dedup`.
+    :return: Список изменений дельта-синхронизации или `None`.
+    """
+    part = get_part(shard, worker_id)
+    metrics.start(prometheus_path=get_metrics_path(settings.metrics_prometheus, part),
+                  interval=settings.metrics_interval, **({'part': part} if part else {}))
+    try:
+        if settings.concurrency:
+            # Асинхронный обход включается через настройки. Импортируем его здесь, т.к. модуль сам использует `main`.
+            from async_crawler import crawl_async
+            return crawl_async(settings, shard=shard, queue=queue, worker_id=worker_id, **kwargs)
+        return crawl(settings, shard=shard, queue=queue, worker_id=worker_id, **kwargs)
+    finally:
+        metrics.stop()
+        report_path = get_metrics_path(settings.metrics_report, part)
+        if report_path:
+            metrics.write_report(report_path)
+            logger.info(f'Отчет с метриками обхода: `{report_path}`')
+
+
+def get_worker_id() -> str:
+    """Идентификатор процесса в очереди шардов, уникальный и среди машин с общей файловой системой."""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def run_queue_worker(settings_path, worker_id: str = None) -> None:
+    """
+    Процесс обхода, который берет шарды из общей очереди, пока они не закончатся.
+    :param settings_path: Путь к файлу настроек. Передается путь, а не объект, т.к. функция запускается
+    в отдельном процессе.
+    :param worker_id: Идентификатор процесса. Если не задан - формируется из имени машины и PID.
+    """
+    setup_logging()
+    settings = Settings(settings_path)
+    setup_logging(settings.log_format, settings.log_level)     # Процесс запущен через `spawn` и лог не настроен
+    queue = WorkQueue(settings.work_queue, lease=settings.shard_lease)
+    try:
+        run_crawl(settings, queue=queue, worker_id=worker_id or get_worker_id())
+    finally:
+        queue.close()
+
+
+def run_queue_workers(settings: Settings, workers: int) -> None:
+    """Запускает `workers` процессов обхода по общей очереди и объединяет их результаты после завершения."""
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_queue_worker, args=(str(settings.path),)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Ctrl-C получают и дочерние процессы: дожидаемся, пока они допишут очереди и вернут свои шарды
+        for process in processes:
+            process.join()
+        raise
+    failed = [process.exitcode for process in processes if process.exitcode]
+    if failed:
+        logger.error(f'Процессов завершилось с ошибкой: {len(failed)}')
+    merge_results(settings)
+
+
+def merge_results(settings: Settings) -> None:
+    """
+    Объединяет части результатов процессов обхода по шардам. Если все шарды очереди выполнены - удаляет очередь
+    и очищает состояние, как после обычного обхода. Иначе состояние сохраняется, и повторный запуск с `--queue`
+    догрузит оставшиеся шарды. Запуск дельта-синхронизации тоже завершается только здесь.
+    """
+    logger.info(f'Объединено частей результатов: {merge_outputs(settings)}')
+    queue_path = Path(settings.work_queue) if settings.work_queue else None
+    if queue_path and queue_path.exists():
+        queue = WorkQueue(queue_path)
+        counts = queue.get_counts()
+        queue.close()
+        if counts['pending'] or counts['leased'] or counts['failed']:
+            logger.warning(f"Шарды не завершены: ожидают {counts['pending']}, в работе {counts['leased']}, "
+                           f"неудачных {counts['failed']}. Состояние сохранено, запустите обход с `--queue` еще раз.")
+            return
+        for path in (queue_path, Path(f'{queue_path}-wal'), Path(f'{queue_path}-shm')):
+            path.unlink(missing_ok=True)
+        logger.info(f"Все шарды выполнены: {counts['done']}. Очередь удалена.")
+    if settings.state_db:
+        state = StateStore(settings.state_db)
+        state.clear()
+        state.close()
+    if settings.delta_db:
+        client = create_client(settings)
+        output = create_output(settings, blobs=client.blobs)
+        delta = DeltaIndex(settings.delta_db)
+        try:
+            finish_delta(settings, delta, None, output)
+        finally:
+            output.close()
+            delta.close()
+            client.close()
+    run_thumbnails(settings)
+
+
+def run_thumbnails(settings: Settings) -> None:
+    """
+    Отдельный проход загрузки отложенных миниатюр (`--thumbnails`): догружает миниатюры, неудачные в прошлых
+    обходах, и миниатюры процессов обхода по шардам после объединения результатов.
+    """
+    if not settings.preview_only or settings.preview_thumbnails != 'deferred':
+        return
+    client = create_client(settings)
+    output = create_output(settings, blobs=client.blobs)
+    thumbnails = open_thumbnails(settings, client, output)
+    try:
+        thumbnails.flush()
+    finally:
+        thumbnails.close()
+        output.close()
+        client.close()
+
+
+def parse_shard(value: str) -> tuple:
+    """Разбирает аргумент `--shard` формата `i/N`."""
+    try:
+        index, count = (int(number) for number in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard must be `i/N`, got `{value}`')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'Shard number must be from 1 to {count}, got {index}')
+    return index, count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Парсер нарушителей и потерянных.')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='обойти только i-й из N статических шардов (комбинаций страница/гражданство/пол)')
+    parser.add_argument('--queue', action='store_true',
+                        help='брать шарды из общей очереди `work_queue`, пока они не закончатся')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help='запустить N процессов с `--queue` и объединить их результаты')
+    parser.add_argument('--worker-id', help='идентификатор процесса в очереди, по-умолчанию `имя машины-PID`')
+    parser.add_argument('--merge', action='store_true', help='объединить результаты процессов обхода по шардам')
+    parser.add_argument('--thumbnails', action='store_true',
+                        help='догрузить отложенные и неудачные миниатюры обхода `preview_only`')
+    parser.add_argument('--daemon', action='store_true',
+                        help='работать службой: поисковые и полные циклы синхронизации по расписанию')
+    parser.add_argument('--cycles', type=int, default=0, metavar='N',
+                        help='с `--daemon`: завершить службу после N циклов')
+    args = parser.parse_args()
+
+    setup_logging()     # Уровень и формат из настроек применяются, как только настройки загружены
+    settings = Settings()
+    setup_logging(settings.log_format, settings.log_level)
+    logger.info(f"Гражданство: {settings.nations}\n"
+                f"Пол: {settings.genders}\n"
+                f"Минимальный возраст: {settings.min_age}\n"
+                f"Максимальный возраст: {settings.max_age}\n"
+                f"Только Превью: {settings.preview_only}\n"
+                f"Параллельных запросов: {settings.concurrency}")
+
+    if args.merge:
+        merge_results(settings)
+    elif args.thumbnails:
+        run_thumbnails(settings)
+    elif args.daemon:
+        # Импортируем здесь, как и асинхронный обход: модуль службы сам использует `main`
+        from daemon import run_daemon
+        run_daemon(settings, max_cycles=args.cycles)
+    elif args.queue or args.workers:
+        work_queue = WorkQueue(settings.work_queue, lease=settings.shard_lease)
+        retried = work_queue.retry_failed()
+        work_queue.close()
+        if retried:
+            logger.info(f'Неудачных шардов возвращено в очередь: {retried}')
+        if args.workers:
+            run_queue_workers(settings, workers=args.workers)
+        else:
+            run_queue_worker(settings.path, worker_id=args.worker_id)
+    else:
+        run_crawl(settings, shard=args.shard)
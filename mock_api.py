@@ -0,0 +1,347 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+NATIONS = {'RU': 'Russia', 'US': 'United States', 'MX': 'Mexico', 'SV': 'El Salvador', 'AR': 'Argentina',
+           'IN': 'India', 'GT': 'Guatemala', 'CO': 'Colombia', 'PK': 'Pakistan', 'BR': 'Brazil', 'UA': 'Ukraine',
+           'TR': 'Turkey', 'DE': 'Germany', 'FR': 'France', 'CN': 'China'}
+GENDERS = {'M': 'Male', 'F': 'Female', 'U': 'Unknown'}
+PAGES = {'red': '/How-we-work/Notices/View-Red-Notices', 'yellow': '/How-we-work/Notices/View-Yellow-Notices'}
+RESULTS_LIMIT = 160     # Как и настоящий API, выдача не бывает больше 160 Персон, сколько бы их ни нашлось
+NAMES = ['IVANOV', 'GARCIA', 'LOPEZ', 'KHAN', 'SMITH', 'MARTINEZ', 'KOVAL', 'YILMAZ', 'MULLER', 'SILVA', 'WANG']
+FORENAMES = ['ALEKSANDR', 'JOSE', 'MARIA', 'ALI', 'JOHN', 'ANA', 'OLEKSANDR', 'MEHMET', 'HANS', 'LI', 'PEDRO']
+
+
+class Dataset:
+    """
+    Детерминированный набор Персон для `MockApi`. Распределение похоже на настоящее: гражданства неравномерны
+    (первые в списке встречаются гораздо чаще, поэтому их выдача упирается в лимит и делится по возрастам),
+    часть Персон имеет два гражданства, у Персон от 0 до нескольких фото.
+    """
+
+    def __init__(self, size: int, nations: int = 8, seed: int = 1, max_images: int = 3, image_size: int = 20 * 1024):
+        """
+        :param size: Количество Персон на каждый тип поисковой страницы.
+        :param nations: Сколько гражданств из `NATIONS` использовать.
+        :param seed: Зерно генератора. Одинаковые параметры дают одинаковый набор.
+        :param max_images: Максимальное количество фото Персоны.
+        :param image_size: Размер каждого фото в байтах.
+        """
+        generator = random.Random(seed)
+        self.nations = dict(list(NATIONS.items())[:max(1, min(nations, len(NATIONS)))])
+        self.image_size = image_size
+        codes = list(self.nations)
+        weights = [1 / (rank + 1) for rank in range(len(codes))]    # Закон Ципфа
+        today = date.today()
+        self.persons = {}       # {тип страницы: {entity_id: Персона}}
+        for page_id in PAGES:
+            persons = {}
+            for number in range(size):
+                nationalities = [generator.choices(codes, weights)[0]]
+                if generator.random() < 0.05:
+                    second = generator.choice(codes)
+                    if second not in nationalities:
+                        nationalities.append(second)
+                age = max(0, min(100, int(generator.gauss(38, 12))))
+                # Дата рождения соответствует возрасту на сегодня, как его считает фильтр настоящего API
+                birthday = today.replace(year=today.year - age) if (today.month, today.day) != (2, 29) \
+                    else today.replace(year=today.year - age, day=28)
+                entity_id = f'{2000 + number % 26}/{10000 + number}'
+                persons[entity_id] = {
+                    'entity_id': entity_id, 'name': generator.choice(NAMES), 'forename': generator.choice(FORENAMES),
+                    'sex_id': generator.choice(list(GENDERS)), 'nationalities': nationalities, 'age': age,
+                    'date_of_birth': (birthday - timedelta(days=generator.randint(0, 360))).strftime('%Y/%m/%d'),
+                    'pictures': [f'{page_id[0]}{number}{index}' for index in range(generator.randint(0, max_images))]}
+            self.persons[page_id] = persons
+
+    def count_expected(self) -> int:
+        """Сколько Персон сохранит полный обход: Персона сохраняется по разу на каждое свое гражданство."""
+        return sum(len(person['nationalities']) for persons in self.persons.values() for person in persons.values())
+
+    def search(self, page_id: str, query: dict) -> tuple:
+        """
+        Поиск по фильтрам настоящего API: `nationality`, `sexId`, `ageMin`, `ageMax`.
+        :return: Кортеж (общее количество найденных Персон, Персоны в выдаче не больше `resultPerPage`).
+        """
+        min_age = int(query.get('ageMin') or 0)
+        max_age = int(query.get('ageMax') or 200)
+        found = [person for person in self.persons[page_id].values()
+                 if (not query.get('nationality') or query['nationality'] in person['nationalities'])
+                 and (not query.get('sexId') or query['sexId'] == person['sex_id'])
+                 and min_age <= person['age'] <= max_age]
+        limit = min(int(query.get('resultPerPage') or 20), RESULTS_LIMIT)
+        return len(found), found[:limit]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов `MockApi`. Пути повторяют настоящие `www.interpol.int` и `ws-public.interpol.int`."""
+    protocol_version = 'HTTP/1.1'     # Keep-alive, как у настоящего сервера
+    wbufsize = 64 * 1024        # Заголовки и тело уходят одним пакетом, без задержек Nagle
+
+    def log_message(self, *args):
+        pass    # Журнал каждого запроса замедлил бы сервер
+
+    def send_body(self, body, content_type: str = 'application/json', status: int = 200, headers: dict = None):
+        """
+        Отправляет ответ. Успешный ответ получает валидаторы `ETag` и `Last-Modified`, как у настоящего сервера,
+        и если условный запрос подтверждает закэшированную копию - вместо тела уходит `304`.
+        """
+        if not isinstance(body, bytes):
+            body = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        headers = dict(headers or {})
+        if status == 200:
+            api = self.server.api
+            headers.update({'ETag': f'"{hashlib.sha1(body).hexdigest()[:16]}"', 'Last-Modified': api.last_modified})
+            if api.is_not_modified(self.headers, headers['ETag']):
+                self.send_response(304)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                return
+            api.count_bytes(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        api = self.server.api
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip('/')
+        resource = api.get_resource(path)
+        fault = api.get_fault(resource, proxied=bool(parts.netloc))
+        if fault == 429:
+            return self.send_body({'error': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        if fault == 503:
+            return self.send_body({'error': 'Service Unavailable'}, status=503)
+
+        for page_id, page_path in PAGES.items():
+            if path == page_path:
+                return self.send_body(api.get_page_html(), 'text/html; charset=utf-8')
+        segments = path.strip('/').split('/')      # notices / v1 / red / 2020-10001 / images / r10010
+        if len(segments) < 3 or segments[:2] != ['notices', 'v1'] or segments[2] not in PAGES:
+            return self.send_body({'error': 'Not Found'}, status=404)
+        page_id = segments[2]
+        if len(segments) == 3:
+            query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+            return self.send_body(api.get_search(page_id, query))
+        person = api.dataset.persons[page_id].get(segments[3].replace('-', '/'))
+        if person is None:
+            return self.send_body({'error': 'Not Found'}, status=404)
+        if len(segments) == 4:
+            return self.send_body(api.get_detail(page_id, person))
+        if len(segments) == 5 and segments[4] == 'images':
+            return self.send_body(api.get_images(page_id, person))
+        if len(segments) == 6 and segments[5] in person['pictures']:
+            return self.send_body(api.get_image(segments[5]), 'image/jpeg')
+        return self.send_body({'error': 'Not Found'}, status=404)
+
+
+class MockApi:
+    """
+    Локальный HTTP-сервер, повторяющий поисковые страницы Интерпола и API `notices/v1`: HTML страниц с фильтрами
+    для `NoticePage`, поиск с лимитом выдачи в 160 Персон и фильтрами по возрасту, детальные данные, списки фото
+    и сами фото. Задержка ответа, доля ошибок 503 и ограничение частоты запросов (429 с `Retry-After`)
+    настраиваются, поэтому обход можно измерять и отлаживать, не нагружая настоящий сайт.
+    Сервер принимает и запросы с полным адресом, как HTTP-прокси, и отвечает на них сам, поэтому заменяет прокси
+    в тестах `ProxyPool`. Сервер работает в фоновом потоке, пока не вызван `stop()`.
+    """
+
+    def __init__(self, dataset: Dataset, host: str = '127.0.0.1', port: int = 0, latency: float = 0,
+                 jitter: float = 0, error_rate: float = 0, rate_limit: float = 0, seed: int = 1):
+        """
+        :param dataset: Набор Персон.
+        :param port: Порт сервера. Если `0` - выбирается свободный.
+        :param latency: Задержка каждого ответа в секундах.
+        :param jitter: Случайная добавка к задержке, от `0` до `jitter` секунд.
+        :param error_rate: Доля ответов 503 на запросы к API (кроме поисковых страниц).
+        :param rate_limit: Запросов в секунду, сверх которых сервер отвечает 429. Если `0` - не ограничивается.
+        :param seed: Зерно генератора задержек и ошибок.
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = rate_limit
+        self.tokens_at = time.monotonic()
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'not_modified': 0, 'proxied': 0, 'bytes': 0}
+        # Набор не меняется, пока сервер работает, поэтому все ответы изменены в момент запуска
+        self.started_at = int(time.time())
+        self.last_modified = formatdate(self.started_at, usegmt=True)
+        self.resources = {}     # Количество запросов по типам ресурсов, как в `HttpClient`
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.thread = None
+        self.images = {}        # Содержимое фото по `picture_id`, создается при первом запросе
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_settings(self) -> dict:
+        """Параметры `settings.json`, направляющие обход на этот сервер."""
+        return {'search_pages_urls': {page_id: f'{self.url}{path}' for page_id, path in PAGES.items()},
+                'request_url': f'{self.url}/notices/v1/'}
+
+    def start(self) -> 'MockApi':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get_stats(self) -> dict:
+        """
+        Статистика сервера: запросы, ответы 503, 429 и 304, запросы через сервер как через прокси, отданные байты
+        тел ответов и запросы по типам ресурсов.
+        """
+        with self.lock:
+            return {**self.stats, 'resources': dict(self.resources)}
+
+    @staticmethod
+    def get_resource(path: str) -> str:
+        """Тип ресурса по пути запроса: `page`, `search`, `detail`, `images` или `image`."""
+        segments = path.strip('/').split('/')
+        if segments[:2] != ['notices', 'v1']:
+            return 'page'
+        return {3: 'search', 4: 'detail', 5: 'images'}.get(len(segments), 'image')
+
+    def get_fault(self, resource: str, proxied: bool = False):
+        """
+        Считает запрос, выдерживает задержку и решает, ответить ли ошибкой.
+        :param proxied: Запрос пришел на сервер как на прокси: в строке запроса полный адрес, а не только путь.
+        :return: `429`, `503` или `None`, если запрос обрабатывается штатно.
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['proxied'] += proxied
+            self.resources[resource] = self.resources.get(resource, 0) + 1
+            fault = None
+            if self.rate_limit:
+                now = time.monotonic()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.tokens_at) * self.rate_limit)
+                self.tokens_at = now
+                if self.tokens < 1:
+                    fault = 429
+                    self.stats['throttled'] += 1
+                else:
+                    self.tokens -= 1
+            if fault is None and resource != 'page' and self.random.random() < self.error_rate:
+                fault = 503
+                self.stats['errors'] += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        return fault
+
+    def is_not_modified(self, request_headers, etag: str) -> bool:
+        """
+        Проверяет условный запрос. `If-None-Match` важнее `If-Modified-Since`, как требует RFC 9110.
+        :return: `True`, если копия клиента актуальна и нужно ответить `304`.
+        """
+        not_modified = False
+        if request_headers.get('If-None-Match'):
+            not_modified = etag in [tag.strip() for tag in request_headers['If-None-Match'].split(',')]
+        elif request_headers.get('If-Modified-Since'):
+            try:
+                not_modified = parsedate_to_datetime(request_headers['If-Modified-Since']).timestamp() \
+                    >= self.started_at
+            except (TypeError, ValueError):
+                not_modified = False
+        if not_modified:
+            with self.lock:
+                self.stats['not_modified'] += 1
+        return not_modified
+
+    def count_bytes(self, body: bytes) -> None:
+        with self.lock:
+            self.stats['bytes'] += len(body)
+
+    def get_page_html(self) -> str:
+        """HTML поисковой страницы: только теги фильтров, которые разбирает `NoticePage`."""
+        options = ''.join(f'<option value="{code}">{name}</option>' for code, name in self.dataset.nations.items())
+        radios = ''.join(f'<input type="radio" name="sexId" id="sex{code}" value="{code}">'
+                         f'<label for="sex{code}">{name}</label>' for code, name in GENDERS.items())
+        return (f'<html><body><form><select id="nationality" name="nationality"><option></option>{options}</select>'
+                f'<input type="radio" name="sexId" id="sexAll" value=""><label for="sexAll">All</label>{radios}'
+                f'</form><strong id="totalResults">0</strong></body></html>')
+
+    def get_links(self, page_id: str, person: dict) -> dict:
+        base = f"{self.url}/notices/v1/{page_id}/{person['entity_id'].replace('/', '-')}"
+        links = {'self': {'href': base}, 'images': {'href': f'{base}/images'}}
+        if person['pictures']:
+            links['thumbnail'] = {'href': f"{base}/images/{person['pictures'][0]}"}
+        return links
+
+    def get_search(self, page_id: str, query: dict) -> bytes:
+        total, found = self.dataset.search(page_id, query)
+        notices = [{'forename': person['forename'], 'name': person['name'], 'date_of_birth': person['date_of_birth'],
+                    'nationalities': person['nationalities'], 'entity_id': person['entity_id'],
+                    '_links': self.get_links(page_id, person)} for person in found]
+        return json.dumps({'total': total, 'query': query, '_embedded': {'notices': notices},
+                           '_links': {'self': {'href': f'{self.url}/notices/v1/{page_id}'}}}).encode()
+
+    def get_detail(self, page_id: str, person: dict) -> bytes:
+        detail = {key: value for key, value in person.items() if key not in ('age', 'pictures')}
+        detail.update({'place_of_birth': 'UNKNOWN', 'languages_spoken_ids': ['ENG'], 'height': 1.75, 'weight': 80,
+                       'distinguishing_marks': None, 'eyes_colors_id': ['BRO'], 'hairs_id': ['BLA'],
+                       '_links': self.get_links(page_id, person)})
+        return json.dumps(detail).encode()
+
+    def get_images(self, page_id: str, person: dict) -> bytes:
+        base = f"{self.url}/notices/v1/{page_id}/{person['entity_id'].replace('/', '-')}/images"
+        images = [{'picture_id': picture_id, '_links': {'self': {'href': f'{base}/{picture_id}'}}}
+                  for picture_id in person['pictures']]
+        return json.dumps({'_embedded': {'images': images}}).encode()
+
+    def get_image(self, picture_id: str) -> bytes:
+        image = self.images.get(picture_id)
+        if image is None:
+            # Содержимое уникально для каждого фото, чтобы хранилище без дублей не склеивало разные фото
+            pattern = picture_id.encode() + b'\x00'
+            image = b'\xff\xd8\xff\xe0' + (pattern * (self.dataset.image_size // len(pattern) + 1))
+            image = self.images.setdefault(picture_id, image[:self.dataset.image_size])
+        return image
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Локальный сервер, повторяющий поисковые страницы и API Интерпола.')
+    parser.add_argument('--size', type=int, default=1000, help='Персон на каждый тип страницы')
+    parser.add_argument('--nations', type=int, default=8, help='количество гражданств')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа в секундах')
+    parser.add_argument('--jitter', type=float, default=0, help='случайная добавка к задержке в секундах')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 503')
+    parser.add_argument('--rate-limit', type=float, default=0, help='запросов в секунду до ответов 429')
+    args = parser.parse_args()
+
+    mock = MockApi(Dataset(args.size, nations=args.nations), port=args.port, latency=args.latency, jitter=args.jitter,
+                   error_rate=args.error_rate, rate_limit=args.rate_limit).start()
+    print(f'Сервер запущен: {mock.url}. Параметры для `settings.json`:')
+    print(json.dumps(mock.get_settings(), indent=4))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mock.stop()
+        print(json.dumps(mock.get_stats(), indent=4))
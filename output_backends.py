@@ -0,0 +1,308 @@
+# -*- coding: UTF-8 -*-
+
+import abc
+import gzip
+import json
+import logging
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from blob_store import BlobStore
+from file_manager import FileWriter
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TreeOutput:
+    """
+    Исходный формат результатов: папка на каждую Персону (`result/red/Zimbabwe/1990-8402/`) с файлом `detail.json`
+    или `preview.json` и всеми фото. Json-файлы записываются в фоне через `FileWriter`.
+    """
+
+    def __init__(self, writer: FileWriter = None):
+        """
+        :param writer: Фоновая запись файлов. Если не передана - файлы записываются сразу.
+        """
+        self.writer = writer if writer else FileWriter(workers=0)
+
+    def get_image_dir(self, person_result_path: Path):
+        """Папка, в которую скачиваются фото Персоны."""
+        return person_result_path
+
+    def save_person(self, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                    on_saved=None) -> None:
+        """
+        Сохраняет данные Персоны. Вызывается после загрузки всех ее фото.
+        :param page_id: Тип поисковой страницы: `red`, `yellow`.
+        :param nation: ID гражданства из фильтра.
+        :param nation_name: Название государства.
+        :param person_result_path: Путь к папке Персоны формата 'result/red/Zimbabwe/1990-8402/'.
+        :param person: Объект `PersonDetail` или `PersonPreview`.
+        :param on_saved: Функция без аргументов, которая вызывается, когда данные Персоны записаны на диск.
+        """
+        Path(person_result_path, 'removed.json').unlink(missing_ok=True)    # Персона снова появилась в выдаче
+        if hasattr(person, 'detail_json'):
+            self.writer.submit(file_path=Path(person_result_path, 'detail.json'), file_data=person.detail_json,
+                               on_done=on_saved)
+        else:
+            self.writer.submit(file_path=Path(person_result_path, 'preview.json'), file_data=person.preview_json,
+                               on_done=on_saved)
+
+    def update_images(self, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                      on_saved=None) -> None:
+        """
+        Дополняет уже сохраненную Персону фото, скачанными позже ее данных (отложенные миниатюры Превью).
+        Фото уже лежат в папке Персоны, поэтому записывать нечего.
+        :param person: Объект `PersonPreview` с заполненным `images`.
+        :param on_saved: Функция без аргументов, которая вызывается, когда фото учтены в формате вывода.
+        """
+        if on_saved:
+            on_saved()
+
+    def remove_person(self, page_id: str, nation: str, nation_name: str, person_result_path: Path,
+                      entity_id: str) -> None:
+        """
+        Отмечает Персону, пропавшую из выдачи (дельта-синхронизация). Папка Персоны не удаляется, а получает
+        файл-метку `removed.json`.
+        """
+        self.writer.submit(file_path=Path(person_result_path, 'removed.json'),
+                           file_data={'entity_id': entity_id, 'removed_at': int(time.time())})
+
+    def flush(self) -> None:
+        """Дожидается записи на диск всех уже сохраненных Персон."""
+        self.writer.flush()
+
+    def close(self) -> None:
+        """Дописывает все файлы из очереди. Повторный вызов ничего не делает."""
+        self.writer.close()
+
+
+class BatchOutput(TreeOutput, abc.ABC):
+    """
+    Основа для форматов, которые пишут по одной записи на Персону пачками. Фото в этих форматах хранятся только
+    в хранилище без дублей (`BlobStore`), а запись Персоны ссылается на них по sha256, поэтому папки на каждую
+    Персону не создаются. Персона отмечается сохраненной (`on_saved`) только после записи пачки на диск.
+    Наследник должен реализовать `write()`, иначе его нельзя создать.
+    """
+    target = 'batch'    # Метка формата в метриках записи
+
+    def __init__(self, blobs: BlobStore, batch_size: int = 500):
+        """
+        :param blobs: Хранилище фото, в которое их скачивает `HttpClient`.
+        :param batch_size: Сколько записей копить в памяти перед записью на диск.
+        """
+        self.blobs = blobs
+        self.batch_size = max(batch_size, 1)
+        self.batch = []         # Список пар (запись, on_saved)
+        self.lock = threading.Lock()
+
+    def get_image_dir(self, person_result_path: Path):
+        return None     # `HttpClient.download()` сохранит фото только в хранилище
+
+    def get_image_refs(self, person) -> list:
+        """Ссылки на сохраненные фото Персоны. Фото, которые не удалось скачать, в список не попадают."""
+        image_refs = []
+        for image_link in person.image_links:
+            known = self.blobs.lookup(image_link.url)
+            if known:
+                digest, suffix = known
+                image_refs.append({'name': f'{image_link.name}.{suffix}', 'url': image_link.url, 'sha256': digest,
+                                   'file': str(self.blobs.get_blob_path(digest).relative_to(self.blobs.path))})
+        return image_refs
+
+    def save_person(self, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                    on_saved=None) -> None:
+        detail = hasattr(person, 'detail_json')
+        data = person.detail_json if detail else person.preview_json
+        record = {'page_id': page_id, 'nation': nation, 'nation_name': nation_name, 'entity_id': data['entity_id'],
+                  'kind': 'detail' if detail else 'preview', 'crawled_at': int(time.time()), 'data': data,
+                  'images': self.get_image_refs(person)}
+        with self.lock:
+            self.batch.append((record, on_saved))
+            if len(self.batch) >= self.batch_size:
+                self.write_batch()
+
+    def update_images(self, page_id: str, nation: str, nation_name: str, person_result_path: Path, person,
+                      on_saved=None) -> None:
+        """Записывает Персону заново, уже со ссылками на фото: новая запись заменяет прежнюю."""
+        self.save_person(page_id, nation, nation_name, person_result_path, person, on_saved=on_saved)
+
+    def remove_person(self, page_id: str, nation: str, nation_name: str, person_result_path: Path,
+                      entity_id: str) -> None:
+        """Записывает метку удаления Персоны: запись с `kind` = `removed` без данных и фото."""
+        record = {'page_id': page_id, 'nation': nation, 'nation_name': nation_name, 'entity_id': entity_id,
+                  'kind': 'removed', 'crawled_at': int(time.time()), 'data': None, 'images': []}
+        with self.lock:
+            self.batch.append((record, None))
+            if len(self.batch) >= self.batch_size:
+                self.write_batch()
+
+    def write_batch(self) -> None:
+        """Записывает накопленную пачку и отмечает ее Персоны сохраненными. Вызывается под `lock`."""
+        if not self.batch:
+            return
+        with metrics.timer('write_seconds', target=self.target):
+            size = self.write([record for record, _ in self.batch])
+        metrics.inc('written_bytes_total', size, target=self.target)
+        logger.debug(f'Saved {len(self.batch)} records.', extra={'records': len(self.batch), 'bytes': size})
+        for _, on_saved in self.batch:
+            if on_saved:
+                on_saved()
+        self.batch = []
+
+    @abc.abstractmethod
+    def write(self, records: list) -> int:
+        """Записывает пачку записей. Возвращает объем записанных данных в байтах для метрик."""
+
+    def flush(self) -> None:
+        with self.lock:
+            self.write_batch()
+
+    def close(self) -> None:
+        self.flush()
+
+
+class JsonlOutput(BatchOutput):
+    """
+    Сжатый gzip-файл, в котором каждая строка - json-запись одной Персоны. Файл только дописывается: каждая пачка
+    добавляется отдельным gzip-блоком, который читается `gzip.open()` и `zcat` как продолжение файла. Если Персона
+    сохранялась несколько раз (повторные запуски), актуальна последняя запись, в том числе метка удаления.
+    """
+    target = 'jsonl'
+
+    def __init__(self, file_path, blobs: BlobStore, batch_size: int = 500):
+        super().__init__(blobs=blobs, batch_size=batch_size)
+        self.path = Path(file_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, records: list) -> int:
+        lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        size = self.path.stat().st_size if self.path.exists() else 0
+        with gzip.open(self.path, 'at', encoding='utf-8') as fp:
+            fp.write(lines)
+        return self.path.stat().st_size - size     # Размер сжатого блока
+
+
+class SqliteOutput(BatchOutput):
+    """
+    База SQLite с таблицами `notices` (запись Персоны, данные в json) и `images` (фото Персоны со ссылками
+    на хранилище). Повторное сохранение Персоны заменяет прежнюю запись, а метка удаления только меняет ее `kind`.
+    """
+    target = 'sqlite'
+
+    def __init__(self, db_path, blobs: BlobStore, batch_size: int = 500):
+        super().__init__(blobs=blobs, batch_size=batch_size)
+        self.path = Path(db_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Пачка пишется из потока, сохранившего последнюю Персону пачки, поэтому доступ защищен `lock`
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS notices (
+                    page_id TEXT, nation TEXT, entity_id TEXT, nation_name TEXT, kind TEXT, crawled_at INTEGER,
+                    data TEXT, PRIMARY KEY (page_id, nation, entity_id))''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    page_id TEXT, nation TEXT, entity_id TEXT, name TEXT, url TEXT, sha256 TEXT, file TEXT,
+                    PRIMARY KEY (page_id, nation, entity_id, name))''')
+
+    def write(self, records: list) -> int:
+        # Метка удаления сохраняет прежние данные и фото Персоны, меняя только `kind`
+        removed = [record for record in records if record['kind'] == 'removed']
+        records = [record for record in records if record['kind'] != 'removed']
+        notices = [(record['page_id'], record['nation'], record['entity_id'], record['nation_name'], record['kind'],
+                    record['crawled_at'], json.dumps(record['data'], ensure_ascii=False)) for record in records]
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE notices SET kind=?, crawled_at=? WHERE page_id=? AND nation=? AND entity_id=?',
+                [(record['kind'], record['crawled_at'], record['page_id'], record['nation'], record['entity_id'])
+                 for record in removed])
+            self.connection.executemany('INSERT OR REPLACE INTO notices VALUES (?, ?, ?, ?, ?, ?, ?)', notices)
+            # Удаляем фото прежней записи Персоны, чтобы не осталось фото, которых больше нет у Персоны
+            self.connection.executemany(
+                'DELETE FROM images WHERE page_id=? AND nation=? AND entity_id=?',
+                [(record['page_id'], record['nation'], record['entity_id']) for record in records])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(record['page_id'], record['nation'], record['entity_id'], image['name'], image['url'],
+                  image['sha256'], image['file']) for record in records for image in record['images']])
+        return sum(len(notice[-1].encode('utf-8')) for notice in notices)   # Объем данных Персон без служебных полей
+
+    def close(self) -> None:
+        super().close()
+        with self.lock:
+            self.connection.close()
+
+
+def get_output_path(settings, part: str = None) -> Path:
+    """
+    Путь к файлу результатов формата `jsonl` или `sqlite`.
+    :param part: Идентификатор процесса при обходе по шардам. Каждый процесс пишет свою часть,
+    которые затем объединяет `merge_outputs()`.
+    """
+    name = 'notices.jsonl.gz' if settings.output_backend == 'jsonl' else 'notices.sqlite'
+    if part:
+        name = name.replace('notices.', f'notices.{part}.', 1)
+    return Path(settings.result_dir, name)
+
+
+def create_output(settings, blobs: BlobStore = None, part: str = None):
+    """
+    Создает формат вывода по параметру `output_backend` из настроек: `tree`, `jsonl` или `sqlite`.
+    :param settings: Объект настроек.
+    :param blobs: Хранилище фото. Обязательно для `jsonl` и `sqlite`.
+    :param part: Идентификатор процесса при обходе по шардам. Для `tree` не используется: процессы пишут в разные
+    папки Персон общего дерева.
+    :return: Объект формата вывода.
+    """
+    if settings.output_backend == 'tree':
+        return TreeOutput(writer=FileWriter(workers=settings.writer_threads, queue_size=settings.writer_queue_size,
+                                            fsync=settings.fsync))
+    if not blobs:
+        raise ValueError(f'Output backend `{settings.output_backend}` stores images in the blob store only')
+    if settings.output_backend == 'jsonl':
+        return JsonlOutput(file_path=get_output_path(settings, part), blobs=blobs,
+                           batch_size=settings.output_batch_size)
+    if settings.output_backend == 'sqlite':
+        return SqliteOutput(db_path=get_output_path(settings, part), blobs=blobs,
+                            batch_size=settings.output_batch_size)
+    raise ValueError(f'Unknown output backend `{settings.output_backend}`')
+
+
+def merge_outputs(settings) -> int:
+    """
+    Объединяет части результатов, записанные процессами обхода по шардам, в основной файл и удаляет их.
+    Для `tree` ничего не делает.
+    :return: Количество объединенных частей.
+    """
+    if settings.output_backend == 'tree':
+        return 0
+    main_path = get_output_path(settings)
+    pattern = get_output_path(settings, part='*').name
+    parts = sorted(path for path in Path(settings.result_dir).glob(pattern) if path != main_path)
+    if settings.output_backend == 'jsonl':
+        # Файл из нескольких gzip-блоков остается корректным gzip-файлом, поэтому части просто дописываются в конец
+        with main_path.open('ab') as main_fp:
+            for part_path in parts:
+                with part_path.open('rb') as part_fp:
+                    shutil.copyfileobj(part_fp, main_fp)
+    else:
+        output = SqliteOutput(db_path=main_path, blobs=None)    # Создает основную базу, если ее еще нет
+        connection = output.connection
+        for part_path in parts:
+            connection.execute('ATTACH DATABASE ? AS part', (str(part_path),))
+            with connection:
+                connection.execute('DELETE FROM images WHERE (page_id, nation, entity_id) IN '
+                                   '(SELECT page_id, nation, entity_id FROM part.notices)')
+                connection.execute('INSERT OR REPLACE INTO notices SELECT * FROM part.notices')
+                connection.execute('INSERT OR REPLACE INTO images SELECT * FROM part.images')
+            connection.execute('DETACH DATABASE part')
+        output.close()
+    for part_path in parts:
+        part_path.unlink()
+        logger.info(f'Merged `{part_path}`.')
+    return len(parts)
@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)     # Ответы, после которых запрос стоит повторить
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов к одному хосту. Токены пополняются со скоростью `rate` в секунду, но копятся
+    не больше `burst`, поэтому после простоя можно отправить не более `burst` запросов подряд.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: Запросов в секунду. Если `0` - частота не ограничивается, но `pause()` продолжает работать.
+        :param burst: Сколько запросов можно отправить подряд без ожидания.
+        """
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает все запросы к хосту на `seconds` секунд. Используется для ответов с `Retry-After`."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self) -> None:
+        """Ждет, пока можно будет отправить очередной запрос."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate <= 0:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    """
+    Адаптивный лимит одновременных запросов к хосту по схеме AIMD: при ответах о перегрузке (429, 5xx, таймауты)
+    лимит уменьшается вдвое, а при успешных ответах с задержкой не выше целевой - растет примерно на единицу
+    за каждые `limit` запросов. Так обход сам находит параллельность, которую сервер выдерживает.
+    До первой перегрузки лимит растет на единицу за каждый успешный запрос (медленный старт, как в TCP), т.е.
+    удваивается за каждые `limit` запросов, поэтому обход быстро выходит на рабочую параллельность.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, latency_target: float = 2.0, decrease: float = 0.5,
+                 cooldown: float = 1.0, initial_limit: int = None):
+        """
+        :param max_limit: Максимальный лимит. Выше него лимит не растет.
+        :param min_limit: Минимальный лимит.
+        :param latency_target: Задержка ответа в секундах, при которой лимит еще можно увеличивать.
+        :param decrease: Множитель уменьшения лимита при перегрузке.
+        :param cooldown: Лимит уменьшается не чаще раза в `cooldown` секунд, т.к. одна перегрузка сервера
+        обычно приходит ответами сразу на все запросы, отправленные одновременно.
+        :param initial_limit: Лимит, с которого обход начинает. Если не задан - с `min_limit`.
+        """
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(min(max(initial_limit or self.min_limit, self.min_limit), self.max_limit))
+        self.slow_start = True      # До первого уменьшения лимит растет мультипликативно
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.active = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, latency: float, throttled: bool) -> None:
+        """
+        Освобождает место и подстраивает лимит по результату запроса.
+        :param latency: Время выполнения запроса в секундах. `None` - запрос не дошел до сервера по причине,
+        не связанной с ним: лимит не меняется.
+        :param throttled: `True`, если сервер ответил о перегрузке или не ответил вовремя.
+        """
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if latency is None:
+                pass
+            elif throttled:
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.decreased_at = now
+                    self.slow_start = False
+            elif latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов, через который `HttpClient` отправляет каждый запрос:
+    - Частота запросов к каждому хосту ограничивается `TokenBucket`.
+    - Количество одновременных запросов к хосту подстраивается `AdaptiveLimit`.
+    - Ответы 429/5xx, таймауты и обрывы соединения повторяются с экспоненциальной задержкой со случайной добавкой.
+    Если сервер прислал `Retry-After` - ждем указанное время, но не больше `backoff_max`, и на это время
+    останавливаются все запросы к хосту.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 1, retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, max_concurrency: int = 10, latency_target: float = 2.0,
+                 host_pause: bool = True, initial_concurrency: int = 1):
+        """
+        :param rate: Запросов в секунду к одному хосту. Если `0` - не ограничивается.
+        :param burst: Сколько запросов к хосту можно отправить подряд без ожидания.
+        :param retries: Количество повторов одного запроса.
+        :param backoff_base: Задержка перед первым повтором в секундах. Каждый следующий повтор ждет вдвое дольше.
+        :param backoff_max: Максимальная задержка перед повтором, в том числе по `Retry-After`: иначе ответ
+        `Retry-After: 86400` остановил бы поток на сутки.
+        :param max_concurrency: Максимальное количество одновременных запросов к одному хосту.
+        :param latency_target: Задержка ответа, при которой лимит одновременных запросов еще растет.
+        :param host_pause: Останавливать все запросы к хосту по `Retry-After`. При работе через пул прокси
+        отключается: ограничение относится к IP одного прокси, и пул сам выводит его из ротации.
+        :param initial_concurrency: Лимит одновременных запросов к хосту в начале обхода. Дальше он растет
+        до `max_concurrency`, пока сервер отвечает быстро.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.latency_target = latency_target
+        self.host_pause = host_pause
+        self.hosts = {}         # {хост: (TokenBucket, AdaptiveLimit)}
+        self.lock = threading.Lock()
+        self.stats = {'retries': 0, 'throttled': 0, 'failed': 0}
+
+    def get_host(self, url: str) -> tuple:
+        """Ограничители хоста. Создаются при первом запросе к нему."""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = (TokenBucket(rate=self.rate, burst=self.burst),
+                                    AdaptiveLimit(max_limit=self.max_concurrency, latency_target=self.latency_target,
+                                                  initial_limit=self.initial_concurrency))
+            return self.hosts[host]
+
+    def get_delay(self, attempt: int, response) -> float:
+        """
+        Задержка перед повтором: `Retry-After` из ответа, если он есть (не больше `backoff_max`), иначе
+        экспоненциальная задержка, половина которой выбирается случайно, чтобы параллельные запросы
+        не повторялись одновременно.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), self.backoff_max)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0),
+                               self.backoff_max)
+                except (TypeError, ValueError):
+                    pass    # Непонятный формат - используем обычную задержку
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def request(self, url: str, send) -> requests.Response:
+        """
+        Отправляет запрос с ограничением частоты и повторами.
+        :param url: Адрес запроса. По нему выбирается хост.
+        :param send: Функция без аргументов, которая отправляет запрос и возвращает ответ `requests`.
+        :return: Ответ. Если все повторы исчерпаны - последний неудачный ответ, либо исключение последней попытки.
+        """
+        bucket, limit = self.get_host(url)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            limit.acquire()
+            started = time.monotonic()
+            response = error = None
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # Прочие исключения (например, ошибка в самом запросе) - не перегрузка сервера, лимит не меняем
+                failed = error is not None or response is not None and response.status_code in RETRY_STATUSES
+                completed = response is not None or error is not None
+                limit.release(latency=time.monotonic() - started if completed else None, throttled=failed)
+
+            if not failed:
+                return response
+            with self.lock:
+                self.stats['throttled'] += 1
+            if attempt == self.retries:
+                break
+
+            delay = self.get_delay(attempt, response)
+            if response is not None:
+                if self.host_pause and 'Retry-After' in response.headers:
+                    bucket.pause(delay)     # Сервер просит подождать - не отправляем к нему и другие запросы
+                response.close()
+            with self.lock:
+                self.stats['retries'] += 1
+            logger.warning(f'Retry {attempt + 1}/{self.retries} in {delay:.1f}s: {url} '
+                           f'({error if error else response.status_code})', extra={'url': url})
+            time.sleep(delay)
+
+        with self.lock:
+            self.stats['failed'] += 1
+        if error:
+            raise error
+        return response
+
+    def reset_stats(self) -> None:
+        """
+        Обнуляет счетчики повторов и неудачных запросов. Служба (`--daemon`) обнуляет их перед каждым циклом,
+        т.к. по количеству неудачных запросов решается, завершен ли обход.
+        """
+        with self.lock:
+            self.stats = {'retries': 0, 'throttled': 0, 'failed': 0}
+
+    def get_limits(self) -> dict:
+        """Текущий лимит одновременных запросов для каждого хоста."""
+        with self.lock:
+            return {host: int(limit.limit) for host, (_, limit) in self.hosts.items()}
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+
+class StateStore:
+    """
+    Хранилище состояния обхода в SQLite. Позволяет продолжить прерванный запуск, не повторяя уже выполненную работу:
+    - `search_nodes` - узлы дерева поиска (тип страницы, гражданство, пол, возрастной диапазон). Для узла, который
+    пришлось разбить, хранятся отметка `split`, количество Персон и поддиапазоны, а для листа - превью Персон.
+    - `persons` - Персоны, все файлы которых уже сохранены, со списком имен их фото.
+    Каждая запись делается отдельной транзакцией, поэтому Персона отмечается выполненной только после сохранения
+    всех ее файлов. После успешного завершения обхода состояние очищается, и следующий запуск начинается заново.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Путь к файлу базы в формате строки или `Path`.
+        """
+        self.path = Path(db_path)
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Хранилище используется из потоков асинхронного обхода, поэтому доступ к соединению защищаем блокировкой.
+        # При обходе по шардам базу пишут несколько процессов - ждем освобождения блокировки до минуты
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS search_nodes (
+                    page_id TEXT, nation TEXT, gender TEXT, min_age INTEGER, max_age INTEGER,
+                    split INTEGER NOT NULL, total INTEGER, notices TEXT, sub_ranges TEXT,
+                    PRIMARY KEY (page_id, nation, gender, min_age, max_age))''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS persons (
+                    page_id TEXT, nation TEXT, entity_id TEXT, images TEXT,
+                    PRIMARY KEY (page_id, nation, entity_id))''')
+            # База могла остаться от прерванного запуска прошлой версии, где этих колонок еще не было
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(search_nodes)')]
+            for column, column_type in (('total', 'INTEGER'), ('sub_ranges', 'TEXT')):
+                if column not in columns:
+                    self.connection.execute(f'ALTER TABLE search_nodes ADD COLUMN {column} {column_type}')
+
+    def get_search_node(self, page_id: str, nation: str, gender: str, min_age: int, max_age: int):
+        """
+        Ищем узел дерева поиска, завершенный в прошлом запуске.
+        :return: `None`, если узел еще не запрашивался.
+        Иначе словарь {'split': bool, 'total': int, 'notices': dict, 'sub_ranges': list}.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT split, total, notices, sub_ranges FROM search_nodes '
+                'WHERE page_id=? AND nation=? AND gender=? AND min_age=? AND max_age=?',
+                (page_id, nation, gender, min_age, max_age)).fetchone()
+        if row is None:
+            return None
+        return {'split': bool(row[0]), 'total': row[1], 'notices': json.loads(row[2]) if row[2] else {},
+                'sub_ranges': json.loads(row[3]) if row[3] else []}
+
+    def save_search_node(self, page_id: str, nation: str, gender: str, min_age: int, max_age: int,
+                         split=False, total=0, notices=None, sub_ranges=None) -> None:
+        """
+        Отмечаем узел дерева поиска выполненным.
+        :param split: `True`, если выдача упиралась в лимит и узел был разбит на поддиапазоны.
+        :param total: Количество Персон в диапазоне по ответу сервера. Нужно для повторного разбиения узла.
+        :param notices: Словарь превью Персон листа. Для разбитого узла не передается.
+        :param sub_ranges: Поддиапазоны разбитого узла. Продолженный обход разобьет узел так же.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO search_nodes '
+                '(page_id, nation, gender, min_age, max_age, split, total, notices, sub_ranges) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (page_id, nation, gender, min_age, max_age, int(split), total,
+                 None if split else json.dumps(notices or {}, ensure_ascii=False),
+                 json.dumps(sub_ranges) if split else None))
+
+    def is_person_done(self, page_id: str, nation: str, entity_id: str) -> bool:
+        """Проверяем, сохранена ли Персона полностью в одном из прошлых запусков."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM persons WHERE page_id=? AND nation=? AND entity_id=?',
+                (page_id, nation, entity_id)).fetchone()
+        return row is not None
+
+    def save_person(self, page_id: str, nation: str, entity_id: str, images: list) -> None:
+        """
+        Отмечаем Персону выполненной. Вызывать только после того, как сохранены все ее файлы.
+        :param images: Список имен сохраненных фото Персоны.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO persons VALUES (?, ?, ?, ?)',
+                                    (page_id, nation, entity_id, json.dumps(list(images))))
+
+    def count_persons(self) -> int:
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM persons').fetchone()[0]
+
+    def clear(self) -> None:
+        """Очищаем состояние после успешного завершения обхода."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM search_nodes')
+            self.connection.execute('DELETE FROM persons')
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+# Модули парсера лежат в корне репозитория, а не в пакете
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmark import BENCHMARK_SETTINGS  # noqa: E402
+from file_manager import SETTINGS_DATA, Settings  # noqa: E402
+from mock_api import Dataset, MockApi  # noqa: E402
+
+
+@pytest.fixture
+def start_mock():
+    """
+    Фабрика локальных серверов API: `start_mock(error_rate=0.5)`. Параметры - как у `MockApi`, кроме `size`
+    (Персон на тип страницы). Все серверы теста останавливаются после него.
+    """
+    servers = []
+
+    def start(size: int = 20, **kwargs) -> MockApi:
+        server = MockApi(Dataset(size, nations=2), **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def get_detail_url(mock: MockApi, person: dict = None, page_id: str = 'red') -> str:
+    """Адрес детальных данных Персоны. Если Персона не передана - первой Персоны набора."""
+    person = person or next(iter(mock.dataset.persons[page_id].values()))
+    return f"{mock.url}/notices/v1/{page_id}/{person['entity_id'].replace('/', '-')}"
+
+
+def create_settings(tmp_path: Path, mock: MockApi, **kwargs) -> Settings:
+    """Настройки обхода локального сервера, как в `benchmark.py`, с результатом во временной папке теста."""
+    path = tmp_path / 'settings.json'
+    path.write_text(json.dumps({**SETTINGS_DATA, **BENCHMARK_SETTINGS, **mock.get_settings(), 'metrics_report': '',
+                                'result_dir': str(tmp_path / 'result'), 'retries': 0, **kwargs}), encoding='utf-8')
+    return Settings(path)
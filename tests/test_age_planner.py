@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+
+from datetime import date
+from pathlib import Path
+
+from age_planner import AgePlanner
+from conftest import create_settings
+from main import crawl
+
+
+def assert_covers(ranges: list, min_age: int, max_age: int) -> None:
+    """Диапазоны идут подряд, без пропусков и пересечений, и покрывают весь исходный диапазон."""
+    assert ranges[0][0] == min_age and ranges[-1][1] == max_age
+    for (_, previous_max), (next_min, next_max) in zip(ranges, ranges[1:]):
+        assert next_min == previous_max + 1 and next_min <= next_max
+
+
+def test_split_uses_sample_dates():
+    planner = AgePlanner(histograms_path='', limit=160)
+    today = date.today()
+    # Выдача обрезана лимитом: 160 Персон, поровну 20 и 60 лет, а всего найдено 400
+    sample = [{'date_of_birth': f'{today.year - age}/01/01'} for age in (20, 60) for _ in range(80)]
+
+    ranges = planner.split('red', 'RU', 'M', 0, 120, total=400, sample=sample)
+
+    assert len(ranges) == 4     # 400 / (160 * 0.75) - сразу на 4 части, а не пополам
+    assert_covers(ranges, 0, 120)
+    # Граница проходит между двумя возрастами выборки, а не посередине диапазона
+    assert any(range_min <= 20 and range_max < 60 for range_min, range_max in ranges)
+
+
+def test_split_without_dates_is_uniform():
+    planner = AgePlanner(histograms_path='', limit=160)
+    ranges = planner.split('red', 'RU', 'M', 10, 13, total=10000, sample=[{'date_of_birth': None}])
+    assert ranges == [[10, 10], [11, 11], [12, 12], [13, 13]]      # Частей не больше, чем возрастов
+
+
+def test_plan_by_histogram(tmp_path):
+    path = tmp_path / 'histograms.json'
+    planner = AgePlanner(histograms_path=path, limit=160)
+    for leaf in ([0, 30, 100], [31, 40, 150], [41, 120, 60]):
+        planner.record_leaf('red', 'RU', 'M', *leaf)
+    planner.save()
+
+    planner = AgePlanner(histograms_path=path, limit=160)
+    ranges = planner.plan('red', 'RU', 'M', 0, 120)
+
+    assert_covers(ranges, 0, 120)
+    density = planner.get_density(AgePlanner.get_key('red', 'RU', 'M'), 0, 120)
+    for range_min, range_max in ranges:
+        assert sum(density.get(age, 0) for age in range(range_min, range_max + 1)) <= 160 * 0.75 + 1e-9
+    assert planner.plan('red', 'UA', 'M', 0, 120) == [[0, 120]]     # Гистограммы нет - весь диапазон
+
+
+def test_second_crawl_plans_by_histograms(tmp_path, start_mock):
+    mock = start_mock(size=2000)
+    settings = create_settings(tmp_path, mock, age_histograms=str(tmp_path / 'histograms.json'),
+                               search_pages_id=['red'], preview_only=True, preview_thumbnails='none')
+    expected = sum(len(person['nationalities']) for person in mock.dataset.persons['red'].values())
+
+    first = AgePlanner(histograms_path=settings.age_histograms, limit=settings.notices_limit)
+    crawl(settings, planner=first)
+    # Выдача упиралась в лимит, но деление на k частей обходится меньшим числом запросов, чем деление пополам
+    assert first.requests < first.count_bisection_requests()
+    assert len(list(Path(settings.result_dir, 'red').glob('*/*'))) == expected
+
+    second = AgePlanner(histograms_path=settings.age_histograms, limit=settings.notices_limit)
+    crawl(settings, planner=second)
+    # По гистограммам сразу запрашиваются диапазоны, которые почти всегда уже не упираются в лимит
+    splits = [planner.requests - sum(len(leaves) for leaves in planner.leaves.values()) for planner in (first, second)]
+    assert second.requests < first.requests and splits[1] < splits[0]
+    assert len(list(Path(settings.result_dir, 'red').glob('*/*'))) == expected
@@ -0,0 +1,26 @@
+# -*- coding: UTF-8 -*-
+
+from pathlib import Path
+
+import async_crawler
+from async_crawler import AsyncCrawler, crawl_async
+from conftest import create_settings
+
+
+def test_person_tasks_are_bounded(tmp_path, start_mock, monkeypatch):
+    mock = start_mock(size=200, latency=0.005)
+    settings = create_settings(tmp_path, mock, concurrency=2, search_pages_id=['red'])
+    crawl_person = AsyncCrawler.crawl_person
+    pending = []
+
+    async def count_pending(self, *args):
+        pending.append(self.persons_pending)
+        return await crawl_person(self, *args)
+
+    monkeypatch.setattr(AsyncCrawler, 'crawl_person', count_pending)
+    crawl_async(settings)
+
+    # Поиск ждет, пока загрузка Персон отстает, а все Персоны все равно сохранены
+    assert max(pending) <= settings.concurrency * async_crawler.PERSONS_PER_REQUEST
+    saved = list(Path(settings.result_dir, 'red').glob('*/*'))
+    assert len(saved) == sum(len(person['nationalities']) for person in mock.dataset.persons['red'].values())
@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+
+import argparse
+from types import SimpleNamespace
+
+import pytest
+
+from benchmark import get_counter, get_regressions, parse_setting, run_case
+
+
+def get_result(**kwargs) -> dict:
+    return {'case': '500/c0/tree', 'returncode': 0, 'complete': True, 'persons': 100, 'expected_persons': 100,
+            'wall_time': 10.0, 'peak_rss_mb': 50.0, 'requests': 1000, **kwargs}
+
+
+def test_regressions_against_baseline():
+    baseline = {'results': [get_result()]}
+
+    assert get_regressions([get_result(wall_time=11.9, peak_rss_mb=59)], baseline, tolerance=0.2) == []
+    assert get_regressions([get_result(wall_time=12.1)], baseline, tolerance=0.2) == \
+        ['500/c0/tree: wall_time 10.0 -> 12.1']
+    # Набор детерминирован, поэтому лишний запрос - регрессия при любом допуске
+    assert get_regressions([get_result(requests=1001)], baseline, tolerance=1) == \
+        ['500/c0/tree: requests 1000 -> 1001']
+    # Память, которую ОС не сообщила, не сравнивается
+    assert get_regressions([get_result(peak_rss_mb=None)], baseline, tolerance=0.2) == []
+
+
+def test_incomplete_crawl_is_regression_without_baseline():
+    results = [get_result(case='500/c16/tree', complete=False, persons=90), get_result(returncode=1)]
+    assert get_regressions(results, {}, tolerance=0.2) == ['500/c16/tree: exit code 0, persons 90 of 100',
+                                                           '500/c0/tree: exit code 1, persons 100 of 100']
+
+
+def test_parse_setting():
+    assert parse_setting('concurrency=8') == ('concurrency', 8)
+    assert parse_setting('output_backend=jsonl') == ('output_backend', 'jsonl')
+    assert parse_setting('genders=["M"]') == ('genders', ['M'])
+    for value in ('concurrency', 'unknown=1'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_setting(value)
+
+
+def test_get_counter():
+    report = {'counters': {'persons_total': [{'labels': {'kind': 'detail'}, 'value': 3},
+                                             {'labels': {'kind': 'preview'}, 'value': 2}]}}
+    assert get_counter(report, 'persons_total') == 5
+    assert get_counter(report, 'persons_total', kind='preview') == 2
+    assert get_counter(report, 'http_requests_total') == 0
+
+
+def test_case_is_measured():
+    args = SimpleNamespace(nations=2, seed=1, image_size=1024, latency=0, jitter=0, error_rate=0, server_rps=0,
+                           settings={}, timeout=120, quiet=True)
+    case = {'size': 20, 'concurrency': 4, 'output_backend': 'jsonl', 'preview_only': False}
+
+    result = run_case(case, args)
+
+    assert result['case'] == '20/c4/jsonl' and result['returncode'] == 0
+    assert result['complete'] and result['persons'] == result['expected_persons'] > 0
+    # Счетчики клиента и сервера сходятся: каждый запрос обхода дошел до сервера один раз
+    assert result['client_requests'] == result['requests'] and result['server_errors'] == 0
+    assert get_regressions([result], {'results': [result]}, tolerance=0.2) == []
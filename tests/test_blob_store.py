@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+
+from blob_store import BlobStore
+from conftest import get_detail_url
+from http_client import HttpClient
+
+
+def get_image_url(mock) -> str:
+    person = next(person for person in mock.dataset.persons['red'].values() if person['pictures'])
+    return f"{get_detail_url(mock, person)}/images/{person['pictures'][0]}"
+
+
+def test_known_url_is_linked_without_download(tmp_path, start_mock):
+    mock = start_mock()
+    url = get_image_url(mock)
+    client = HttpClient(blobs=BlobStore(tmp_path / 'blobs'))
+
+    first = client.download(url, tmp_path / 'RU', 'photo')
+    second = client.download(url, tmp_path / 'UA', 'photo')
+
+    assert mock.get_stats()['resources']['image'] == 1
+    assert first.read_bytes() == second.read_bytes() and second.name == 'photo.jpeg'
+    digest = hashlib.sha256(first.read_bytes()).hexdigest()
+    blob_path = client.blobs.get_blob_path(digest)
+    # Обе папки Персоны ссылаются на один файл хранилища
+    assert first.stat().st_ino == second.stat().st_ino == blob_path.stat().st_ino and blob_path.stat().st_nlink == 3
+    assert client.blobs.stats == {'files': 2, 'blobs': 1, 'duplicates': 0, 'skipped': 1,
+                                  'bytes_saved': mock.dataset.image_size}
+    client.close()
+
+    # Индекс адресов переживает перезапуск
+    client = HttpClient(blobs=BlobStore(tmp_path / 'blobs'))
+    assert client.blobs.lookup(url) == (digest, 'jpeg')
+    assert client.download(url, None, 'photo') == blob_path
+    assert mock.get_stats()['resources']['image'] == 1
+    client.close()
+
+
+def test_same_content_is_stored_once(tmp_path):
+    blobs = BlobStore(tmp_path / 'blobs')
+    body = b'photo'
+    digest = hashlib.sha256(body).hexdigest()
+    paths = []
+    for index, url in enumerate(('http://host/1', 'http://host/2')):
+        temp_path = blobs.get_temp_path(f'photo{index}')
+        temp_path.write_bytes(body)
+        paths.append(blobs.add(url, temp_path, digest, 'jpg', tmp_path / f'person{index}' / 'photo.jpg'))
+
+    assert [path.read_bytes() for path in paths] == [body, body]
+    assert blobs.stats == {'files': 2, 'blobs': 1, 'duplicates': 1, 'skipped': 0, 'bytes_saved': len(body)}
+    assert not list((tmp_path / 'blobs').glob('.*.tmp'))     # Временный файл дубля удален
+    blobs.close()
+
+
+def test_lost_blob_is_downloaded_again(tmp_path, start_mock):
+    mock = start_mock()
+    url = get_image_url(mock)
+    client = HttpClient(blobs=BlobStore(tmp_path / 'blobs'))
+    path = client.download(url, None, 'photo')
+
+    path.unlink()
+    assert client.blobs.lookup(url) is None
+    assert client.download(url, tmp_path / 'RU', 'photo').is_file() and path.is_file()
+    assert mock.get_stats()['resources']['image'] == 2
+    client.close()
@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from age_planner import AgePlanner
+from conftest import create_settings
+from daemon import TOP_PRIORITIES, Daemon
+
+
+def create_daemon(tmp_path, mock, max_cycles: int = 1, **kwargs) -> Daemon:
+    settings = create_settings(tmp_path, mock, **{'delta_db': str(tmp_path / 'delta.sqlite'),
+                                                  'daemon_status': str(tmp_path / 'status.json'),
+                                                  'daemon_full_at': '03:00', 'daemon_search_interval': 900,
+                                                  **kwargs})
+    return Daemon(settings, max_cycles=max_cycles)
+
+
+def test_parse_time():
+    assert Daemon.parse_time('03:00') == (3, 0)
+    assert Daemon.parse_time('23:59') == (23, 59)
+    for value in ('24:00', '12:60', '3h', '12'):
+        with pytest.raises(ValueError):
+            Daemon.parse_time(value)
+
+
+def test_settings_are_checked(tmp_path, start_mock):
+    mock = start_mock()
+    with pytest.raises(ValueError):
+        create_daemon(tmp_path, mock, delta_db='')
+    with pytest.raises(ValueError):
+        create_daemon(tmp_path, mock, daemon_full_at='', daemon_search_interval=0)
+
+
+def test_cycle_choice(tmp_path, start_mock):
+    daemon = create_daemon(tmp_path, start_mock())
+    noon = datetime(2026, 1, 2, 12, 0).timestamp()
+
+    # Первый запуск службы: поисковый цикл сразу, а полный - в ближайшие `03:00`, а не немедленно
+    daemon.started_at = daemon.last_started['full'] = noon
+    assert daemon.get_next_cycle(noon) == ('search', 900)
+    assert daemon.get_schedule(noon)['full'] == datetime(2026, 1, 3, 3, 0).timestamp()
+
+    # Наступили оба - идет полный, т.к. он заменяет поисковый
+    daemon.last_started = {'search': noon - 1000, 'full': noon - 86400}
+    assert daemon.get_next_cycle(noon) == ('full', datetime(2026, 1, 2, 3, 0).timestamp())
+
+    # Поисковый цикл недавно был - ждем его интервал
+    daemon.last_started = {'search': noon - 100, 'full': noon - 3600}
+    assert daemon.get_next_cycle(noon) == ('search', noon + 800)
+
+
+def test_search_cycle_can_be_disabled(tmp_path, start_mock):
+    daemon = create_daemon(tmp_path, start_mock(), daemon_search_interval=0)
+    noon = datetime(2026, 1, 2, 12, 0).timestamp()
+    daemon.last_started['full'] = noon
+    assert daemon.get_next_cycle(noon) == ('full', datetime(2026, 1, 3, 3, 0).timestamp())
+
+
+def test_changes_decay(tmp_path, start_mock):
+    daemon = create_daemon(tmp_path, start_mock())
+    changelog = {'added': [{'page_id': 'red', 'nation': 'RU'}] * 2, 'updated': [{'page_id': 'red', 'nation': 'UA'}],
+                 'removed': []}
+    daemon.update_changes(changelog)
+    assert daemon.changes == {('red', 'RU'): 2, ('red', 'UA'): 1}
+
+    daemon.update_changes({'added': [{'page_id': 'red', 'nation': 'UA'}], 'updated': [], 'removed': []})
+    assert daemon.changes == {('red', 'RU'): 1, ('red', 'UA'): 1.5}
+    for _ in range(7):
+        daemon.update_changes({'added': [], 'updated': [], 'removed': []})
+    # Совсем старые изменения забываются
+    assert daemon.changes == {('red', 'UA'): 1.5 * 0.5 ** 7}
+    daemon.update_changes({'added': [], 'updated': [], 'removed': []})
+    assert daemon.changes == {}
+
+
+def test_queries_are_ordered_by_changes_then_leaves(tmp_path, start_mock):
+    mock = start_mock()
+    daemon = create_daemon(tmp_path, mock, search_pages_id=['red'], genders=['M', 'F'])
+    first, second = list(mock.dataset.nations)
+    daemon.changes = {('red', second): 1}
+    daemon.planner.histograms = {AgePlanner.get_key('red', first, 'F'): [[0, 30, 100], [31, 120, 100]]}
+
+    queries = [(page_id, nation, gender) for page_id, _, nation, gender in daemon.get_queries()]
+
+    assert queries[:2] == [('red', second, 'M'), ('red', second, 'F')]     # Сначала комбинации с изменениями
+    assert queries[2] == ('red', first, 'F')    # Затем с большим числом листьев
+    assert sorted(queries) == sorted(('red', nation, gender) for nation in (first, second) for gender in ('M', 'F'))
+    assert daemon.priorities[0] == {'page_id': 'red', 'nation': second, 'gender': 'M', 'changes': 1, 'leaves': 0}
+    assert daemon.priorities[2]['leaves'] == 2
+
+
+def test_daemon_runs_cycle_and_writes_status(tmp_path, start_mock):
+    mock = start_mock(size=30)
+    daemon = create_daemon(tmp_path, mock, state_db=str(tmp_path / 'state.sqlite'),
+                           dedup_db=str(tmp_path / 'dedup.sqlite'))
+    daemon.run()
+
+    status = json.loads((tmp_path / 'status.json').read_text(encoding='utf-8'))
+    assert status['state'] == 'stopped' and status['cycle'] is None
+    cycle = status['cycles']['search']
+    assert cycle['number'] == 1 and cycle['failed_requests'] == 0 and 'error' not in cycle
+    # Первый поисковый цикл на пустом снимке загружает всех Персон
+    assert cycle['added'] == mock.dataset.count_expected() and cycle['removed'] == 0
+    assert len(status['priorities']) == min(cycle['queries'], TOP_PRIORITIES) and cycle['queries'] > 0
+    assert set(status['next']) == {'search', 'full'} and status['next']['search'] == cycle['started_at'] + 900
+    # Служба закрыла хранилище состояния и индекс дублей при остановке
+    with pytest.raises(sqlite3.ProgrammingError):
+        daemon.state.count_persons()
+
+    # Перезапущенная служба помнит время прошлого поискового цикла
+    restarted = create_daemon(tmp_path, mock)
+    assert restarted.last_started['search'] == cycle['started_at']
+
+
+@pytest.mark.parametrize('concurrency', [0, 4])
+def test_state_and_dedup_stay_open_between_cycles(tmp_path, start_mock, concurrency):
+    mock = start_mock(size=60)
+    daemon = create_daemon(tmp_path, mock, state_db=str(tmp_path / 'state.sqlite'),
+                           dedup_db=str(tmp_path / 'dedup.sqlite'), concurrency=concurrency)
+    state, dedup = daemon.state, daemon.dedup
+    try:
+        daemon.run_cycle('full')
+        first = dict(dedup.stats)
+        daemon.run_cycle('full')
+
+        assert daemon.state is state and daemon.dedup is dedup
+        assert state.count_persons() == 0   # Цикл завершен - состояние очищено, но хранилище открыто
+        # Счетчики индекса сбрасываются перед циклом, поэтому второй полный цикл считает так же, как первый
+        assert dedup.stats == first and first['avoided'] > 0
+        assert daemon.cycles['full']['number'] == 2 and daemon.cycles['full']['failed_requests'] == 0
+        assert daemon.cycles['full']['added'] == 0 and daemon.cycles['full']['updated'] == 0
+    finally:
+        daemon.client.close()
+        state.close()
+        dedup.close()
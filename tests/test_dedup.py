@@ -0,0 +1,43 @@
+# -*- coding: UTF-8 -*-
+
+import time
+from pathlib import Path
+
+import pytest
+
+from async_crawler import crawl_async
+from conftest import create_settings
+from main import crawl
+from mock_api import MockHandler
+
+
+@pytest.mark.parametrize('concurrency', [0, 4])
+def test_copy_loads_person_itself_when_first_copy_fails(tmp_path, start_mock, concurrency):
+    mock = start_mock(size=60)
+    person = next(person for person in mock.dataset.persons['red'].values()
+                  if len(person['nationalities']) > 1 and person['pictures'])
+    picture = person['pictures'][0]
+    failed = []
+
+    class FailingHandler(MockHandler):
+        """
+        Первый запрос фото Персоны с двумя гражданствами получает 503: первая копия не загрузится. Ответ
+        задерживается, чтобы вторая копия успела начать ждать первую.
+        """
+        def do_GET(self):
+            if self.path.endswith(f'/images/{picture}') and not failed:
+                failed.append(self.path)
+                time.sleep(0.5)
+                return self.send_body({'error': 'Service Unavailable'}, status=503)
+            return super().do_GET()
+
+    mock.server.RequestHandlerClass = FailingHandler
+    settings = create_settings(tmp_path, mock, concurrency=concurrency, search_pages_id=['red'])
+    (crawl_async if concurrency else crawl)(settings)
+
+    assert failed
+    entity_dir = person['entity_id'].replace('/', '-')
+    saved = [nation for nation in person['nationalities']
+             if list(Path(settings.result_dir, 'red', mock.dataset.nations[nation], entity_dir).glob(f'{picture}.*'))]
+    # Первая копия без фото не сохранена, вторая загрузила Персону сама
+    assert len(saved) == len(person['nationalities']) - 1
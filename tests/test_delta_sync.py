@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+
+import json
+from pathlib import Path
+
+from conftest import create_settings
+from main import crawl
+
+
+def get_ids(changes: list) -> list:
+    return sorted((change['page_id'], change['nation'], change['entity_id']) for change in changes)
+
+
+def test_changelog_of_second_crawl(tmp_path, start_mock):
+    mock = start_mock(size=30)
+    settings = create_settings(tmp_path, mock, delta_db=str(tmp_path / 'delta.sqlite'))
+    expected = mock.dataset.count_expected()
+
+    first = crawl(settings)
+    assert len(first['added']) == expected and first['updated'] == first['removed'] == []
+    first_requests = mock.get_stats()['resources']
+
+    persons = mock.dataset.persons['red']
+    single = [person for person in persons.values() if len(person['nationalities']) == 1]
+    updated, removed = single[0], single[1]
+    updated['name'] = 'CHANGED'
+    del persons[removed['entity_id']]
+    added = {**single[2], 'entity_id': '2030/99999', 'pictures': []}
+    persons[added['entity_id']] = added
+
+    second = crawl(settings)
+
+    assert get_ids(second['added']) == [('red', added['nationalities'][0], added['entity_id'])]
+    assert get_ids(second['updated']) == [('red', updated['nationalities'][0], updated['entity_id'])]
+    assert get_ids(second['removed']) == [('red', removed['nationalities'][0], removed['entity_id'])]
+    # Фото неизмененных Персон повторно не скачиваются
+    assert mock.get_stats()['resources']['image'] == first_requests['image']
+
+    nation_name = mock.dataset.nations[updated['nationalities'][0]]
+    detail = Path(settings.result_dir, 'red', nation_name, updated['entity_id'].replace('/', '-'), 'detail.json')
+    assert json.loads(detail.read_text(encoding='utf-8'))['name'] == 'CHANGED'
+    nation_name = mock.dataset.nations[removed['nationalities'][0]]
+    removed_dir = Path(settings.result_dir, 'red', nation_name, removed['entity_id'].replace('/', '-'))
+    assert (removed_dir / 'removed.json').is_file() and (removed_dir / 'detail.json').is_file()
+    changelogs = sorted(Path(settings.result_dir, 'changelog').glob('*.json'))
+    assert changelogs and json.loads(changelogs[-1].read_text(encoding='utf-8'))['updated'] == second['updated']
+
+
+def test_failed_run_continues_same_changelog(tmp_path, start_mock):
+    mock = start_mock(size=30, error_rate=0.2)
+    settings = create_settings(tmp_path, mock, delta_db=str(tmp_path / 'delta.sqlite'))
+
+    # Часть запросов не удалась - запуск не завершен, и Персон без полной выдачи не отмечаем удаленными
+    assert crawl(settings) is None
+    assert not Path(settings.result_dir, 'changelog').exists()
+
+    mock.error_rate = 0
+    changelog = crawl(settings)
+    # Продолженный запуск выдает один список изменений на оба запуска
+    assert len(changelog['added']) == mock.dataset.count_expected() and changelog['removed'] == []
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+from conftest import create_settings
+from file_manager import FileWriter, save_file, write_file
+from main import crawl
+
+
+def test_writer_writes_in_background(tmp_path):
+    writer = FileWriter(workers=2, queue_size=2)
+    written = []
+    (tmp_path / 'file').write_text('')
+
+    for index in range(10):
+        writer.submit(tmp_path / 'persons' / str(index) / 'detail.json', {'index': index},
+                      on_done=lambda index=index: written.append(index))
+    # Папку нельзя создать внутри файла - ошибка записи не останавливает остальные файлы
+    writer.submit(tmp_path / 'file' / 'detail.json', {}, on_done=lambda: written.append('failed'))
+    writer.close()
+
+    assert sorted(written) == list(range(10))
+    assert (writer.written, writer.errors, writer.pending) == (10, 1, 0)
+    for index in range(10):
+        path = tmp_path / 'persons' / str(index) / 'detail.json'
+        assert json.loads(path.read_text(encoding='utf-8')) == {'index': index}
+    writer.close()      # Повторный вызов ничего не делает
+
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    path = tmp_path / 'detail.json'
+    write_file(path, b'previous')
+
+    with pytest.raises(TypeError):
+        write_file(path, 'not bytes', fsync='full')
+
+    assert path.read_bytes() == b'previous'
+    assert [item.name for item in tmp_path.iterdir()] == ['detail.json']    # Временный файл удален
+
+
+def test_removed_dir_is_created_again(tmp_path):
+    path = tmp_path / 'red' / 'Russia' / '2020-1' / 'detail.json'
+    save_file(path, {'entity_id': '2020/1'})
+    # Папка запомнена как созданная, но ее удалили во время обхода
+    shutil.rmtree(tmp_path / 'red')
+
+    save_file(path, {'entity_id': '2020/1'})
+
+    assert json.loads(path.read_text(encoding='utf-8')) == {'entity_id': '2020/1'}
+
+
+@pytest.mark.parametrize('writer_threads', [0, 2])
+def test_crawl_writes_tree_through_writer(tmp_path, start_mock, writer_threads):
+    mock = start_mock(size=30)
+    settings = create_settings(tmp_path, mock, writer_threads=writer_threads, writer_queue_size=4, fsync='file')
+
+    crawl(settings)
+
+    details = list(Path(settings.result_dir).glob('*/*/*/detail.json'))
+    assert len(details) == mock.dataset.count_expected()
+    assert not list(Path(settings.result_dir).rglob('.*.tmp'))
+    for path in details:
+        entity_id = json.loads(path.read_text(encoding='utf-8'))['entity_id']
+        assert entity_id.replace('/', '-') == path.parent.name
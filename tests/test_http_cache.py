@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 -*-
+
+from conftest import get_detail_url
+from http_cache import HttpCache
+from http_client import HttpClient
+
+
+def create_client(cache_dir, ttl: int) -> HttpClient:
+    return HttpClient(cache=HttpCache(cache_dir, max_size=1024 * 1024, ttl={'detail': ttl, 'image': ttl}))
+
+
+def test_fresh_entry_is_served_without_request(tmp_path, start_mock):
+    mock = start_mock()
+    client = create_client(tmp_path, ttl=3600)
+    url = get_detail_url(mock)
+
+    first = client.get(url, 'detail')
+    second = client.get(url, 'detail')
+
+    assert second.from_cache and second.content == first.content
+    assert mock.get_stats()['requests'] == 1
+    assert client.cache.stats == {'hits': 1, 'revalidated': 0, 'misses': 1, 'bytes_saved': len(first.content)}
+
+
+def test_stale_entry_is_revalidated_instead_of_downloaded(tmp_path, start_mock):
+    mock = start_mock()
+    client = create_client(tmp_path, ttl=0)    # Любая запись уже устарела
+    url = get_detail_url(mock)
+
+    first = client.get(url, 'detail')
+    assert first.headers['ETag'] and first.headers['Last-Modified']
+    second = client.get(url, 'detail')
+
+    assert second.status_code == 200 and second.from_cache and second.content == first.content
+    server = mock.get_stats()
+    assert server['requests'] == 2 and server['not_modified'] == 1
+    assert server['bytes'] == len(first.content)    # Тело отдано только первый раз
+    assert client.cache.stats == {'hits': 0, 'revalidated': 1, 'misses': 1, 'bytes_saved': len(first.content)}
+
+
+def test_changed_entry_is_downloaded_again(tmp_path, start_mock):
+    mock = start_mock()
+    client = create_client(tmp_path, ttl=0)
+    url = get_detail_url(mock)
+
+    first = client.get(url, 'detail')
+    next(iter(mock.dataset.persons['red'].values()))['name'] = 'CHANGED'
+    second = client.get(url, 'detail')
+
+    assert not getattr(second, 'from_cache', False) and second.content != first.content
+    assert mock.get_stats()['not_modified'] == 0
+    assert client.cache.stats['misses'] == 2 and client.cache.stats['revalidated'] == 0
+
+
+def test_stale_image_download_is_revalidated(tmp_path, start_mock):
+    mock = start_mock()
+    client = create_client(tmp_path / 'cache', ttl=0)
+    person = next(person for person in mock.dataset.persons['red'].values() if person['pictures'])
+    url = f"{get_detail_url(mock, person)}/images/{person['pictures'][0]}"
+
+    first = client.download(url, tmp_path / 'first', 'photo')
+    second = client.download(url, tmp_path / 'second', 'photo')
+
+    assert second.read_bytes() == first.read_bytes()
+    assert mock.get_stats()['not_modified'] == 1
+    assert mock.get_stats()['bytes'] == mock.dataset.image_size
+    assert client.cache.stats['revalidated'] == 1 and client.cache.stats['misses'] == 1
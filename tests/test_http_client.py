@@ -0,0 +1,48 @@
+# -*- coding: UTF-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import create_settings, get_detail_url
+from http_client import HttpClient
+from main import create_client, crawl
+
+
+def test_requests_reuse_one_connection(start_mock):
+    mock = start_mock()
+    client = HttpClient()
+    urls = [get_detail_url(mock, person) for person in mock.dataset.persons['red'].values()]
+
+    for url in urls:
+        assert client.get(url, 'detail').status_code == 200
+
+    assert client.get_stats() == {'requests': len(urls), 'connections': 1}
+    assert mock.get_stats()['requests'] == len(urls)
+    client.close()
+
+
+def test_threads_share_pool(start_mock):
+    mock = start_mock()
+    client = HttpClient(pool_size=4)
+    urls = [get_detail_url(mock, person) for person in mock.dataset.persons['red'].values()] * 5
+
+    with ThreadPoolExecutor(4) as executor:
+        statuses = list(executor.map(lambda url: client.get(url, 'detail').status_code, urls))
+
+    assert statuses == [200] * len(urls)
+    # Потоков не больше размера пула, поэтому каждый поток держит свое соединение и не открывает новых
+    assert client.get_stats()['requests'] == len(urls) and client.get_stats()['connections'] <= 4
+    client.close()
+
+
+def test_crawl_uses_shared_client(tmp_path, start_mock):
+    mock = start_mock(size=30)
+    settings = create_settings(tmp_path, mock)
+    client = create_client(settings)
+
+    crawl(settings, client=client)
+
+    stats = client.get_stats()
+    # Все запросы обхода, включая фото из фоновых потоков, ушли через один клиент и его пул соединений
+    assert stats['requests'] == mock.get_stats()['requests'] > mock.dataset.count_expected()
+    assert stats['connections'] <= settings.image_workers + 1
+    client.close()
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+
+import threading
+
+from bs_interface import ImageLink
+from conftest import get_detail_url
+from http_client import HttpClient
+from image_pipeline import ImagePipeline
+
+
+def get_image_links(mock, count: int) -> list:
+    """Ссылки на фото первых Персон набора, у которых фото есть."""
+    links = []
+    for person in mock.dataset.persons['red'].values():
+        for picture_id in person['pictures']:
+            links.append(ImageLink(name=picture_id, url=f'{get_detail_url(mock, person)}/images/{picture_id}',
+                                   default_suffix='jpg'))
+    return links[:count]
+
+
+def test_images_are_streamed_to_person_dir(tmp_path, start_mock):
+    mock = start_mock()
+    client = HttpClient()
+    pipeline = ImagePipeline(client=client, workers=2, queue_size=2)
+    links = get_image_links(mock, 5)
+    missing = links[0]._replace(name='missing', url=f'{links[0].url}-missing')
+    done = []
+
+    def on_done(images, failed):
+        done.append((images, failed))
+
+    pipeline.submit(tmp_path / 'person', [*links, missing], on_done=on_done)
+    pipeline.submit(tmp_path / 'empty', [], on_done=on_done)
+    pipeline.close()
+
+    # Персона без фото завершается сразу, Персона с фото - после последнего из них, с учетом неудачного
+    assert done[0] == ({}, 0)
+    images, failed = done[1]
+    assert failed == 1 and sorted(images) == sorted(f'{link.name}.jpeg' for link in links)
+    for name, path in images.items():
+        assert path == tmp_path / 'person' / name and path.stat().st_size == mock.dataset.image_size
+    # Временные файлы загрузки не остаются в папке Персоны
+    assert sorted(path.name for path in (tmp_path / 'person').iterdir()) == sorted(images)
+    client.close()
+
+
+def test_submit_waits_for_free_queue_slot(tmp_path, start_mock):
+    mock = start_mock(latency=0.05)
+    client = HttpClient()
+    pipeline = ImagePipeline(client=client, workers=1, queue_size=2)
+    links = get_image_links(mock, 6)
+    finished = threading.Event()
+
+    pipeline.submit(tmp_path, links, on_done=lambda images, failed: finished.set())
+
+    # Обход ждал, пока в очереди освободится место: последнее фото встало в очередь, когда в ней было не больше
+    # одного, значит поток уже взял четвертое фото, а первые три скачал
+    assert mock.get_stats()['resources'].get('image', 0) >= 3
+    assert not finished.is_set()
+    pipeline.flush()
+    assert finished.is_set() and mock.get_stats()['resources']['image'] == len(links)
+    pipeline.close()
+    client.close()
+
+
+def test_without_workers_images_are_downloaded_in_caller(tmp_path, start_mock):
+    mock = start_mock()
+    client = HttpClient()
+    pipeline = ImagePipeline(client=client, workers=0)
+    links = get_image_links(mock, 3)
+    done = []
+
+    pipeline.submit(tmp_path, links, on_done=lambda images, failed: done.append(len(images)))
+
+    assert done == [len(links)] and mock.get_stats()['resources']['image'] == len(links)
+    pipeline.close()
+    client.close()
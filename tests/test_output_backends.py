@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+
+import gzip
+import hashlib
+import json
+import sqlite3
+import zlib
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from blob_store import BlobStore
+from conftest import create_settings
+from main import crawl
+from output_backends import BatchOutput, JsonlOutput, SqliteOutput, get_output_path, merge_outputs
+
+
+def add_blob(blobs: BlobStore, url: str, body: bytes) -> str:
+    """Кладет фото в хранилище так же, как его скачивает `HttpClient.download()`."""
+    temp_path = blobs.get_temp_path('test')
+    temp_path.write_bytes(body)
+    digest = hashlib.sha256(body).hexdigest()
+    blobs.add(url, temp_path, digest, 'jpg', None)
+    return digest
+
+
+def get_person(entity_id: str, urls: list = ()) -> SimpleNamespace:
+    """Превью Персоны со ссылками на фото, как `PersonPreview`."""
+    return SimpleNamespace(preview_json={'entity_id': entity_id, 'name': 'IVANOV'},
+                           image_links=[SimpleNamespace(name=f'image{index}', url=url)
+                                        for index, url in enumerate(urls)])
+
+
+def read_records(path: Path) -> dict:
+    """Актуальные записи формата вывода: {(тип страницы, гражданство, entity_id): (`kind`, данные, имена фото)}."""
+    records = {}
+    if path.name.endswith('.jsonl.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as fp:
+            for line in fp:
+                record = json.loads(line)
+                key = record['page_id'], record['nation'], record['entity_id']
+                if record['kind'] == 'removed':
+                    record['data'], record['images'] = records[key][1], [{'name': name} for name in records[key][2]]
+                records[key] = record['kind'], record['data'], sorted(image['name'] for image in record['images'])
+        return records
+    connection = sqlite3.connect(str(path))
+    images = {}
+    for page_id, nation, entity_id, name in connection.execute('SELECT page_id, nation, entity_id, name FROM images'):
+        images.setdefault((page_id, nation, entity_id), []).append(name)
+    for page_id, nation, entity_id, kind, data in connection.execute(
+            'SELECT page_id, nation, entity_id, kind, data FROM notices'):
+        key = page_id, nation, entity_id
+        records[key] = kind, json.loads(data), sorted(images.get(key, []))
+    connection.close()
+    return records
+
+
+def count_gzip_members(path: Path) -> int:
+    data, members = path.read_bytes(), 0
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        members += 1
+    return members
+
+
+def test_batch_output_requires_write():
+    class NoWrite(BatchOutput):
+        pass
+
+    with pytest.raises(TypeError):
+        NoWrite(blobs=None)
+
+
+@pytest.mark.parametrize('output_class, name', [(JsonlOutput, 'notices.jsonl.gz'), (SqliteOutput, 'notices.sqlite')])
+def test_round_trip(tmp_path, output_class, name):
+    blobs = BlobStore(tmp_path / 'blobs')
+    digest = add_blob(blobs, 'http://host/1', b'photo')
+    output = output_class(tmp_path / name, blobs=blobs, batch_size=2)
+    saved = []
+
+    for entity_id in ('2020/1', '2020/2', '2020/3'):
+        output.save_person('red', 'RU', 'Russia', None, get_person(entity_id, ['http://host/1', 'http://host/2']),
+                           on_saved=lambda entity_id=entity_id: saved.append(entity_id))
+    # Персоны отмечаются сохраненными только после записи своей пачки
+    assert saved == ['2020/1', '2020/2']
+    output.flush()
+    assert saved == ['2020/1', '2020/2', '2020/3']
+    output.remove_person('red', 'RU', 'Russia', None, '2020/2')
+    output.close()
+
+    records = read_records(tmp_path / name)
+    # Фото, которого нет в хранилище (не скачано), в запись не попадает
+    assert records[('red', 'RU', '2020/1')] == ('preview', {'entity_id': '2020/1', 'name': 'IVANOV'}, ['image0.jpg'])
+    # Метка удаления сохраняет прежние данные и фото Персоны
+    assert records[('red', 'RU', '2020/2')] == ('removed', {'entity_id': '2020/2', 'name': 'IVANOV'}, ['image0.jpg'])
+    assert len(records) == 3
+    if output_class is SqliteOutput:
+        connection = sqlite3.connect(str(tmp_path / name))
+        assert connection.execute('SELECT sha256, file FROM images').fetchall() == \
+            [(digest, str(Path(digest[:2], digest)))] * 3
+        connection.close()
+    else:
+        assert count_gzip_members(tmp_path / name) == 3     # Один gzip-блок на каждую пачку
+    blobs.close()
+
+
+@pytest.mark.parametrize('backend', ['jsonl', 'sqlite'])
+def test_sharded_crawl_is_merged(tmp_path, start_mock, backend):
+    mock = start_mock(size=40)
+    settings = create_settings(tmp_path, mock, output_backend=backend, output_batch_size=7)
+    for shard in ((1, 2), (2, 2)):
+        crawl(settings, shard=shard)
+    parts = sorted(path.name for path in Path(settings.result_dir).glob(get_output_path(settings, '*').name))
+    assert parts == [get_output_path(settings, f'shard-{index}-of-2').name for index in (1, 2)]
+
+    assert merge_outputs(settings) == 2
+
+    records = read_records(get_output_path(settings))
+    assert len(records) == mock.dataset.count_expected()
+    assert not list(Path(settings.result_dir).glob(get_output_path(settings, '*').name))
+    for (page_id, nation, entity_id), (kind, data, images) in records.items():
+        person = mock.dataset.persons[page_id][entity_id]
+        assert kind == 'detail' and data['entity_id'] == entity_id
+        assert nation in person['nationalities'] and len(images) == len(person['pictures'])
+
+
+def test_merge_replaces_records_of_repeated_crawl(tmp_path, start_mock):
+    mock = start_mock(size=20)
+    settings = create_settings(tmp_path, mock, output_backend='sqlite')
+    crawl(settings)
+    crawl(settings, shard=(1, 1))   # Повторный обход той же выдачи одним шардом
+    merge_outputs(settings)
+
+    # Записи части заменяют прежние записи тех же Персон, а не дублируют их
+    assert len(read_records(get_output_path(settings))) == mock.dataset.count_expected()
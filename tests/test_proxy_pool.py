@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+
+import random
+import time
+from collections import Counter
+
+import pytest
+import requests
+
+from conftest import create_settings, get_detail_url
+from main import create_client
+from proxy_pool import DIRECT, Proxy, ProxyPool
+
+
+@pytest.fixture(autouse=True)
+def no_env_proxies(monkeypatch):
+    """Прокси и исключения из окружения не должны влиять на выбор маршрута."""
+    for name in ('HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'http_proxy', 'https_proxy', 'no_proxy'):
+        monkeypatch.delenv(name, raising=False)
+    random.seed(1)
+
+
+def send(pool: ProxyPool, url: str) -> int:
+    """Статус ответа через пул или `0`, если прокси недоступен."""
+    try:
+        return pool.send(url, {'timeout': 5}).status_code
+    except requests.ConnectionError:
+        return 0
+
+
+def test_requests_go_through_proxy(start_mock):
+    origin, proxy = start_mock(), start_mock()
+    pool = ProxyPool([proxy.url])
+
+    assert send(pool, get_detail_url(origin)) == 200
+    assert proxy.get_stats()['proxied'] == 1
+    assert origin.get_stats()['requests'] == 0
+    pool.close()
+
+
+def test_direct_without_proxies(tmp_path, start_mock):
+    mock = start_mock()
+    client = create_client(create_settings(tmp_path, mock, proxies=[]))
+    assert client.proxies is None
+
+    assert client.get(get_detail_url(mock), 'detail').status_code == 200
+    assert mock.get_stats()['requests'] == 1 and mock.get_stats()['proxied'] == 0
+    client.close()
+    with pytest.raises(ValueError):
+        ProxyPool([])
+
+
+def test_direct_in_pool(start_mock, monkeypatch):
+    mock, env_proxy = start_mock(), start_mock()
+    monkeypatch.setenv('HTTP_PROXY', env_proxy.url)     # Прокси окружения не должен перехватить `direct`
+    pool = ProxyPool([DIRECT])
+
+    assert pool.choose().proxies == {}
+    assert send(pool, get_detail_url(mock)) == 200
+    assert mock.get_stats()['requests'] == 1 and mock.get_stats()['proxied'] == 0
+    assert env_proxy.get_stats()['requests'] == 0
+    pool.close()
+
+
+def test_failing_proxy_is_ejected(start_mock):
+    origin, failing, healthy = start_mock(), start_mock(error_rate=1), start_mock()
+    pool = ProxyPool([failing.url, healthy.url], eject_time=60, max_failures=3)
+    bad, good = pool.proxies
+    url = get_detail_url(origin)
+
+    statuses = [send(pool, url) for _ in range(30)]
+
+    # Три ответа 503 подряд исключают прокси, дальше все запросы идут через исправный
+    assert statuses.count(503) == 3 and bad.stats == {'requests': 3, 'errors': 3, 'ejected': 1}
+    assert statuses[-10:] == [200] * 10
+    assert good.stats['requests'] == 27 and healthy.get_stats()['proxied'] == 27
+    assert [proxy['is_ejected'] for proxy in pool.get_stats()] == [True, False]
+    pool.close()
+
+
+def test_ejected_proxy_returns_with_doubled_backoff(start_mock):
+    origin = start_mock()
+    pool = ProxyPool(['http://127.0.0.1:1', DIRECT], eject_time=0.2, max_failures=2)
+    dead, direct = pool.proxies
+    url = get_detail_url(origin)
+
+    durations = []
+    for _ in range(3):
+        while not dead.ejected_until:
+            send(pool, url)
+        durations.append(dead.ejected_until - time.monotonic())
+        assert all(pool.choose() is direct for _ in range(20))     # Исключенный прокси не выбирается
+        time.sleep(durations[-1] + 0.01)
+        assert pool.choose() and not dead.ejected_until     # Срок истек - прокси снова в ротации
+        assert dead.error_rate == 0 and dead.admitted == 0
+
+    # Каждое следующее исключение подряд вдвое дольше
+    assert [round(duration, 1) for duration in durations] == [0.2, 0.4, 0.8]
+    assert dead.stats['ejected'] == 3
+    pool.close()
+
+
+def test_successes_reset_backoff():
+    pool = ProxyPool(['http://proxy:1'], eject_time=0.01, max_failures=1, min_requests=3)
+    proxy = pool.proxies[0]
+    pool.report(proxy, 0.1, error=True)
+    assert proxy.ejections == 1
+    time.sleep(0.02)
+    pool.choose()
+    for _ in range(3):
+        pool.report(proxy, 0.1, error=False)
+    assert proxy.ejections == 0
+
+
+def test_error_rate_ejects_after_min_requests():
+    pool = ProxyPool(['http://proxy:1'], max_failures=10, max_error_rate=0.3, min_requests=4)
+    proxy = pool.proxies[0]
+    # Доля ошибок: 0.2, 0.16, 0.328 - выше порога, но запросов еще мало; 0.4624 на четвертом
+    for error in (True, False, True):
+        pool.report(proxy, 0.1, error=error)
+        assert not proxy.ejected_until
+    pool.report(proxy, 0.1, error=True)
+    assert proxy.ejected_until and proxy.stats['ejected'] == 1
+
+
+def test_retry_after_pauses_proxy_without_ejection():
+    pool = ProxyPool(['http://first:1', 'http://second:1'])
+    first, second = pool.proxies
+    pool.report(first, 0.1, error=True, retry_after=5)
+
+    assert 4.9 < first.ejected_until - time.monotonic() <= 5
+    assert first.ejections == 0 and first.stats['ejected'] == 0
+    assert all(pool.choose() is second for _ in range(20))
+
+
+def test_all_ejected_uses_first_to_return():
+    pool = ProxyPool(['http://first:1', 'http://second:1'])
+    first, second = pool.proxies
+    pool.report(first, 0.1, error=True, retry_after=10)
+    pool.report(second, 0.1, error=True, retry_after=5)
+    assert pool.choose() is second
+
+
+def test_health_is_exponential_moving_average():
+    proxy = Proxy(DIRECT, smoothing=0.5)
+    proxy.report(1.0, error=False)
+    proxy.report(3.0, error=False)
+    assert proxy.latency == 2.0 and proxy.error_rate == 0
+    proxy.report(10.0, error=True)      # Задержка ошибок не учитывается
+    proxy.report(1.0, error=True)
+    assert proxy.latency == 2.0 and proxy.error_rate == 0.75
+    assert proxy.stats == {'requests': 4, 'errors': 2, 'ejected': 0}
+    proxy.close()
+
+
+def test_choice_is_weighted_by_health():
+    pool = ProxyPool(['http://fast:1', 'http://slow:1', 'http://flaky:1', 'http://new:1'])
+    fast, slow, flaky, new = pool.proxies
+    fast.latency, slow.latency, flaky.latency = 0.1, 0.4, 0.1
+    flaky.error_rate = 0.5
+
+    counts = Counter(pool.choose().get_name() for _ in range(10000))
+
+    # Веса 10, 2.5, 5 и 10: еще не измеренный прокси считается не медленнее лучшего
+    shares = {name: count / 10000 for name, count in counts.items()}
+    for proxy, expected in ((fast, 10 / 27.5), (slow, 2.5 / 27.5), (flaky, 5 / 27.5), (new, 10 / 27.5)):
+        assert abs(shares[proxy.get_name()] - expected) < 0.02
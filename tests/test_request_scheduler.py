@@ -0,0 +1,231 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import threading
+import time
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from conftest import get_detail_url
+from http_client import HttpClient
+from request_scheduler import AdaptiveLimit, RequestScheduler, TokenBucket
+
+
+def create_client(**kwargs) -> HttpClient:
+    """Клиент с планировщиком без долгих задержек между повторами."""
+    return HttpClient(scheduler=RequestScheduler(**{'backoff_base': 0.001, 'backoff_max': 0.01, **kwargs}))
+
+
+def test_token_bucket_keeps_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    started = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # Первый запрос уходит сразу, остальные 10 - по одному в 1/50 секунды
+    assert 0.18 <= time.monotonic() - started < 0.35
+
+
+def test_token_bucket_allows_burst_after_idle():
+    bucket = TokenBucket(rate=10, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    bucket.acquire()    # Шестой ждет пополнения
+    assert time.monotonic() - started >= 0.08
+
+
+def test_token_bucket_pause_stops_requests():
+    bucket = TokenBucket(rate=0)
+    bucket.pause(0.2)
+    started = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - started >= 0.19
+
+
+def test_retry_after_pauses_request(start_mock):
+    mock = start_mock(rate_limit=2)     # Два запроса подряд, третий получает 429 с `Retry-After: 1`
+    client = create_client(retries=2, backoff_max=2)
+    url = get_detail_url(mock)
+
+    started = time.monotonic()
+    responses = [client.get(url, 'detail') for _ in range(3)]
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert time.monotonic() - started >= 0.95      # Ждали `Retry-After`, а не короткую задержку повтора
+    assert mock.get_stats()['throttled'] == 1
+    assert client.scheduler.stats == {'retries': 1, 'throttled': 1, 'failed': 0}
+
+
+def test_retry_after_is_capped_by_backoff_max():
+    scheduler = RequestScheduler(retries=1, backoff_max=0.2)
+    replies = [get_response(429, {'Retry-After': '86400'}), get_response(200)]
+
+    started = time.monotonic()
+    response = scheduler.request('http://host/a', lambda: replies.pop(0))
+
+    assert response.status_code == 200
+    assert 0.19 <= time.monotonic() - started < 1
+    assert scheduler.get_delay(0, get_response(429, {'Retry-After': 'Wed, 21 Oct 2099 07:28:00 GMT'})) == 0.2
+
+
+def test_other_errors_are_not_throttling():
+    scheduler = RequestScheduler(retries=3, initial_concurrency=4)
+
+    def send_broken():
+        raise requests.exceptions.InvalidURL('bad url')
+
+    with pytest.raises(requests.exceptions.InvalidURL):
+        scheduler.request('http://host/a', send_broken)
+    # Ошибка запроса не повторяется и не меняет лимит хоста
+    assert scheduler.get_limits() == {'host': 4}
+    assert scheduler.stats == {'retries': 0, 'throttled': 0, 'failed': 0}
+
+
+def get_response(status: int, headers: dict = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(b'')     # Планировщик закрывает ответ перед повтором
+    return response
+
+
+def test_retry_after_pauses_whole_host():
+    scheduler = RequestScheduler(retries=1)
+    throttled = threading.Event()
+    replies = [get_response(429, {'Retry-After': '0.5'}), get_response(200)]
+
+    def send_throttled():
+        reply = replies.pop(0)
+        if reply.status_code == 429:
+            throttled.set()
+        return reply
+
+    worker = threading.Thread(target=scheduler.request, args=('http://host/a', send_throttled))
+    worker.start()
+    assert throttled.wait(1)
+    time.sleep(0.05)    # Пауза хоста ставится сразу после ответа 429
+    started = time.monotonic()
+    response = scheduler.request('http://host/b', lambda: get_response(200))
+    worker.join()
+
+    assert response.status_code == 200
+    assert time.monotonic() - started >= 0.35   # Другой запрос к тому же хосту ждал окончания паузы
+    assert scheduler.stats == {'retries': 1, 'throttled': 1, 'failed': 0}
+
+
+def test_adaptive_limit_halves_on_throttling_and_grows_additively():
+    limit = AdaptiveLimit(max_limit=8, cooldown=0, initial_limit=8)
+    for expected in (4, 2, 1, 1):
+        limit.acquire()
+        limit.release(latency=0.01, throttled=True)
+        assert limit.limit == expected
+
+    limit.limit = 2.0
+    grown = []
+    for _ in range(3):
+        limit.acquire()
+        limit.release(latency=0.01, throttled=False)
+        grown.append(int(limit.limit))
+    # Примерно +1 за каждые `limit` успешных запросов: 2 -> 2.5 -> 2.9 -> 3.24
+    assert grown == [2, 2, 3]
+
+
+def test_adaptive_limit_ramps_up_under_low_latency():
+    limit = AdaptiveLimit(max_limit=8, cooldown=0)
+    assert limit.limit == 1     # Начинаем с минимума, а не с потолка
+    grown = []
+    for _ in range(9):
+        limit.acquire()
+        limit.release(latency=0.01, throttled=False)
+        grown.append(int(limit.limit))
+    # Медленный старт: +1 за каждый успешный запрос, но не выше `max_limit`
+    assert grown == [2, 3, 4, 5, 6, 7, 8, 8, 8]
+
+    limit.acquire()
+    limit.release(latency=0.01, throttled=True)
+    assert limit.limit == 4
+    for _ in range(4):
+        limit.acquire()
+        limit.release(latency=0.01, throttled=False)
+    assert int(limit.limit) == 4    # После перегрузки рост уже аддитивный: +1 за `limit` запросов
+
+
+def test_scheduler_ramps_up_concurrency(start_mock):
+    mock = start_mock()
+    client = create_client(max_concurrency=6)
+    url = get_detail_url(mock)
+    assert client.get(url, 'detail').status_code == 200
+    host = urlsplit(url).netloc
+    assert client.scheduler.get_limits()[host] == 2
+    for _ in range(10):
+        client.get(url, 'detail')
+    assert client.scheduler.get_limits()[host] == 6
+
+
+def test_adaptive_limit_does_not_grow_on_slow_responses_and_respects_cooldown():
+    limit = AdaptiveLimit(max_limit=8, latency_target=0.5, cooldown=60, initial_limit=8)
+    limit.acquire()
+    limit.release(latency=1.0, throttled=False)
+    assert limit.limit == 8
+    for _ in range(3):     # Одна перегрузка приходит сразу на все одновременные запросы
+        limit.acquire()
+        limit.release(latency=0.01, throttled=True)
+    assert limit.limit == 4
+
+
+def test_adaptive_limit_blocks_above_limit():
+    limit = AdaptiveLimit(max_limit=1)
+    limit.acquire()
+    waiter = threading.Thread(target=limit.acquire)
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()    # Второй запрос ждет, пока лимит занят
+    limit.release(latency=0.01, throttled=False)
+    waiter.join(1)
+    assert not waiter.is_alive() and limit.active == 1
+
+
+def test_stats_when_server_always_fails(start_mock):
+    mock = start_mock(error_rate=1)
+    client = create_client(retries=2, max_concurrency=10, initial_concurrency=10)
+    url = get_detail_url(mock)
+
+    response = client.get(url, 'detail')
+
+    assert response.status_code == 503     # После всех повторов возвращается последний ответ
+    assert mock.get_stats()['requests'] == 3
+    assert client.scheduler.stats == {'retries': 2, 'throttled': 3, 'failed': 1}
+    assert client.scheduler.get_limits()[urlsplit(url).netloc] == 5     # Одно уменьшение за время `cooldown`
+
+
+def test_stats_match_server_with_random_errors(start_mock):
+    mock = start_mock(error_rate=0.3)
+    client = create_client(retries=3)
+    url = get_detail_url(mock)
+
+    statuses = [client.get(url, 'detail').status_code for _ in range(40)]
+
+    server = mock.get_stats()
+    stats = client.scheduler.stats
+    assert server['requests'] == 40 + stats['retries']
+    assert stats['throttled'] == server['errors']
+    assert stats['failed'] == statuses.count(503)
+    assert stats['retries'] == stats['throttled'] - stats['failed']
+
+
+def test_connection_errors_are_retried_and_raised():
+    client = create_client(retries=2)
+    with pytest.raises(requests.ConnectionError):
+        client.get('http://127.0.0.1:1/notices/v1/red', 'search')
+    assert client.scheduler.stats == {'retries': 2, 'throttled': 3, 'failed': 1}
+
+
+def test_reset_stats():
+    client = create_client(retries=0)
+    with pytest.raises(requests.ConnectionError):
+        client.get('http://127.0.0.1:1/notices/v1/red', 'search')
+    client.scheduler.reset_stats()
+    assert client.scheduler.stats == {'retries': 0, 'throttled': 0, 'failed': 0}
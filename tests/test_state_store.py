@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+
+from pathlib import Path
+
+import pytest
+
+from async_crawler import crawl_async
+from conftest import create_settings
+from main import crawl
+from state_store import StateStore
+
+
+def test_state_survives_reopen(tmp_path):
+    state = StateStore(tmp_path / 'state.sqlite')
+    state.save_search_node('red', 'RU', 'M', 0, 120, split=True, total=300, sub_ranges=[[0, 38], [39, 120]])
+    state.save_search_node('red', 'RU', 'M', 0, 38, notices={'2020/1': {'entity_id': '2020/1'}})
+    state.save_person('red', 'RU', '2020/1', ['image0.jpg'])
+    state.close()
+
+    state = StateStore(tmp_path / 'state.sqlite')
+    assert state.get_search_node('red', 'RU', 'M', 0, 120) == \
+        {'split': True, 'total': 300, 'notices': {}, 'sub_ranges': [[0, 38], [39, 120]]}
+    assert state.get_search_node('red', 'RU', 'M', 0, 38)['notices'] == {'2020/1': {'entity_id': '2020/1'}}
+    assert state.get_search_node('red', 'RU', 'F', 0, 120) is None
+    assert state.is_person_done('red', 'RU', '2020/1') and not state.is_person_done('red', 'UA', '2020/1')
+
+    state.clear()
+    assert state.count_persons() == 0 and state.get_search_node('red', 'RU', 'M', 0, 120) is None
+    state.close()
+
+
+@pytest.mark.parametrize('concurrency', [0, 4])
+def test_interrupted_crawl_is_resumed(tmp_path, start_mock, concurrency):
+    mock = start_mock(size=40, error_rate=0.2)
+    settings = create_settings(tmp_path, mock, state_db=str(tmp_path / 'state.sqlite'), concurrency=concurrency)
+    run = crawl_async if concurrency else crawl
+
+    run(settings)
+    # Часть запросов не удалась - состояние сохранено вместе с уже загруженными Персонами
+    state = StateStore(settings.state_db)
+    done = state.count_persons()
+    state.close()
+    expected = mock.dataset.count_expected()
+    assert 0 < done < expected
+    first = mock.get_stats()['resources']
+
+    mock.error_rate = 0
+    run(settings)
+
+    second = {resource: count - first.get(resource, 0) for resource, count in mock.get_stats()['resources'].items()}
+    # Продолженный обход не запрашивает заново ни сохраненных Персон, ни выполненных узлов поиска
+    assert second['detail'] <= expected - done
+    assert second['search'] < first['search']
+    assert len(list(Path(settings.result_dir).glob('*/*/*'))) == expected
+    state = StateStore(settings.state_db)
+    assert state.count_persons() == 0     # Обход завершен - состояние очищено
+    state.close()
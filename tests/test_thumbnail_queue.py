@@ -0,0 +1,47 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+from pathlib import Path
+
+from conftest import create_settings
+from main import crawl, get_thumbnail_db, run_thumbnails
+from mock_api import MockHandler
+from thumbnail_queue import ThumbnailQueue
+
+
+def test_failed_thumbnail_is_retried_by_thumbnails_pass(tmp_path, start_mock, caplog):
+    mock = start_mock(size=30)
+    person = next(person for person in mock.dataset.persons['red'].values() if person['pictures'])
+    thumbnail = f"/images/{person['pictures'][0]}"
+    failing = [True]
+
+    class FailingHandler(MockHandler):
+        """Миниатюра одной Персоны не скачивается, пока не сброшен флаг `failing`."""
+        def do_GET(self):
+            if failing[0] and self.path.endswith(thumbnail):
+                return self.send_body({'error': 'Service Unavailable'}, status=503)
+            return super().do_GET()
+
+    mock.server.RequestHandlerClass = FailingHandler
+    settings = create_settings(tmp_path, mock, preview_only=True, search_pages_id=['red'])
+    assert settings.preview_thumbnails == 'deferred' and not settings.thumbnail_db
+    with caplog.at_level(logging.WARNING):
+        crawl(settings)
+
+    # Очередь по-умолчанию лежит в папке результатов и переживает конец запуска
+    assert get_thumbnail_db(settings) == Path(settings.result_dir, 'thumbnails.sqlite')
+    queue = ThumbnailQueue(get_thumbnail_db(settings))
+    assert [(item['entity_id'], item['attempts']) for item in queue.get_pending()] == [(person['entity_id'], 1)]
+    queue.close()
+    assert '--thumbnails' in caplog.text
+    nation_name = mock.dataset.nations[person['nationalities'][0]]
+    person_dir = Path(settings.result_dir, 'red', nation_name, person['entity_id'].replace('/', '-'))
+    assert (person_dir / 'preview.json').exists() and not list(person_dir.glob('thumbnail.*'))
+
+    failing[0] = False
+    run_thumbnails(settings)
+
+    queue = ThumbnailQueue(get_thumbnail_db(settings))
+    assert queue.get_pending() == []
+    queue.close()
+    assert list(person_dir.glob('thumbnail.*'))
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+
+import time
+from pathlib import Path
+
+from conftest import create_settings
+from main import crawl, merge_results
+from work_queue import WorkQueue, in_shard
+
+ITEMS = [('red', 'RU', 'M'), ('red', 'RU', 'F'), ('yellow', 'UA', 'M')]
+
+
+def test_shard_is_leased_to_one_owner(tmp_path):
+    first, second = WorkQueue(tmp_path / 'queue.sqlite'), WorkQueue(tmp_path / 'queue.sqlite')
+    first.populate(ITEMS)
+    second.populate(ITEMS)      # Повторное заполнение другим процессом ничего не дублирует
+
+    claimed = [first.claim('first'), second.claim('second'), first.claim('first')]
+    assert sorted((shard['page_id'], shard['nation'], shard['gender']) for shard in claimed) == sorted(ITEMS)
+    assert second.claim('second') is None
+
+    first.complete(claimed[0]['id'], 'first')
+    first.complete(claimed[1]['id'], 'first')       # Чужой шард не отмечается выполненным
+    second.release(claimed[1]['id'], 'second')
+    assert first.get_counts() == {'pending': 1, 'leased': 1, 'done': 1, 'failed': 0}
+    assert first.claim('first')['id'] == claimed[1]['id']
+    first.close()
+    second.close()
+
+
+def test_expired_lease_goes_to_another_owner(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite', lease=0.3, max_attempts=2)
+    queue.populate(ITEMS[:1])
+    shard = queue.claim('dead')
+    assert queue.claim('alive') is None
+
+    time.sleep(0.4)
+    assert queue.claim('alive')['id'] == shard['id']
+    # Упавший процесс потерял аренду и не может ни продлить, ни завершить шард
+    assert not queue.renew(shard['id'], 'dead')
+    queue.complete(shard['id'], 'dead')
+    assert queue.get_counts()['leased'] == 1
+
+    time.sleep(0.4)
+    assert queue.claim('third') is None      # Попытки шарда исчерпаны
+    assert queue.get_counts() == {'pending': 0, 'leased': 0, 'done': 0, 'failed': 1}
+    assert queue.retry_failed() == 1 and queue.claim('third')['id'] == shard['id']
+    queue.close()
+
+
+def test_keep_alive_renews_lease(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite', lease=0.3)
+    queue.populate(ITEMS[:1])
+    shard = queue.claim('worker')
+
+    with queue.keep_alive(shard['id'], 'worker'):
+        time.sleep(0.7)
+        assert queue.claim('other') is None
+
+    queue.close()
+
+
+def test_static_shards_split_all_combinations():
+    items = [(page_id, nation, gender) for page_id in ('red', 'yellow') for nation in ('RU', 'UA', 'US', 'DE')
+             for gender in ('M', 'F', 'U')]
+    shards = [[item for item in items if in_shard(*item, (index, 3))] for index in (1, 2, 3)]
+    # Каждая комбинация попадает ровно в один шард, и ни один шард не пуст
+    assert sorted(sum(shards, [])) == sorted(items) and all(shards)
+
+
+def test_shard_of_stopped_worker_is_crawled_by_another(tmp_path, start_mock):
+    mock = start_mock(size=40)
+    settings = create_settings(tmp_path, mock, work_queue=str(tmp_path / 'queue.sqlite'), shard_lease=0.5,
+                               state_db=str(tmp_path / 'state.sqlite'))
+    queue = WorkQueue(settings.work_queue, lease=settings.shard_lease)
+
+    crawl(settings, queue=queue, worker_id='first')
+    counts = queue.get_counts()
+    assert counts['done'] > 1 and counts['pending'] == counts['leased'] == 0
+
+    # Процесс взял шард и остановился, не отметив его выполненным
+    queue.connection.execute("UPDATE shards SET status='pending' WHERE id=1")
+    assert queue.claim('stopped')['id'] == 1
+    crawl(settings, queue=queue, worker_id='second')
+    assert queue.get_counts()['leased'] == 1       # Аренда еще не истекла - шард не трогаем
+    time.sleep(0.6)
+    crawl(settings, queue=queue, worker_id='second')
+    assert queue.get_counts() == {'pending': 0, 'leased': 0, 'done': counts['done'], 'failed': 0}
+    queue.close()
+
+    merge_results(settings)
+    assert not Path(settings.work_queue).exists()
+    assert len(list(Path(settings.result_dir).glob('*/*/*'))) == mock.dataset.count_expected()
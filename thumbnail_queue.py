@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+from bs_interface import PersonPreview
+from file_manager import link_file
+from http_client import HttpClient
+from image_pipeline import ImagePipeline
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailQueue:
+    """
+    Очередь отложенных миниатюр обхода `preview_only`. Запись Превью сохраняется сразу после поиска, без миниатюры,
+    а миниатюра попадает сюда вместе с данными Превью и скачивается в фоне (`ThumbnailFetcher`).
+    Скачанная миниатюра удаляется из очереди. Неудачная остается с количеством попыток и последней ошибкой,
+    и ее повторит следующий обход или команда `python main.py --thumbnails`.
+    """
+
+    def __init__(self, db_path=''):
+        """
+        :param db_path: Путь к файлу базы в формате строки или `Path`. Если пусто - очередь хранится в памяти,
+        и неудачные миниатюры повторяются только до конца запуска.
+        """
+        self.path = Path(db_path) if db_path else None
+        if self.path:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Очередь пополняют потоки асинхронного обхода и процессы обхода по шардам, как и `StateStore`
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path) if self.path else ':memory:', timeout=60,
+                                          check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # Запись на каждое Превью не должна ждать сброса на диск: WAL без `fsync` переживает падение процесса
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    page_id TEXT, nation TEXT, entity_id TEXT, nation_name TEXT, path TEXT, preview TEXT,
+                    attempts INTEGER NOT NULL, error TEXT, failed_at INTEGER,
+                    PRIMARY KEY (page_id, nation, entity_id))''')
+
+    def add(self, page_id: str, nation: str, nation_name: str, person_result_path, preview_json: dict) -> None:
+        """
+        Ставит миниатюру Превью в очередь. Повторно добавленное Превью заменяет прежнее и сбрасывает счетчик попыток.
+        :param person_result_path: Путь к папке Персоны формата 'result/red/Zimbabwe/1990-8402/'.
+        :param preview_json: Данные Превью со ссылкой на миниатюру.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, 0, NULL, NULL)',
+                (page_id, nation, preview_json['entity_id'], nation_name, str(person_result_path),
+                 json.dumps(preview_json, ensure_ascii=False)))
+
+    def get_pending(self) -> list:
+        """
+        Все миниатюры, которые еще не скачаны, в том числе неудачные.
+        :return: Список словарей {'page_id', 'nation', 'entity_id', 'nation_name', 'path', 'preview_json',
+        'attempts'}.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT page_id, nation, entity_id, nation_name, path, preview, attempts FROM thumbnails '
+                'ORDER BY attempts, page_id, nation, entity_id').fetchall()
+        return [{'page_id': page_id, 'nation': nation, 'entity_id': entity_id, 'nation_name': nation_name,
+                 'path': Path(path), 'preview_json': json.loads(preview), 'attempts': attempts}
+                for page_id, nation, entity_id, nation_name, path, preview, attempts in rows]
+
+    def done(self, page_id: str, nation: str, entity_id: str) -> None:
+        """Убирает из очереди миниатюру, которая скачана и записана в формат вывода."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM thumbnails WHERE page_id=? AND nation=? AND entity_id=?',
+                                    (page_id, nation, entity_id))
+
+    def fail(self, page_id: str, nation: str, entity_id: str, error: str) -> None:
+        """Отмечает неудачную попытку. Миниатюра остается в очереди для следующего прохода."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE thumbnails SET attempts=attempts+1, error=?, failed_at=? '
+                'WHERE page_id=? AND nation=? AND entity_id=?',
+                (error, int(time.time()), page_id, nation, entity_id))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class ThumbnailFetcher:
+    """
+    Фоновая загрузка отложенных миниатюр. Миниатюры качаются своими потоками параллельно с поиском, а их очередь
+    не ограничена, поэтому поиск и запись Превью никогда не ждут миниатюр. Каждая миниатюра сначала записывается
+    в `ThumbnailQueue` и удаляется из нее только после того, как дописана к записи Превью в формате вывода.
+    Миниатюра, общая для копий Персоны по разным гражданствам, скачивается за запуск один раз, а копии получают
+    жесткие ссылки на ее файл.
+    """
+
+    def __init__(self, queue: ThumbnailQueue, output, client: HttpClient = None, workers: int = 4):
+        """
+        :param queue: Очередь миниатюр.
+        :param output: Формат вывода, в котором сохраняются Превью.
+        :param client: Общий HTTP-клиент.
+        :param workers: Количество потоков загрузки. Если `0` - миниатюра скачивается сразу, в вызывающем потоке.
+        """
+        self.queue = queue
+        self.output = output
+        self.pipeline = ImagePipeline(client=client, workers=workers, queue_size=0, name='thumbnails')
+        self.lock = threading.Lock()
+        self.downloads = {}     # Загрузки миниатюр этого запуска: {адрес миниатюры: `Future` словаря фото}
+        self.stats = {'saved': 0, 'failed': 0}
+
+    def submit(self, page_id: str, nation: str, nation_name: str, person_result_path: Path,
+               preview_json: dict) -> None:
+        """
+        Ставит миниатюру сохраненного Превью в очередь и в загрузку.
+        :param person_result_path: Путь к папке Персоны формата 'result/red/Zimbabwe/1990-8402/'.
+        """
+        self.queue.add(page_id, nation, nation_name, person_result_path, preview_json)
+        self.fetch({'page_id': page_id, 'nation': nation, 'entity_id': preview_json['entity_id'],
+                    'nation_name': nation_name, 'path': Path(person_result_path), 'preview_json': preview_json})
+
+    def resume(self) -> int:
+        """
+        Ставит в загрузку миниатюры, оставшиеся в очереди от прошлых запусков: неудачные и недокачанные.
+        :return: Количество миниатюр.
+        """
+        items = self.queue.get_pending()
+        for item in items:
+            self.fetch(item)
+        return len(items)
+
+    def fetch(self, item: dict) -> None:
+        """Скачивает миниатюру одного Превью из `ThumbnailQueue.get_pending()` или берет уже скачанную."""
+        person = PersonPreview(person_preview_data=item['preview_json'], client=self.pipeline.client)
+        url = person.image_links[0].url if person.image_links else None
+        with self.lock:
+            download = self.downloads.get(url)
+            owner = download is None
+            if owner:
+                download = self.downloads[url] = Future()
+        if owner:
+            self.pipeline.submit(directory=self.output.get_image_dir(item['path']), image_links=person.image_links,
+                                 on_done=functools.partial(self.on_downloaded, download))
+        download.add_done_callback(functools.partial(self.on_done, item, person))
+
+    @staticmethod
+    def on_downloaded(download: Future, images: dict, failed: int) -> None:
+        if failed:
+            download.set_exception(RuntimeError('Thumbnail is not downloaded'))
+        else:
+            download.set_result(images)
+
+    def on_done(self, item: dict, person: PersonPreview, download: Future) -> None:
+        """Дописывает скачанную миниатюру к записи Превью или отмечает неудачную попытку в очереди."""
+        error = download.exception()
+        if error:
+            self.queue.fail(item['page_id'], item['nation'], item['entity_id'], str(error))
+            metrics.inc('thumbnails_total', result='failed')
+            with self.lock:
+                self.stats['failed'] += 1
+            return
+        directory = self.output.get_image_dir(item['path'])
+        # Миниатюра скачана в папку другой копии Персоны - связываем ее файл ссылкой
+        person.images = {name: link_file(Path(path), Path(directory, name))
+                         if directory and Path(path).parent != Path(directory) else Path(path)
+                         for name, path in download.result().items()}
+        self.output.update_images(item['page_id'], item['nation'], item['nation_name'], item['path'], person,
+                                  on_saved=functools.partial(self.queue.done, item['page_id'], item['nation'],
+                                                             item['entity_id']))
+        metrics.inc('thumbnails_total', result='saved')
+        with self.lock:
+            self.stats['saved'] += 1
+
+    def flush(self) -> None:
+        """Дожидается загрузки всех миниатюр, уже поставленных в очередь."""
+        self.pipeline.flush()
+
+    def close(self) -> None:
+        """
+        Останавливает потоки загрузки. Миниатюры, загрузка которых еще не началась (прерванный обход), остаются
+        в `ThumbnailQueue` и будут скачаны следующим запуском.
+        """
+        cancelled = self.pipeline.cancel()
+        self.pipeline.close()
+        self.output.flush()     # Миниатюра убирается из очереди, только когда формат вывода записал ее
+        self.queue.close()
+        # Повторить загрузку можно, только если очередь сохранена на диске
+        retry = f' Повторить загрузку: `python main.py --thumbnails`' if self.queue.path else ''
+        if cancelled:
+            logger.warning(f'Загрузка миниатюр прервана, не скачано: {cancelled}.{retry}')
+        if self.stats['failed']:
+            logger.warning(f"Миниатюр скачано: {self.stats['saved']}, не скачано: {self.stats['failed']}.{retry}")
+        elif self.stats['saved']:
+            logger.info(f"Миниатюр скачано: {self.stats['saved']}")
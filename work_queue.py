@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def in_shard(page_id: str, nation: str, gender: str, shard: tuple) -> bool:
+    """
+    Относится ли комбинация фильтров к статическому шарду. Комбинации распределяются по хэшу, поэтому
+    шард не зависит от порядка гражданств на странице и одинаков на всех машинах.
+    :param shard: Кортеж (номер шарда от `1`, количество шардов).
+    """
+    index, count = shard
+    return zlib.crc32(f'{page_id}/{nation}/{gender}'.encode()) % count == index - 1
+
+
+class WorkQueue:
+    """
+    Очередь работы в SQLite для обхода несколькими процессами или машинами с общей файловой системой.
+    Единица работы (шард) - комбинация (тип страницы, гражданство, пол). Процесс берет шард в аренду (`claim`),
+    продлевает аренду, пока его обходит (`keep_alive`), и отмечает выполненным (`complete`). Шард процесса,
+    который упал или был остановлен, освобождается по истечении аренды и достается другому процессу.
+    """
+
+    def __init__(self, db_path, lease: float = 600, max_attempts: int = 3):
+        """
+        :param db_path: Путь к файлу очереди в формате строки или `Path`.
+        :param lease: Время аренды шарда в секундах. Аренда продлевается, пока процесс работает над шардом.
+        :param max_attempts: Сколько раз шард можно взять в работу. После этого он отмечается неудачным.
+        """
+        self.path = Path(db_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Транзакции открываем сами через `BEGIN IMMEDIATE`, чтобы два процесса не взяли один шард
+        self.connection = sqlite3.connect(str(self.path), timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS shards (
+                id INTEGER PRIMARY KEY, page_id TEXT, nation TEXT, gender TEXT, status TEXT, owner TEXT,
+                lease_until REAL, attempts INTEGER, UNIQUE (page_id, nation, gender))''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def is_populated(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM meta WHERE key='populated'").fetchone() is not None
+
+    def populate(self, items: list) -> None:
+        """
+        Заполняет очередь шардами. Повторный вызов из другого процесса ничего не дублирует.
+        :param items: Список кортежей (тип страницы, гражданство, пол).
+        """
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO shards (page_id, nation, gender, status, attempts) "
+                "VALUES (?, ?, ?, 'pending', 0)", items)
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('populated', '1')")
+
+    def claim(self, owner: str):
+        """
+        Берет в аренду очередной свободный шард или шард с истекшей арендой.
+        :param owner: Идентификатор процесса.
+        :return: Словарь {'id', 'page_id', 'nation', 'gender'} или `None`, если свободных шардов нет.
+        """
+        with self.transaction() as connection:
+            while True:
+                now = time.time()
+                row = connection.execute(
+                    "SELECT id, page_id, nation, gender, attempts FROM shards "
+                    "WHERE status='pending' OR (status='leased' AND lease_until < ?) ORDER BY id LIMIT 1",
+                    (now,)).fetchone()
+                if row is None:
+                    return None
+                shard_id, page_id, nation, gender, attempts = row
+                if attempts >= self.max_attempts:
+                    connection.execute("UPDATE shards SET status='failed', owner=NULL WHERE id=?", (shard_id,))
+                    continue
+                connection.execute(
+                    "UPDATE shards SET status='leased', owner=?, lease_until=?, attempts=attempts+1 WHERE id=?",
+                    (owner, now + self.lease, shard_id))
+                return {'id': shard_id, 'page_id': page_id, 'nation': nation, 'gender': gender}
+
+    def renew(self, shard_id: int, owner: str) -> bool:
+        """Продлевает аренду. Возвращает `False`, если шард уже забрал другой процесс."""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE shards SET lease_until=? WHERE id=? AND owner=? AND status='leased'",
+                (time.time() + self.lease, shard_id, owner))
+            return cursor.rowcount > 0
+
+    @contextmanager
+    def keep_alive(self, shard_id: int, owner: str):
+        """Продлевает аренду шарда в фоновом потоке, пока выполняется блок `with`."""
+        stop = threading.Event()
+
+        def renew_loop():
+            while not stop.wait(self.lease / 3):
+                if not self.renew(shard_id, owner):
+                    logger.warning(f'Shard {shard_id} lease lost')
+                    break
+
+        thread = threading.Thread(target=renew_loop, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, shard_id: int, owner: str) -> None:
+        with self.transaction() as connection:
+            connection.execute("UPDATE shards SET status='done', owner=NULL WHERE id=? AND owner=?", (shard_id, owner))
+
+    def release(self, shard_id: int, owner: str) -> None:
+        """Возвращает шард в очередь, например, если часть его запросов не удалась или процесс прерван."""
+        with self.transaction() as connection:
+            connection.execute("UPDATE shards SET status='pending', owner=NULL WHERE id=? AND owner=?",
+                               (shard_id, owner))
+
+    def retry_failed(self) -> int:
+        """
+        Возвращает в очередь шарды, исчерпавшие попытки, со сброшенным счетчиком попыток.
+        :return: Количество возвращенных шардов.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE shards SET status='pending', owner=NULL, attempts=0 WHERE status='failed'")
+            return cursor.rowcount
+
+    def get_counts(self) -> dict:
+        """Количество шардов по статусам: {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}."""
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        with self.lock:
+            for status, count in self.connection.execute('SELECT status, COUNT(*) FROM shards GROUP BY status'):
+                counts[status] = count
+        return counts
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()